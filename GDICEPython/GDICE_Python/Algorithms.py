@@ -1,11 +1,18 @@
+import copy
 import numpy as np
-from .Domains import MultiPOMDP
+from functools import partial
+from multiprocessing import cpu_count
+from .Domains import MultiPOMDP, VectorizedMultiPOMDP, VectorizedMultiDPOMDP, getExpectedRewards, getMDPBaseline
 from gym_dpomdps import MultiDPOMDP
 from .GDICEEnvWrapper import GDICEEnvWrapper
 from .Scripts import saveResults
 from .Evaluation import *
+from .EvaluationCache import EvaluationCache
+from .EvaluationStore import getEnvironmentFingerprint, getEstimatorKey
+from .EvaluationPool import EvaluationPool
+from .RandomStreams import RandomStreams
 from .Utils import _initGDICERunVariables, _parsePartialResultsToGDICERunVariables, _checkEnv, _checkControllerDist, \
-    sampleFromControllerDistribution, updateControllerDistribution
+    sampleFromControllerDistribution, updateControllerDistribution, getControllerDistributionTables
 
 # Run GDICE with controller(s) on an environment, given
 # Inputs:
@@ -13,12 +20,50 @@ from .Utils import _initGDICERunVariables, _parsePartialResultsToGDICERunVariabl
 #   controller: A controller or list of controllers corresponding to agents in the environment
 #   params: GDICEParams object
 #   timeHorizon: Number of timesteps to evaluate to. If None, run each sample until episode is finished
-#   parallel: Attempt to use python multiprocessing across samples. If not None, should be a Pool object
+#                If params.horizonTolerance is set, this is cut to the epsilon horizon of the environment (see getEpsilonHorizon)
+#   parallel: Attempt to use python multiprocessing across samples. If not None, should be a Pool object, or an
+#             EvaluationPool to keep the environment loaded in the workers, or a ThreadEvaluationPool to run the
+#             rollouts in threads with a compiled kernel that releases the GIL (envType 2, see NumbaEvaluation)
 #   convergenceThreshold: If set, attempts to detect early convergence within a run and stop before all iterations are done
 #   saveFrequency: How frequently to save results in the middle of a run (numIterations between saves)
 #   baseDir: Where to save temp results relative to. Defaults to current directory
-#   envType: 0 if standard MultiPOMDP, anything else for GDICEEnvWrapper
-def runGDICEOnEnvironment(env, controller, params, parallel=None, results=None, convergenceThreshold=0, saveFrequency=50, baseDir='', envType=0):
+#   envType: 0 if standard MultiPOMDP, 1 for GDICEEnvWrapper, 2 for the vectorized (inverse-CDF) multi-trajectory wrapper
+#   evalType: 'sample' to evaluate each sampled controller separately. With parallel, each sample's simulations are split
+#                      into blocks when there are fewer samples than shards, so every worker stays busy (see _scheduleShards)
+#             'batched' to advance the rollouts of all samples together in one wrapper. With parallel, the (samples x
+#                       simulations) rollouts are split into balanced shards across the workers instead (see _scheduleShards)
+#             'exact' to solve for each sample's infinite-horizon discounted value exactly (parallel is not used). As the
+#                     default wrappers do, trajectories keep going past the end of an episode (see evaluateSamplesExactPOMDP)
+#             'exactFinite' to compute each sample's value over timeHorizon exactly, with the same episode ends (parallel is not used)
+#             'racing' to race the samples for the elite set, spending most simulations on contenders (parallel is not used)
+#             'offPolicy' to estimate all samples by importance weighting numSimulationsPerSample rollouts of the controller
+#                         distribution, simulating samples with an effective sample size below 10% of that directly
+#                         (see evaluateSamplesOffPolicy, parallel is not used). numSimulations logs the fallbacks.
+#                         Only worth it for short horizons or a concentrated distribution: the effective sample size
+#                         shrinks geometrically with the horizon, and fallbacks cost more than 'sample'
+#   cacheSize: If nonzero, reuse the statistics of sampled controllers already evaluated this run, keeping up to
+#              this many controllers (least recently used are evicted). Hits per iteration are logged as cacheHits
+#   evaluationStore: If not None, an EvaluationStore shared across runs. Controllers with enough stored simulations on this
+#                    environment and horizon (by the same return estimator, see getEstimatorKey) are not simulated again,
+#                    and all new simulations are added to it. Only for the simulation-based evalTypes. High-fidelity
+#                    re-evaluations (params.highFidelitySimulations) are always simulated afresh and never use the store
+#   If params.confidenceWidth is set, 'sample' and 'batched' simulate all samples together in growing batches until each
+#   sample's confidence interval is narrow enough (see evaluateSamplesSequential, parallel is not used). The simulations
+#   spent on each sample are logged as numSimulations
+#   If params.chunkSize is set, 'sample' and 'batched' simulate at most that many trajectories at once. Across the pool,
+#   each sample's simulations are split into chunks of that size. Chunk results are merged with RunningStatistics
+#   If params.highFidelitySimulations is set, samples are only compared with the cheap search budget. The search tier's
+#   best controller is re-evaluated with the high-fidelity budget (across the pool if given) when it has changed, every
+#   reevaluateFrequency iterations and at the end, together with the current best. bestValue and the best tables are
+#   those of the best controller of the latest re-evaluation. The search tier's best value is logged as searchBestValue,
+#   the best value of each re-evaluation as highFidelityValue
+#   reevaluateFrequency: With params.highFidelitySimulations, how often (numIterations) a changed search best is
+#                        re-evaluated. 1 re-evaluates it in the iteration it changes
+#   reevaluateElite: With params.highFidelitySimulations, also re-evaluate the last elite set at the end
+#   params.quasiRandom and params.antithetic select the random streams of the vectorized wrapper (see RandomStreams)
+#   If params.commonRandomNumbers is set, the simulation-based evalTypes give every sample of an iteration the same
+#   random streams. This needs the vectorized wrapper (envType 2), whose randomness does not depend on the actions taken
+def runGDICEOnEnvironment(env, controller, params, parallel=None, results=None, convergenceThreshold=0, saveFrequency=50, baseDir='', envType=0, evalType='sample', cacheSize=0, evaluationStore=None, reevaluateFrequency=1, reevaluateElite=False):
     nAgents, nActions, nObs = _checkEnv(env)
     nNodes, nActionsC, nObsC = _checkControllerDist(controller)
     # Ensure controller matches environment
@@ -26,13 +71,37 @@ def runGDICEOnEnvironment(env, controller, params, parallel=None, results=None,
     # Ensure params match controllers
     if isinstance(nNodes, (int, np.integer)): assert nNodes == params.numNodes
 
-    # Choose appropriate evaluation function
-    envEvalFn = evaluateSampleMultiDPOMDP if nAgents > 1 else evaluateSampleMultiPOMDP
-
     # Swap the wrapper function if using other type of environment
-    MultiEnvWrapper = GDICEEnvWrapper if envType else MultiPOMDP if nAgents == 1 else MultiDPOMDP
+    MultiEnvWrapper = _chooseEnvWrapper(envType, nAgents, getattr(env, 'sparse', False))
+    commonRandomNumbers = params.commonRandomNumbers and evalType in ('sample', 'batched', 'racing')
+    assert not commonRandomNumbers or MultiEnvWrapper in (VectorizedMultiPOMDP, VectorizedMultiDPOMDP)
+    # Expected rewards and baseline values are looked up from the wrapper's current states, which GDICEEnvWrapper does not track
+    assert not (params.raoBlackwell or params.controlVariate) or MultiEnvWrapper is not GDICEEnvWrapper
+    # Sequential stopping batches the rollouts of all samples, and racing already allocates its own simulations
+    assert params.confidenceWidth is None or (evalType != 'racing' and MultiEnvWrapper is not GDICEEnvWrapper)
+    # Variance-reduced random streams plug into the vectorized wrappers' uniform draws
+    if params.quasiRandom is not None or params.antithetic:
+        assert MultiEnvWrapper in (VectorizedMultiPOMDP, VectorizedMultiDPOMDP)
+        MultiEnvWrapper = partial(MultiEnvWrapper, streams=RandomStreams(params.quasiRandom or 'uniform', params.antithetic))
 
     timeHorizon = params.timeHorizon
+    # Stop rollouts once the discounted tail can no longer change a value by more than the tolerance
+    if params.horizonTolerance is not None:
+        epsilonHorizon = getEpsilonHorizon(env, params.horizonTolerance)
+        if epsilonHorizon is not None:
+            timeHorizon = epsilonHorizon if timeHorizon is None else min(timeHorizon, epsilonHorizon)
+    assert evalType != 'offPolicy' or not (params.controlVariate or commonRandomNumbers)
+    evaluateFn = partial(_evaluateSamples, env, MultiEnvWrapper, nAgents, params, timeHorizon, evalType, parallel, commonRandomNumbers, controller)
+    if evaluationStore is not None:
+        assert evalType in ('sample', 'batched', 'racing', 'offPolicy')
+        evaluateFn = partial(evaluationStore.evaluateSamples, evaluateFn, getEnvironmentFingerprint(env), getEstimatorKey(params),
+                             -1 if timeHorizon is None else timeHorizon, params.numSimulationsPerSample)
+    evaluationCache = EvaluationCache(cacheSize) if cacheSize else None
+    twoTier = params.highFidelitySimulations is not None
+    assert not twoTier or evalType in ('sample', 'batched', 'racing', 'offPolicy')
+    if twoTier:
+        reevaluateFn = partial(_reevaluateSamples, env, MultiEnvWrapper, nAgents, params,
+                               timeHorizon if params.highFidelityTimeHorizon is None else params.highFidelityTimeHorizon, parallel)
     if results is None:  # Not continuing previous results
         # Reset controller
         if nAgents == 1 or params.centralized: controller.reset()
@@ -40,12 +109,18 @@ def runGDICEOnEnvironment(env, controller, params, parallel=None, results=None,
         # Start variables
         bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs, estimatedConvergenceIteration, \
         allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration, startIter, \
-        worstValueOfPreviousIteration = _initGDICERunVariables(params)
+        worstValueOfPreviousIteration, evaluationLog = _initGDICERunVariables(params)
     else:  # Continuing
         bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs, estimatedConvergenceIteration, \
         allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration, startIter, \
-        worstValueOfPreviousIteration =_parsePartialResultsToGDICERunVariables(params, results)
-
+        worstValueOfPreviousIteration, evaluationLog = _parsePartialResultsToGDICERunVariables(params, results)
+    # Best value of the search tier, which samples are compared against. Same as bestValue without high-fidelity re-evaluation
+    searchBestValue, searchBestStdDev = bestValue, bestValueVariance
+    searchBestActions, searchBestNodes = bestActionProbs, bestNodeTransitionProbs
+    if startIter > 0 and not np.isnan(evaluationLog['searchBestValue'][startIter - 1]):
+        searchBestValue, searchBestStdDev = evaluationLog['searchBestValue'][startIter - 1], evaluationLog['searchBestStdDev'][startIter - 1]
+    needsReevaluation = False
+    eliteActions, eliteNodes = None, None
 
     iterBestValue = np.NINF  # What is the most recently seen best controller value
     for iteration in range(startIter, params.numIterations):
@@ -53,24 +128,28 @@ def runGDICEOnEnvironment(env, controller, params, parallel=None, results=None,
         sampledActions, sampledNodes = sampleFromControllerDistribution(controller, params.numSamples, nAgents)
 
         # For each sampled action, evaluate in environment
-        # For parallel, parallelize across simulations
-        if parallel is not None:
-            res = parallel.starmap(envEvalFn, [(MultiEnvWrapper(env, params.numSimulationsPerSample),
-                                                              timeHorizon, sampledActions[:, i],
-                                                              sampledNodes[:, :, i]) for i in range(params.numSamples)])
-            values, stdDev = (np.array([ent[0] for ent in res]), np.array([ent[1] for ent in res]))
+        # Samples whose tables were already evaluated this run are served from the cache
+        if evaluationCache is None:
+            values, stdDev, numSimulations, eliminated = evaluateFn(sampledActions, sampledNodes)
         else:
-            multiEnv = MultiEnvWrapper(env, params.numSimulationsPerSample)
-            res = [envEvalFn(multiEnv, timeHorizon, sampledActions[:,i], sampledNodes[:,:,i]) for i in range(params.numSamples)]
-            values, stdDev = (np.array([ent[0] for ent in res]), np.array([ent[1] for ent in res]))
+            hitsBefore = evaluationCache.hits
+            values, stdDev, numSimulations, eliminated = evaluationCache.evaluateSamples(evaluateFn, sampledActions, sampledNodes)
+            evaluationLog['cacheHits'][iteration] = evaluationCache.hits - hitsBefore
 
         # Save values
         allValues[iteration, :] = values
         allStdDev[iteration, :] = stdDev
+        evaluationLog['numSimulations'][iteration, :] = numSimulations
+        evaluationLog['eliminated'][iteration, :] = eliminated
+        evaluationLog['timeHorizon'][iteration] = -1 if evalType == 'exact' or timeHorizon is None else timeHorizon
 
         # Find N_b best policies
-        bestValues, bestSampleIndices, bestValue, bestValueVariance, controllerChange = \
-            _reduceSamplesToBest(values, stdDev, bestValue, bestValueVariance, params.numBestSamples, worstValueOfPreviousIteration)
+        bestValues, bestSampleIndices, searchBestValue, searchBestStdDev, controllerChange = \
+            _reduceSamplesToBest(values, stdDev, searchBestValue, searchBestStdDev, params.numBestSamples, worstValueOfPreviousIteration)
+        evaluationLog['searchBestValue'][iteration] = searchBestValue
+        evaluationLog['searchBestStdDev'][iteration] = searchBestStdDev
+        if not twoTier:
+            bestValue, bestValueVariance = searchBestValue, searchBestStdDev
 
         # Update worst value to this one
         try:
@@ -80,12 +159,25 @@ def runGDICEOnEnvironment(env, controller, params, parallel=None, results=None,
 
         # Update latest controller if best value changed
         if controllerChange:
-            bestActionProbs = sampledActions[:, bestSampleIndices[-1]]
-            bestNodeTransitionProbs = sampledNodes[:, :, bestSampleIndices[-1]]
+            searchBestActions = sampledActions[:, bestSampleIndices[-1]]
+            searchBestNodes = sampledNodes[:, :, bestSampleIndices[-1]]
+            if twoTier:
+                needsReevaluation = True
+            else:
+                bestActionProbs, bestNodeTransitionProbs = searchBestActions, searchBestNodes
+
+        # Re-evaluate a changed search best
+        if needsReevaluation and (iteration + 1) % reevaluateFrequency == 0:
+            bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs = \
+                _reevaluateCandidates(reevaluateFn, np.expand_dims(searchBestActions, 1), np.expand_dims(searchBestNodes, 2),
+                                      bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs, evaluationLog, iteration)
+            needsReevaluation = False
 
         #If we're using a value threshold, also throw away iterations below that
         if params.valueThreshold is not None:
             bestSampleIndices = _applyValueThreshold(params.valueThreshold, bestValues, bestSampleIndices)
+        if bestSampleIndices.shape[0] > 0:
+            eliteActions, eliteNodes = sampledActions[:, bestSampleIndices], sampledNodes[:, :, bestSampleIndices]
 
         # For each controller, for each node, update using best samples (if there are any)
         if bestSampleIndices.shape[0] > 0:
@@ -117,16 +209,191 @@ def runGDICEOnEnvironment(env, controller, params, parallel=None, results=None,
         # Save occasionally so we don't lose everything in a crash. Saves relative to working dir
         if saveFrequency and iteration % saveFrequency == 0:
             saveResults(baseDir, env.spec.id, params, (bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs,
-                                               controller, estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration))
+                                               controller, estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration,
+                                               evaluationLog))
 
         # Notify the environment that an iteration has finished
         if hasattr(env, 'gdice_iteration_end'):
             env.gdice_iteration_end()
 
+    # Final high-fidelity re-evaluation of the best controller (and the last elite set)
+    if twoTier and startIter < params.numIterations and (needsReevaluation or (reevaluateElite and eliteActions is not None)):
+        candidateActions = np.expand_dims(searchBestActions, 1)[:, :int(needsReevaluation)]
+        candidateNodes = np.expand_dims(searchBestNodes, 2)[:, :, :int(needsReevaluation)]
+        if reevaluateElite and eliteActions is not None:
+            candidateActions = np.concatenate((candidateActions, eliteActions), axis=1)
+            candidateNodes = np.concatenate((candidateNodes, eliteNodes), axis=2)
+        bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs = \
+            _reevaluateCandidates(reevaluateFn, candidateActions, candidateNodes, bestValue, bestValueVariance,
+                                  bestActionProbs, bestNodeTransitionProbs, evaluationLog, iteration)
+        bestValueAtEachIteration[iteration], bestStdDevAtEachIteration[iteration] = bestValue, bestValueVariance
+
     # Return best policy, best value, updated controller
     return bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs, controller, \
-           estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration
+           estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration, \
+           evaluationLog
+
+
+# Evaluate sampled controllers with the chosen evalType (see runGDICEOnEnvironment)
+# Output:
+#   values, stdDev: (numSamples,) value estimates and standard deviations of the returns
+#   numSimulations: (numSamples,) number of simulations spent on each sample
+#   eliminated: (numSamples,) whether each sample was dropped early by racing
+def _evaluateSamples(env, MultiEnvWrapper, nAgents, params, timeHorizon, evalType, parallel, commonRandomNumbers, controller, sampledActions, sampledNodes):
+    numSamples = sampledActions.shape[1]
+    numSimulations = np.full(numSamples, params.numSimulationsPerSample, dtype=np.int64)
+    eliminated = np.zeros(numSamples, dtype=bool)
+
+    # Choose appropriate evaluation function
+    envEvalFn = evaluateSampleMultiDPOMDP if nAgents > 1 else evaluateSampleMultiPOMDP
+    batchEvalFn = evaluateSamplesMultiDPOMDP if nAgents > 1 else evaluateSamplesMultiPOMDP
+    exactEvalFn = evaluateSamplesExactDPOMDP if nAgents > 1 else evaluateSamplesExactPOMDP
+    finiteEvalFn = evaluateSamplesFiniteHorizonDPOMDP if nAgents > 1 else evaluateSamplesFiniteHorizonPOMDP
+    expectedRewards = getExpectedRewards(env) if params.raoBlackwell else None
+    baseline = getMDPBaseline(env) if params.controlVariate else None
+    batchEvalFn = partial(batchEvalFn, expectedRewards=expectedRewards, baseline=baseline)
+
+    # For parallel, parallelize across simulations
+    if evalType == 'exact':
+        values, stdDev = exactEvalFn(env, sampledActions, sampledNodes)
+        numSimulations[:] = 0
+    elif evalType == 'exactFinite':
+        values, stdDev = finiteEvalFn(env, timeHorizon, sampledActions, sampledNodes)
+        numSimulations[:] = 0
+    elif evalType == 'racing':
+        values, stdDev, numSimulations, eliminated = evaluateSamplesRacing(env, MultiEnvWrapper, batchEvalFn, timeHorizon, sampledActions, sampledNodes,
+                                                                           params.numSimulationsPerSample, params.numBestSamples,
+                                                                           commonRandomNumbers=commonRandomNumbers)
+    elif evalType == 'offPolicy':
+        actionProbabilities, nodeTransitionProbabilities = getControllerDistributionTables(controller, nAgents)
+        values, stdDev, numSimulations = evaluateSamplesOffPolicy(env, MultiEnvWrapper, batchEvalFn, timeHorizon, sampledActions, sampledNodes,
+                                                                  actionProbabilities, nodeTransitionProbabilities,
+                                                                  params.numSimulationsPerSample, params.numSimulationsPerSample,
+                                                                  params.numSimulationsPerSample / 10, expectedRewards)[:3]
+    elif params.confidenceWidth is not None:
+        values, stdDev, numSimulations = evaluateSamplesSequential(env, MultiEnvWrapper, batchEvalFn, timeHorizon, sampledActions, sampledNodes,
+                                                                   params.confidenceWidth, params.numSimulationsPerSample,
+                                                                   commonRandomNumbers=commonRandomNumbers)
+    elif parallel is not None and evalType in ('sample', 'batched'):
+        # Balanced shards of (samples x simulations), each on its own random stream (shared by a simulation block with CRN)
+        # 'sample' shards hold one sample each, and split its simulations into blocks when there are few samples
+        batched = evalType == 'batched'
+        numShards = 4 * _getNumWorkers(parallel)
+        if params.chunkSize is not None:  # Also keep shards within the chunk size
+            numShards = max(numShards, -(-numSamples * params.numSimulationsPerSample // params.chunkSize) if batched else
+                                       numSamples * -(-params.numSimulationsPerSample // params.chunkSize))
+        shards = _scheduleShards(numSamples, params.numSimulationsPerSample, numShards, None if batched else 1)
+        seeds = [int(seed.generate_state(1)[0]) for seed in np.random.SeedSequence(np.random.randint(2**31 - 1)).spawn(len(shards))]
+        seeds = [seeds[shard[1]] if commonRandomNumbers else seeds[i] for i, shard in enumerate(shards)]
+        if batched and isinstance(parallel, EvaluationPool):
+            res = parallel.evaluateBatches(env, MultiEnvWrapper, timeHorizon, [(numSims, numSims if commonRandomNumbers else None, seeds[i], sampledActions[:, samples],
+                                                                                sampledNodes[:, :, samples]) for i, (samples, _, numSims) in enumerate(shards)],
+                                           params.raoBlackwell, params.controlVariate)
+        elif batched:
+            res = parallel.starmap(_evaluateSeededSample, [(batchEvalFn, MultiEnvWrapper(env, samples.shape[0] * numSims, **({'numStreams': numSims} if commonRandomNumbers else {})),
+                                                            seeds[i], timeHorizon, sampledActions[:, samples], sampledNodes[:, :, samples])
+                                                           for i, (samples, _, numSims) in enumerate(shards)])
+        elif isinstance(parallel, EvaluationPool):  # Workers hold the environment, only send the tables
+            res = parallel.evaluate(env, MultiEnvWrapper, timeHorizon, [(numSims, seeds[i], sampledActions[:, samples[0]], sampledNodes[:, :, samples[0]])
+                                                                        for i, (samples, _, numSims) in enumerate(shards)],
+                                    params.raoBlackwell, params.controlVariate)
+        else:
+            res = parallel.starmap(_evaluateSeededSample, [(envEvalFn, MultiEnvWrapper(env, numSims), seeds[i], timeHorizon, sampledActions[:, samples[0]],
+                                                            sampledNodes[:, :, samples[0]], expectedRewards, baseline)
+                                                           for i, (samples, _, numSims) in enumerate(shards)])
+        statistics = RunningStatistics(numSamples)
+        for (samples, _, numSims), ent in zip(shards, res):
+            statistics.add(numSims, ent[0], ent[1], samples)
+        values, stdDev = statistics.values, statistics.stdDevs
+    elif params.chunkSize is not None and (evalType == 'batched' or parallel is None):
+        values, stdDev = evaluateSamplesChunked(env, MultiEnvWrapper, batchEvalFn, timeHorizon, sampledActions, sampledNodes,
+                                                params.numSimulationsPerSample, params.chunkSize, commonRandomNumbers=commonRandomNumbers)
+    elif evalType == 'batched':
+        # Trajectories are sample-major, so sharing numSimulationsPerSample streams gives each simulation index the same stream in every sample
+        # (only the vectorized wrappers take numStreams, see the CRN assert in runGDICEOnEnvironment)
+        multiEnv = MultiEnvWrapper(env, numSamples * params.numSimulationsPerSample,
+                                   **({'numStreams': params.numSimulationsPerSample} if commonRandomNumbers else {}))
+        values, stdDev = batchEvalFn(multiEnv, timeHorizon, sampledActions, sampledNodes)
+    else:
+        crnSeed = np.random.randint(2**31 - 1) if commonRandomNumbers else None
+        multiEnv = MultiEnvWrapper(env, params.numSimulationsPerSample)
+        res = [envEvalFn(_seedForSample(multiEnv, crnSeed), timeHorizon, sampledActions[:,i], sampledNodes[:,:,i], expectedRewards, baseline) for i in range(numSamples)]
+        values, stdDev = (np.array([ent[0] for ent in res]), np.array([ent[1] for ent in res]))
+    return values, stdDev, numSimulations, eliminated
+
+# Evaluate sampled controllers with the high-fidelity budget of params (see runGDICEOnEnvironment)
+# Each sample's simulations are split into chunks across the pool (one per worker if params.chunkSize is not set)
+# Output:
+#   values, stdDev: (numSamples,) high-fidelity value estimates and standard deviations of the returns
+def _reevaluateSamples(env, MultiEnvWrapper, nAgents, params, timeHorizon, parallel, sampledActions, sampledNodes):
+    highFidelityParams = copy.copy(params)
+    highFidelityParams.numSimulationsPerSample = params.highFidelitySimulations
+    highFidelityParams.confidenceWidth = None
+    if parallel is not None and params.chunkSize is None:
+        highFidelityParams.chunkSize = -(-params.highFidelitySimulations // _getNumWorkers(parallel))
+    return _evaluateSamples(env, MultiEnvWrapper, nAgents, highFidelityParams, timeHorizon, 'sample', parallel, False, None,
+                            sampledActions, sampledNodes)[:2]
+
+# Re-evaluate candidate controllers with the high-fidelity budget, together with the previous best
+# The previous best is compared on a fresh estimate too, so a lucky earlier estimate neither keeps out better candidates
+# nor stays the reported value. The new best's high-fidelity statistics are logged at iteration
+# Output:
+#   bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs: Updated best controller and its statistics
+def _reevaluateCandidates(reevaluateFn, candidateActions, candidateNodes, bestValue, bestValueVariance, bestActionProbs,
+                          bestNodeTransitionProbs, evaluationLog, iteration):
+    if candidateActions.shape[1] == 0:
+        return bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs
+    if bestActionProbs is not None:
+        candidateActions = np.concatenate((candidateActions, np.expand_dims(bestActionProbs, 1)), axis=1)
+        candidateNodes = np.concatenate((candidateNodes, np.expand_dims(bestNodeTransitionProbs, 2)), axis=2)
+    values, stdDev = reevaluateFn(candidateActions, candidateNodes)
+    best = np.argmax(values)
+    evaluationLog['highFidelityValue'][iteration], evaluationLog['highFidelityStdDev'][iteration] = values[best], stdDev[best]
+    return values[best], stdDev[best], candidateActions[:, best], candidateNodes[:, :, best]
+
+# Choose the multi-trajectory wrapper class for an environment type (see runGDICEOnEnvironment)
+# Sparse POMDPs (see sparsifyPOMDP) can only be stepped by the vectorized wrapper
+def _chooseEnvWrapper(envType, nAgents, sparse=False):
+    if envType == 2 or (sparse and nAgents == 1):
+        return VectorizedMultiPOMDP if nAgents == 1 else VectorizedMultiDPOMDP
+    if envType:
+        return GDICEEnvWrapper
+    return MultiPOMDP if nAgents == 1 else MultiDPOMDP
+
+# Reseed a multi-trajectory wrapper before evaluating one sample, so that every sample given the same seed
+# consumes the same random streams (common random numbers). No-op if seed is None
+def _seedForSample(multiEnv, seed):
+    if seed is not None:
+        multiEnv.env.seed(seed)
+    return multiEnv
+
+# Split the (numSamples x numSimulationsPerSample) rollouts of an iteration into about numShards blocks of similar size
+# Samples are split into groups and simulations into blocks, so shards stay balanced whether there are few samples
+# with many simulations or many samples with few
+# Inputs:
+#   maxSamplesPerShard: If set, the most samples a shard may hold (1 to evaluate samples separately)
+# Output:
+#   shards: List of (samples, simulationBlock, numSimulations): the sample indices of the shard, the index of its
+#           block of simulations, and the number of simulations it runs of each of its samples
+def _scheduleShards(numSamples, numSimulationsPerSample, numShards, maxSamplesPerShard=None):
+    simulationSplits = min(numSimulationsPerSample, max(1, int(round(numShards / numSamples))))
+    simulationsPerShard = -(-numSimulationsPerSample // simulationSplits)
+    sampleGroups = min(numSamples, max(1, int(round(numShards / simulationSplits))))
+    if maxSamplesPerShard is not None:
+        sampleGroups = max(sampleGroups, -(-numSamples // maxSamplesPerShard))
+    samplesPerShard = -(-numSamples // sampleGroups)
+    return [(np.arange(firstSample, min(firstSample + samplesPerShard, numSamples)), block,
+             min(simulationsPerShard, numSimulationsPerSample - firstSimulation))
+            for block, firstSimulation in enumerate(range(0, numSimulationsPerSample, simulationsPerShard))
+            for firstSample in range(0, numSamples, samplesPerShard)]
+
+# Number of worker processes of a pool (the number of CPUs if the pool does not say)
+def _getNumWorkers(parallel):
+    return getattr(parallel, 'processes', None) or getattr(parallel, '_processes', None) or cpu_count()
 
+# Seed and evaluate one sample (or shard of samples) in a pool worker (see _seedForSample)
+def _evaluateSeededSample(envEvalFn, multiEnv, seed, *args):
+    return envEvalFn(_seedForSample(multiEnv, seed), *args)
 
 # Return the best N_b samples. Update the best value if it changes, return whether best tables need to be updated
 def _reduceSamplesToBest(sampleValues, sampleStdDev, bestValue, bestValueVariance, numBestSamples, worstValueOfPreviousIteration):
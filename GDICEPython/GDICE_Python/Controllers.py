@@ -176,6 +176,62 @@ class FiniteStateControllerDistribution(object):
                       noiseInjectionRate * np.ones((np.sum(ntIndices), self.numNodes))/self.numNodes
         return injectedNoise
 
+# Canonical form of a deterministic controller, so that controllers that behave identically have identical tables
+# Nodes unreachable from the start node (0) are dropped, and the rest are renumbered in breadth-first visit order
+# (observations expanded in index order). Optionally, bisimilar nodes (same action, and bisimilar successors for every
+# observation) are merged first
+# For the per-agent layout, each agent's controller is canonicalized separately and padded to a common number of nodes
+# with unreachable nodes (action 0, all transitions to node 0)
+#   Inputs:
+#     actionTransitions: (numNodes,) or (numNodes, numAgents) array of actions to perform at each node
+#     nodeObservationTransitions: (numObservations, numNodes) or (numObservations, numNodes, numAgents) array of end nodes
+#     mergeBisimilar: If True, merge bisimilar nodes
+#   Outputs:
+#     actionTransitions, nodeObservationTransitions: Canonical tables, in the same layout with fewer nodes
+def canonicalizeController(actionTransitions, nodeObservationTransitions, mergeBisimilar=False):
+    if actionTransitions.ndim == 1:
+        return _canonicalizeSingleController(actionTransitions, nodeObservationTransitions, mergeBisimilar)
+    canonical = [_canonicalizeSingleController(actionTransitions[:, a], nodeObservationTransitions[:, :, a], mergeBisimilar)
+                 for a in range(actionTransitions.shape[1])]
+    numNodes = max(actions.shape[0] for actions, _ in canonical)
+    paddedActions = np.zeros((numNodes, len(canonical)), dtype=actionTransitions.dtype)
+    paddedNodes = np.zeros((nodeObservationTransitions.shape[0], numNodes, len(canonical)), dtype=nodeObservationTransitions.dtype)
+    for a, (actions, nodes) in enumerate(canonical):
+        paddedActions[:actions.shape[0], a] = actions
+        paddedNodes[:, :actions.shape[0], a] = nodes
+    return paddedActions, paddedNodes
+
+def _canonicalizeSingleController(actionTransitions, nodeObservationTransitions, mergeBisimilar):
+    numObs = nodeObservationTransitions.shape[0]
+    startNode = 0
+    if mergeBisimilar:
+        # Partition refinement: split blocks of nodes by action, then by the blocks of their successors, until stable
+        blocks = np.unique(actionTransitions, return_inverse=True)[1].ravel()
+        while True:
+            signatures = np.concatenate([blocks[None, :], blocks[nodeObservationTransitions]], axis=0)
+            newBlocks = np.unique(signatures.T, axis=0, return_inverse=True)[1].ravel()
+            if newBlocks.max() == blocks.max():
+                break
+            blocks = newBlocks
+        # Quotient controller, one node per block
+        representatives = np.unique(blocks, return_index=True)[1]
+        actionTransitions = actionTransitions[representatives]
+        nodeObservationTransitions = blocks[nodeObservationTransitions[:, representatives]].astype(nodeObservationTransitions.dtype)
+        startNode = blocks[0]
+
+    # Breadth-first walk from the start node
+    newIndices = np.full(actionTransitions.shape[0], -1, dtype=np.int64)
+    newIndices[startNode] = 0
+    visitOrder = [startNode]
+    for node in visitOrder:
+        for obs in range(numObs):
+            nextNode = nodeObservationTransitions[obs, node]
+            if newIndices[nextNode] == -1:
+                newIndices[nextNode] = len(visitOrder)
+                visitOrder.append(nextNode)
+    visitOrder = np.array(visitOrder)
+    return actionTransitions[visitOrder], newIndices[nodeObservationTransitions[:, visitOrder]].astype(nodeObservationTransitions.dtype)
+
 class DeterministicFiniteStateController(object):
     def __init__(self, actionTransitions, nodeObservationTransitions):
         self.actionTransitions = actionTransitions
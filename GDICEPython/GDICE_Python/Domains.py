@@ -1,8 +1,11 @@
 from gym_pomdps import POMDP
+from gym_dpomdps import DPOMDP, MultiDPOMDP, buildCumulativeCSR, sampleFromCumulativeCSR
 import gym
 from gym import spaces
 from gym.utils import seeding
 import numpy as np
+from scipy.sparse import csr_matrix
+from .RandomStreams import RandomStreams
 
 # States, observations, rewards, actions, dones are now lists or np arrays
 class MultiPOMDP(gym.Wrapper):
@@ -13,6 +16,9 @@ class MultiPOMDP(gym.Wrapper):
         self.reset()
 
     def __getattr__(self, attr):
+        # env is not set yet while unpickling (e.g. in pool workers)
+        if attr == 'env':
+            raise AttributeError(attr)
         return getattr(self.env, attr)
 
     def reset(self):
@@ -63,6 +69,279 @@ class MultiPOMDP(gym.Wrapper):
         return obs, rewards, done, {}
 
 
+# Build a normalized cumulative distribution over the last axis of a probability table
+# Rows that sum to 0 (unreachable) are left as all zeros, since they are never sampled from
+# Inputs:
+#   pTable: (..., n) nparray of (possibly unnormalized) probabilities
+# Outputs:
+#   cumTable: (..., n) nparray of cumulative probabilities, last column is 1 for every valid row
+def buildCumulativeTable(pTable):
+    cumTable = np.cumsum(pTable, axis=-1, dtype=np.float64)
+    totals = cumTable[..., -1:]
+    return np.divide(cumTable, totals, out=np.zeros_like(cumTable), where=totals > 0)
+
+# Draw one index per row of a cumulative table by inverse-CDF lookup
+# Inputs:
+#   cumRows: (n, k) nparray of cumulative probabilities (one row for each draw)
+#   uniforms: (n,) nparray of uniform [0, 1) draws
+# Outputs:
+#   indices: (n,) int32 nparray of sampled indices
+def sampleFromCumulativeRows(cumRows, uniforms):
+    indices = (cumRows <= uniforms[:, None]).sum(axis=1, dtype=np.int32)
+    return np.minimum(indices, cumRows.shape[-1] - 1)  # Guard against rounding in the last column
+
+# Convert a loaded POMDP's or DPOMDP's T, O and R to the CSR layout of a sparse DPOMDP (see gym_dpomdps.DPOMDP), in place
+# This is the fallback for models whose dense tables load but whose cumulative tables, expected rewards and evaluation
+# do not fit in memory next to them: the dense tables are freed, and everything derived from the model is then sparse.
+# It cannot help a model that does not load, since the .pomdp parser builds dense tables (DPOMDPs can be loaded with
+# sparse=True instead). A converted POMDP can then only be stepped by VectorizedMultiPOMDP
+# Requires observations that do not depend on the start state, as in the .pomdp and .dpomdp file formats
+def sparsifyPOMDP(env):
+    nStates = env.state_space.n
+    if hasattr(env, 'agents'):  # DPOMDP, over joint actions and observations
+        nActions, nObs = env.nJointActions, env.nJointObs
+    else:
+        nActions, nObs = env.action_space.n, env.observation_space.n
+    O = env.O.reshape(nStates, nActions * nStates, nObs)
+    assert all(np.array_equal(O[s], O[0]) for s in range(1, nStates)), 'Observations depend on the start state'
+    env.T = csr_matrix(env.T.reshape(nStates * nActions, nStates))
+    env.O = csr_matrix(O[0])
+    env.R = csr_matrix(env.R.reshape(nStates * nActions, nStates * nObs))
+    env.sparse = True
+    env.nJointActions, env.nJointObs = nActions, nObs
+    env.cumT = None  # Drop cumulative tables built from the dense model
+    env.expectedRewards = None
+    env.mdpBaseline = None
+    env.fingerprint = None
+    return env
+
+# Get the cumulative start, transition and observation tables of an environment
+# Computed once and cached on the environment, so every wrapper built from it can reuse them
+# For DPOMDPs, agent actions and observations are flattened into joint indices
+# Outputs:
+#   cumStart: (nStates,) cumulative start distribution
+#   cumT: (nStates, nJointActions, nStates) cumulative transition table (buildCumulativeCSR form if sparse)
+#   cumO: (nStates, nJointActions, nStates, nJointObs) cumulative observation table (buildCumulativeCSR form if sparse)
+def getCumulativeTables(env):
+    nStates = env.state_space.n
+    if getattr(env, 'cumStart', None) is None:
+        env.cumStart = buildCumulativeTable(env.start if env.start is not None else np.ones(nStates))
+    if getattr(env, 'cumT', None) is None:  # Sparse tables may already be built by MultiDPOMDP
+        if getattr(env, 'sparse', False):
+            env.cumT = buildCumulativeCSR(env.T)
+            env.cumO = buildCumulativeCSR(env.O)
+        else:
+            env.cumT = buildCumulativeTable(env.T.reshape(nStates, -1, nStates))
+            env.cumO = buildCumulativeTable(env.O.reshape(nStates, env.cumT.shape[1], nStates, -1))
+    return env.cumStart, env.cumT, env.cumO
+
+# Expected immediate reward of every (state, action) pair, E[R | s, a] = sum_{s', o} T[s, a, s'] O[s, a, s', o] R[s, a, s', o]
+# Actions of DPOMDPs are joint actions (agent actions flattened with ravel_multi_index). Sparse models are
+# summed over the nonzero rewards only. Computed once per environment and cached on it
+# Output:
+#   expectedRewards: (nStates, nActions) nparray for POMDPs, (nStates, nJointActions) nparray for DPOMDPs
+def getExpectedRewards(env):
+    if getattr(env, 'expectedRewards', None) is None:
+        nStates = env.state_space.n
+        if getattr(env, 'sparse', False):
+            R = env.R.tocoo()
+            newStates, jointObs = np.divmod(R.col, env.nJointObs)
+            jointActions = R.row % env.nJointActions
+            weights = np.asarray(env.T[R.row, newStates]).ravel() * \
+                      np.asarray(env.O[jointActions * nStates + newStates, jointObs]).ravel() * R.data
+            env.expectedRewards = np.bincount(R.row, weights=weights, minlength=nStates * env.nJointActions).reshape(nStates, env.nJointActions)
+        else:
+            T = env.T.reshape(nStates, -1, nStates)
+            O = env.O.reshape(nStates, T.shape[1], nStates, -1)
+            env.expectedRewards = np.einsum('ijk,ijkl,ijkl->ij', T, O, env.R.reshape(O.shape))
+    return env.expectedRewards
+
+# Baseline for control-variate evaluation: state values of the underlying MDP, by value iteration on T and the expected rewards
+# Any baseline keeps estimates unbiased, its quality only affects how much variance is removed. Undiscounted models
+# stop after maxIterations sweeps. Computed once per environment and cached on it
+# Inputs:
+#   env: POMDP or DPOMDP (dense or sparse)
+#   tolerance: Stop value iteration once no value changes by more than this
+#   maxIterations: Maximum number of value iteration sweeps
+# Outputs:
+#   stateValues: (nStates,) nparray of MDP state values V(s)
+#   expectedNextValues: (nStates, n(Joint)Actions) nparray of E[V(s') | s, a], 0 for transitions that end the episode
+#   expectedStartValue: E[V(s0)] under the start distribution
+#   notDone: (nStates, n(Joint)Actions) nparray, 0 for transitions that end the episode and 1 otherwise
+def getMDPBaseline(env, tolerance=1e-6, maxIterations=1000):
+    if getattr(env, 'mdpBaseline', None) is None:
+        nStates = env.state_space.n
+        expectedRewards = getExpectedRewards(env)
+        T = env.T if getattr(env, 'sparse', False) else env.T.reshape(nStates * expectedRewards.shape[1], nStates)
+        notDone = 1 - np.asarray(env.D, dtype=np.float64).reshape(expectedRewards.shape) if env.episodic else np.ones(expectedRewards.shape)
+        gamma = env.discount if env.discount is not None else 1
+        stateValues = np.zeros(nStates, dtype=np.float64)
+        for _ in range(maxIterations):
+            newStateValues = (expectedRewards + gamma * notDone * (T @ stateValues).reshape(expectedRewards.shape)).max(axis=1)
+            converged = np.abs(newStateValues - stateValues).max() <= tolerance
+            stateValues = newStateValues
+            if converged:
+                break
+        start = env.start if env.start is not None else np.ones(nStates)
+        env.mdpBaseline = stateValues, notDone * (T @ stateValues).reshape(expectedRewards.shape), \
+                          np.dot(start, stateValues) / np.sum(start), notDone
+    return env.mdpBaseline
+
+# Sample successor states, joint observations and rewards of a batch of (state, joint action) pairs by inverse-CDF
+# Inputs:
+#   env: Environment the cumulative tables were built from (dense or sparse)
+#   cumT, cumO: Cumulative tables from getCumulativeTables
+#   states: (n,) int nparray of current states
+#   jointActions: (n,) int nparray of (joint) actions
+#   uniforms: (2, n) nparray of uniform [0, 1) draws
+# Outputs:
+#   newStates: (n,) int32 nparray of successor states
+#   jointObs: (n,) int32 nparray of (joint) observations
+#   rewards: (n,) nparray of rewards
+def sampleTransitions(env, cumT, cumO, states, jointActions, uniforms):
+    nStates = env.state_space.n
+    if getattr(env, 'sparse', False):
+        rows = states * env.nJointActions + jointActions
+        newStates = sampleFromCumulativeCSR(cumT, rows, uniforms[0])
+        jointObs = sampleFromCumulativeCSR(cumO, jointActions * nStates + newStates, uniforms[1])
+        rewards = np.asarray(env.R[rows, newStates * env.nJointObs + jointObs]).ravel()
+    else:
+        newStates = sampleFromCumulativeRows(cumT[states, jointActions], uniforms[0])
+        jointObs = sampleFromCumulativeRows(cumO[states, jointActions, newStates], uniforms[1])
+        rewards = env.R.reshape(cumO.shape)[states, jointActions, newStates, jointObs]
+    return newStates, jointObs, rewards
+
+
+# MultiPOMDP that steps all trajectories at once
+# Successor states and observations are drawn by inverse-CDF lookup in cumulative T and O tables
+# (built once per environment), using a single bulk uniform draw per step instead of a multinomial per trajectory
+# Also steps POMDPs converted by sparsifyPOMDP, drawing directly from the CSR tables
+# If numStreams is given, trajectory k shares its random stream with every trajectory k + i*numStreams
+# (common random numbers across blocks of trajectories, e.g. across samples in batched evaluation)
+# streams is an optional RandomStreams provider (stratified, quasi-Monte Carlo or antithetic draws). Defaults to plain uniforms
+# As in MultiPOMDP, trajectories of episodic models report done at the end of an episode but keep stepping, so both
+# wrappers give the same statistics. If endEpisodes is True, trajectories that reach the end of an episode are instead
+# marked with state -1, and return -1 obs and 0 reward after (stopping at the episode end, as POMDP.step does)
+class VectorizedMultiPOMDP(MultiPOMDP):
+    def __init__(self, env, numTrajectories, numStreams=None, streams=None, endEpisodes=False):
+        assert isinstance(env, POMDP)
+        self.numStreams = numTrajectories if numStreams is None else numStreams
+        self.streams = RandomStreams() if streams is None else streams
+        self.endEpisodes = endEpisodes
+        assert numTrajectories % self.numStreams == 0
+        self.cumStart, self.cumT, self.cumO = getCumulativeTables(env)
+        super().__init__(env, numTrajectories)
+
+    # All randomness of the wrapper is drawn here, from the stream provider: numDraws uniforms for every trajectory, (numDraws, nTrajectories)
+    # Trajectory k reads stream k % numStreams, so the same number of draws is consumed whatever the actions are
+    def drawUniforms(self, numDraws):
+        u = self.streams.draw(self.np_random, numDraws, self.numStreams)
+        return np.tile(u, (1, self.nTrajectories // self.numStreams))
+
+    def reset(self):
+        u = self.drawUniforms(1)[0]
+        self.state = sampleFromCumulativeRows(np.broadcast_to(self.cumStart, (self.nTrajectories, self.cumStart.shape[0])), u)
+
+    # Step given an nparray of actions
+    # Input:
+    #   actions: nparray, apply to all states
+    # Output:
+    #   obs: nparray of observation indices for each trajectory. -1 for completed trajectories
+    #   rewards: nparray of rewards for each trajectory
+    #   done: nparray of whether a particular trajectory is done
+    def step(self, actions):
+        assert actions.shape[0] == self.nTrajectories
+        notDoneIndices = np.nonzero(self.state != -1)[0]
+
+        # Blank init. Invalid states/obs, 0 reward, all done
+        newStates = np.full(self.nTrajectories, -1, dtype=np.int32)
+        obs = np.full(self.nTrajectories, -1, dtype=np.int32)
+        rewards = np.zeros(self.nTrajectories, dtype=np.float64)
+        done = np.ones(self.nTrajectories, dtype=bool)
+
+        validStates = self.state[notDoneIndices]
+        validActions = actions[notDoneIndices]
+        u = self.drawUniforms(2)[:, notDoneIndices]
+        validNewStates, validObs, validRewards = sampleTransitions(self.env, self.cumT, self.cumO, validStates, validActions, u)
+        if self.env.episodic:
+            validDone = np.asarray(self.env.D[validStates, validActions], dtype=bool)
+        else:
+            validDone = np.zeros(notDoneIndices.shape[0], dtype=bool)
+
+        newStates[notDoneIndices] = np.where(validDone, -1, validNewStates) if self.endEpisodes else validNewStates
+        obs[notDoneIndices] = validObs
+        rewards[notDoneIndices] = validRewards
+        done[notDoneIndices] = validDone
+        self.state = newStates
+
+        return obs, rewards, done, {}
+
+
+# MultiDPOMDP that steps all trajectories at once, for any number of agents
+# Joint actions and joint observations are flattened to single indices so that successor states and joint
+# observations are drawn by inverse-CDF lookup from one bulk uniform draw per step, then unraveled per agent
+# Also steps sparse DPOMDPs, drawing directly from the CSR tables
+# numStreams, streams and endEpisodes control the random streams and episode ends, as in VectorizedMultiPOMDP
+# (by default trajectories keep stepping past the end of an episode, as in MultiDPOMDP)
+class VectorizedMultiDPOMDP(MultiDPOMDP):
+    def __init__(self, env, nTrajectories, numStreams=None, streams=None, endEpisodes=False):
+        assert isinstance(env, DPOMDP)
+        self.numStreams = nTrajectories if numStreams is None else numStreams
+        self.streams = RandomStreams() if streams is None else streams
+        self.endEpisodes = endEpisodes
+        assert nTrajectories % self.numStreams == 0
+        self.cumStart, self.cumT, self.cumO = getCumulativeTables(env)
+        self.actionShape = tuple(aSpace.n for aSpace in env.action_space)
+        self.obsShape = tuple(oSpace.n for oSpace in env.observation_space)
+        super().__init__(env, nTrajectories)
+
+    # All randomness of the wrapper is drawn here, from the stream provider: numDraws uniforms for every trajectory, (numDraws, nTrajectories)
+    # Trajectory k reads stream k % numStreams, so the same number of draws is consumed whatever the actions are
+    def drawUniforms(self, numDraws):
+        u = self.streams.draw(self.np_random, numDraws, self.numStreams)
+        return np.tile(u, (1, self.nTrajectories // self.numStreams))
+
+    def reset(self):
+        u = self.drawUniforms(1)[0]
+        self.state = sampleFromCumulativeRows(np.broadcast_to(self.cumStart, (self.nTrajectories, self.cumStart.shape[0])), u)
+
+    # Step given an nparray of actions
+    # Input:
+    #   actions: (nTrajectories, nAgents) nparray of action indices. Each row represents a joint action
+    # Output:
+    #   obs: (nTrajectories, nAgents) nparray of observation indices. -1 for completed trajectories
+    #   rewards: (nTrajectories) nparray of rewards
+    #   done: (nTrajectories) nparray of whether a particular trajectory is done
+    def step(self, actions):
+        assert actions.shape[0] == self.nTrajectories
+        assert actions.shape[1] == self.nAgents
+        notDoneIndices = np.nonzero(self.state != -1)[0]
+
+        # Blank init. Invalid states/obs, 0 reward, all done
+        newStates = np.full(self.nTrajectories, -1, dtype=np.int32)
+        obs = np.full((self.nTrajectories, self.nAgents), -1, dtype=np.int32)
+        rewards = np.zeros(self.nTrajectories, dtype=np.float64)
+        done = np.ones(self.nTrajectories, dtype=bool)
+
+        validStates = self.state[notDoneIndices]
+        validActionIndices = tuple(actions[notDoneIndices, :].T)
+        validJointActions = np.ravel_multi_index(validActionIndices, self.actionShape)
+        u = self.drawUniforms(2)[:, notDoneIndices]
+        validNewStates, validJointObs, validRewards = sampleTransitions(self.env, self.cumT, self.cumO, validStates, validJointActions, u)
+        if self.env.episodic:
+            validDone = np.asarray(self.env.D[(validStates,) + validActionIndices], dtype=bool)
+        else:
+            validDone = np.zeros(notDoneIndices.shape[0], dtype=bool)
+
+        newStates[notDoneIndices] = np.where(validDone, -1, validNewStates) if self.endEpisodes else validNewStates
+        obs[notDoneIndices, :] = np.stack(np.unravel_index(validJointObs, self.obsShape), axis=1)
+        rewards[notDoneIndices] = validRewards
+        done[notDoneIndices] = validDone
+        self.state = newStates
+
+        return obs, rewards, done, {}
+
+
 class PackageDeliveryEnvironment(gym.Env):
     # Map: Base1 (B1), Base2 (B2), Rendezvous (R), Delivery1 (D1), Delivery2 (D2)
     # 0  0 D2 0
@@ -1,6 +1,76 @@
 import numpy as np
+from scipy.sparse import coo_matrix, identity, block_diag
+from scipy.sparse.linalg import spsolve
 
 
+# Shortest horizon after which the discounted tail of any rollout is negligible
+# Rewards after step H contribute at most gamma^H * max|R| / (1 - gamma), so H is the smallest value making this <= tolerance
+# Reward bounds come from env.reward_range, or from the reward table if the range is unbounded
+# The horizon is at least 1, so a tolerance above the largest possible return still ranks controllers by their first reward
+# Inputs:
+#   env: Environment with a discount and reward range (or reward table R)
+#   tolerance: Largest discounted tail that may be dropped
+#  Output:
+#    horizon: Number of timesteps to evaluate, or None if no finite horizon is guaranteed (undiscounted or unbounded rewards)
+def getEpsilonHorizon(env, tolerance):
+    assert tolerance > 0
+    gamma = env.discount if env.discount is not None else 1
+    if gamma >= 1:
+        return None
+    maxAbsReward = max(abs(r) for r in env.reward_range)
+    if not np.isfinite(maxAbsReward):
+        if not hasattr(env, 'R'):
+            return None
+        maxAbsReward = abs(env.R).max()
+    if maxAbsReward == 0:
+        return 1
+    return max(int(np.ceil(np.log(tolerance * (1 - gamma) / maxAbsReward) / np.log(gamma))), 1)
+
+# Pool the statistics of two sets of simulations of the same controller(s). Works elementwise on arrays (see RunningStatistics)
+# Inputs:
+#   numSimulations1, values1, stdDevs1: Number of simulations, mean returns and standard deviations of returns of the first set
+#   numSimulations2, values2, stdDevs2: The same for the second set
+#  Output:
+#    numSimulations, values, stdDevs: Statistics of the two sets taken together
+def poolStatistics(numSimulations1, values1, stdDevs1, numSimulations2, values2, stdDevs2):
+    statistics = RunningStatistics(np.broadcast(numSimulations1, values1, stdDevs1, numSimulations2, values2, stdDevs2).shape)
+    statistics.add(numSimulations1, values1, stdDevs1)
+    statistics.add(numSimulations2, values2, stdDevs2)
+    return statistics.numSimulations[()], statistics.values[()], statistics.stdDevs[()]
+
+# Mergeable running mean and variance of the returns of one or more controllers (Chan et al. pairwise update)
+# Batches of simulations are added by their summary statistics, in any order and from any process, so results can be
+# accumulated chunk by chunk or gathered from pool workers without keeping the individual returns
+# Inputs:
+#   shape: Shape of the statistics, e.g. (numSamples,) for one entry per sampled controller
+class RunningStatistics(object):
+    def __init__(self, shape=()):
+        self.numSimulations = np.zeros(shape, dtype=np.int64)
+        self.values = np.zeros(shape, dtype=np.float64)
+        self.sumSquaredDeviations = np.zeros(shape, dtype=np.float64)
+
+    # Standard deviations of the returns added so far (0 for entries with no simulations)
+    @property
+    def stdDevs(self):
+        return np.sqrt(self.sumSquaredDeviations / np.maximum(self.numSimulations, 1))
+
+    # Add a batch of simulations to the entries at index
+    # Inputs:
+    #   numSimulations, values, stdDevs: Number of simulations, mean returns and standard deviations of returns of the batch
+    #   index: Entries the batch belongs to. Must not repeat an entry
+    def add(self, numSimulations, values, stdDevs, index=Ellipsis):
+        n1 = self.numSimulations[index]
+        total = n1 + numSimulations
+        delta = values - self.values[index]
+        self.sumSquaredDeviations[index] += np.asarray(stdDevs) ** 2 * numSimulations + \
+                                            delta ** 2 * n1 * numSimulations / np.maximum(total, 1)
+        self.values[index] += delta * numSimulations / np.maximum(total, 1)
+        self.numSimulations[index] = total
+
+    # Merge the statistics of another RunningStatistics of the same shape into these
+    def merge(self, other):
+        self.add(other.numSimulations, other.values, other.stdDevs)
+
 # Evaluate a single sample, starting from first node
 # Inputs:
 #   env: Environment in which to evaluate
@@ -61,24 +131,34 @@ def evaluateSampleDPOMDP(env, timeHorizon, actionTransitions, nodeObservationTra
 #   timeHorizon: Time horizon over which to evaluate
 #   actionTransitions: (numNodes,) int array of chosen actions for each node
 #   nodeObservationTransitions: (numObs, numNodes) int array of chosen node transitions for obs
+#   expectedRewards: If given (see getExpectedRewards), accumulate the expected rewards of the visited (state, action)
+#                    pairs instead of the sampled rewards. Unbiased, with the variance of sampling s' and o integrated out
+#   baseline: If given (see getMDPBaseline), use the zero-mean baseline martingale
+#             V(s0) - E[V(s0)] + sum_t gamma^(t+1) c_t (V(s_t+1) - E[V(s_t+1) | s_t, a_t]) as a control variate, where c_t
+#             is 0 if (s_t, a_t) ends the episode and 1 otherwise. It is subtracted from the returns with the
+#             variance-minimizing coefficient, cross-fitted over two folds of the rollouts
 #  Output:
 #    value: Discounted total return over timeHorizon (or until episode is done), averaged over all simulations
 #    stdDev: Standard deviation of discounter total returns over all simulations
-def evaluateSampleMultiPOMDP(env, timeHorizon, actionTransitions, nodeObservationTransitions):
+def evaluateSampleMultiPOMDP(env, timeHorizon, actionTransitions, nodeObservationTransitions, expectedRewards=None, baseline=None):
     numTrajectories = env.nTrajectories
     gamma = env.discount if env.discount is not None else 1
     env.reset()
     currentNodes = np.zeros(numTrajectories, dtype=np.int32)
     currentTimestep = 0
     values = np.zeros(numTrajectories, dtype=np.float64)
+    martingale = None if baseline is None else _getStartMartingale(env, baseline)
     isDones = np.zeros(numTrajectories, dtype=bool)
     while not all(isDones) and currentTimestep < timeHorizon:
-        obs, rewards, isDones = env.step(actionTransitions[currentNodes])[:3]
+        actions = actionTransitions[currentNodes]
+        obs, rewards, isDones, martingaleSteps = _stepWithEstimator(env, actions, actions, gamma, expectedRewards, baseline)
         currentNodes = nodeObservationTransitions[obs, currentNodes]
         values += rewards * (gamma ** currentTimestep)
+        if baseline is not None:
+            martingale += martingaleSteps * (gamma ** currentTimestep)
         currentTimestep += 1
 
-    return values.mean(axis=0), values.std(axis=0)
+    return _summarizeReturns(values, martingale, axis=0)
 
 # Evaluate multiple trajectories for a sample, starting from first node
 # Inputs:
@@ -86,10 +166,12 @@ def evaluateSampleMultiPOMDP(env, timeHorizon, actionTransitions, nodeObservatio
 #   timeHorizon: Time horizon over which to evaluate
 #   actionTransitions: (numNodes, numAgents) int array of chosen actions for each node
 #   nodeObservationTransitions: (numObs, numNodes, numAgents) int array of chosen node transitions for obs
+#   expectedRewards: If given (see getExpectedRewards), accumulate expected rewards of the visited (state, joint action) pairs
+#   baseline: If given (see getMDPBaseline), subtract the baseline martingale from the returns (control variate)
 #  Output:
 #    value: Discounted total return over timeHorizon (or until episode is done), averaged over all simulations
 #    stdDev: Standard deviation of discounter total returns over all simulations
-def evaluateSampleMultiDPOMDP(env, timeHorizon, actionTransitions, nodeObservationTransitions):
+def evaluateSampleMultiDPOMDP(env, timeHorizon, actionTransitions, nodeObservationTransitions, expectedRewards=None, baseline=None):
     nTrajectories = env.nTrajectories
     nAgents = env.agents
     agentIndices = tuple(np.full(nTrajectories, a, dtype=np.int32) for a in range(nAgents))
@@ -98,14 +180,685 @@ def evaluateSampleMultiDPOMDP(env, timeHorizon, actionTransitions, nodeObservati
     currentNodes = tuple(np.zeros(nTrajectories, dtype=np.int32) for _ in range(nAgents))
     currentTimestep = 0
     values = np.zeros(nTrajectories, dtype=np.float64)
+    martingale = None if baseline is None else _getStartMartingale(env, baseline)
     isDones = np.zeros(nTrajectories, dtype=bool)
     while not all(isDones) and currentTimestep < timeHorizon:
-        obs, rewards, isDones = env.step(actionTransitions[currentNodes, agentIndices].T)[:3]
+        actions = actionTransitions[currentNodes, agentIndices].T
+        jointActions = None if expectedRewards is None and baseline is None else np.ravel_multi_index(tuple(actions.T), env.actionShape)
+        obs, rewards, isDones, martingaleSteps = _stepWithEstimator(env, actions, jointActions, gamma, expectedRewards, baseline)
         currentNodes = nodeObservationTransitions[tuple(obs[:, i] for i in range(nAgents)), currentNodes, agentIndices]
         values += rewards * (gamma ** currentTimestep)
+        if baseline is not None:
+            martingale += martingaleSteps * (gamma ** currentTimestep)
+        currentTimestep += 1
+
+    return _summarizeReturns(values, martingale, axis=0)
+
+# Evaluate all sampled controllers of an iteration together, each starting from first node
+# Every timestep advances all (numSamples x numSimulations) rollouts at once
+# Inputs:
+#   env: MultiPOMDP environment with numSamples*numSimulations trajectories. Trajectories are sample-major
+#   timeHorizon: Time horizon over which to evaluate
+#   sampledActions: (numNodes, numSamples) int array of chosen actions for each node of each sample
+#   sampledNodes: (numObs, numNodes, numSamples) int array of chosen node transitions for obs of each sample
+#   expectedRewards: If given (see getExpectedRewards), accumulate expected rewards instead of sampled rewards
+#   baseline: If given (see getMDPBaseline), subtract the baseline martingale from the returns (control variate)
+#  Output:
+#    values: (numSamples,) discounted total returns over timeHorizon (or until episode is done), averaged over all simulations
+#    stdDevs: (numSamples,) standard deviations of discounted total returns over all simulations
+def evaluateSamplesMultiPOMDP(env, timeHorizon, sampledActions, sampledNodes, expectedRewards=None, baseline=None):
+    numSamples = sampledActions.shape[-1]
+    numSimulations = env.nTrajectories // numSamples
+    assert numSamples * numSimulations == env.nTrajectories
+    gamma = env.discount if env.discount is not None else 1
+    env.reset()
+    sampleIndices = np.repeat(np.arange(numSamples, dtype=np.int32)[:, None], numSimulations, axis=1)
+    currentNodes = np.zeros((numSamples, numSimulations), dtype=np.int32)
+    currentTimestep = 0
+    values = np.zeros((numSamples, numSimulations), dtype=np.float64)
+    martingale = None if baseline is None else _getStartMartingale(env, baseline).reshape(values.shape)
+    isDones = np.zeros(env.nTrajectories, dtype=bool)
+    while not all(isDones) and currentTimestep < timeHorizon:
+        actions = sampledActions[currentNodes, sampleIndices].ravel()
+        obs, rewards, isDones, martingaleSteps = _stepWithEstimator(env, actions, actions, gamma, expectedRewards, baseline)
+        currentNodes = sampledNodes[obs.reshape(numSamples, numSimulations), currentNodes, sampleIndices]
+        values += rewards.reshape(numSamples, numSimulations) * (gamma ** currentTimestep)
+        if baseline is not None:
+            martingale += martingaleSteps.reshape(numSamples, numSimulations) * (gamma ** currentTimestep)
+        currentTimestep += 1
+
+    return _summarizeReturns(values, martingale, axis=1)
+
+# Evaluate all sampled joint controllers of an iteration together, each agent starting from first node
+# Every timestep advances all (numSamples x numSimulations x numAgents) controller nodes at once
+# Inputs:
+#   env: MultiDPOMDP environment with numSamples*numSimulations trajectories. Trajectories are sample-major
+#   timeHorizon: Time horizon over which to evaluate
+#   sampledActions: (numNodes, numSamples, numAgents) int array of chosen actions for each node of each sample
+#   sampledNodes: (numObs, numNodes, numSamples, numAgents) int array of chosen node transitions for obs of each sample
+#   expectedRewards: If given (see getExpectedRewards), accumulate expected rewards instead of sampled rewards
+#   baseline: If given (see getMDPBaseline), subtract the baseline martingale from the returns (control variate)
+#  Output:
+#    values: (numSamples,) discounted total returns over timeHorizon (or until episode is done), averaged over all simulations
+#    stdDevs: (numSamples,) standard deviations of discounted total returns over all simulations
+def evaluateSamplesMultiDPOMDP(env, timeHorizon, sampledActions, sampledNodes, expectedRewards=None, baseline=None):
+    numSamples = sampledActions.shape[1]
+    numSimulations = env.nTrajectories // numSamples
+    assert numSamples * numSimulations == env.nTrajectories
+    nAgents = env.agents
+    trajShape = (numSamples, numSimulations, nAgents)
+    sampleIndices = np.arange(numSamples, dtype=np.int32)[:, None, None]
+    agentIndices = np.arange(nAgents, dtype=np.int32)[None, None, :]
+    gamma = env.discount if env.discount is not None else 1
+    env.reset()
+    currentNodes = np.zeros(trajShape, dtype=np.int32)
+    currentTimestep = 0
+    values = np.zeros((numSamples, numSimulations), dtype=np.float64)
+    martingale = None if baseline is None else _getStartMartingale(env, baseline).reshape(values.shape)
+    isDones = np.zeros(env.nTrajectories, dtype=bool)
+    while not all(isDones) and currentTimestep < timeHorizon:
+        actions = sampledActions[currentNodes, sampleIndices, agentIndices].reshape(-1, nAgents)
+        jointActions = None if expectedRewards is None and baseline is None else np.ravel_multi_index(tuple(actions.T), env.actionShape)
+        obs, rewards, isDones, martingaleSteps = _stepWithEstimator(env, actions, jointActions, gamma, expectedRewards, baseline)
+        currentNodes = sampledNodes[obs.reshape(trajShape), currentNodes, sampleIndices, agentIndices]
+        values += rewards.reshape(numSamples, numSimulations) * (gamma ** currentTimestep)
+        if baseline is not None:
+            martingale += martingaleSteps.reshape(numSamples, numSimulations) * (gamma ** currentTimestep)
         currentTimestep += 1
 
-    return values.mean(axis=0), values.std(axis=0)
+    return _summarizeReturns(values, martingale, axis=1)
+
+# Step all trajectories of a multi-trajectory wrapper, returning rewards under the chosen estimator
+# Finished trajectories (state -1) get 0 reward, as the wrappers give them
+# Episode ends in the martingale are taken from the model (see getMDPBaseline), not from the wrapper's states, so it
+# keeps zero mean with wrappers that step on past the end of an episode (MultiPOMDP, or endEpisodes=False)
+# Inputs:
+#   env: Multi-trajectory wrapper that tracks the states of its trajectories
+#   actions: Actions to step with, in the wrapper's format
+#   jointActions: (nTrajectories,) (joint) action indices. Only needed with expectedRewards or baseline
+#   gamma: Discount factor
+#   expectedRewards: If given, the sampled rewards are replaced by the expected rewards E[R | s, a] (see getExpectedRewards)
+#   baseline: If given, (stateValues, expectedNextValues, expectedStartValue) from getMDPBaseline
+#  Output:
+#    obs, rewards, dones of the step
+#    martingaleSteps: (nTrajectories,) gamma * c * (V(s') - E[V(s') | s, a]) of the step (0 for finished trajectories), or None without baseline
+def _stepWithEstimator(env, actions, jointActions, gamma, expectedRewards=None, baseline=None):
+    states = env.state
+    obs, rewards, isDones = env.step(actions)[:3]
+    if expectedRewards is not None:
+        rewards = np.where(states != -1, expectedRewards[states, jointActions], 0.0)
+    martingaleSteps = None
+    if baseline is not None:
+        stateValues, expectedNextValues, _, notDone = baseline
+        martingaleSteps = gamma * np.where(states != -1, notDone[states, jointActions] * stateValues[env.state] -
+                                                         expectedNextValues[states, jointActions], 0.0)
+    return obs, rewards, isDones, martingaleSteps
+
+# Start term of the baseline martingale, V(s0) - E[V(s0)], for every trajectory of a freshly reset wrapper
+def _getStartMartingale(env, baseline):
+    stateValues, _, expectedStartValue = baseline[:3]
+    return stateValues[env.state] - expectedStartValue
+
+# Mean and standard deviation of discounted returns along an axis of simulations
+# With a control variate (martingale not None), the martingale is subtracted with the coefficient Cov(G, M) / Var(M).
+# Estimating it from the same simulations it is applied to biases the mean by O(1/n), so it is cross-fitted: the
+# simulations are split into two folds, and each fold uses the coefficient estimated on the other. Folds take whole
+# pairs of simulations (2k, 2k+1), so antithetic partners stay in the same fold. With fewer than 8 simulations the
+# coefficients are too noisy to help and the plain returns are used
+def _summarizeReturns(values, martingale, axis):
+    numSimulations = values.shape[axis]
+    if martingale is None or numSimulations < 8:
+        return values.mean(axis=axis), values.std(axis=axis)
+    folds = ((np.arange(numSimulations) // 2) % 2).reshape([-1 if d == axis else 1 for d in range(values.ndim)])
+    coefficients = [np.expand_dims(_getControlVariateCoefficient(np.compress(folds.ravel() == fold, values, axis),
+                                                                 np.compress(folds.ravel() == fold, martingale, axis), axis), axis)
+                    for fold in (0, 1)]
+    adjustedValues = values - np.where(folds == 0, coefficients[1], coefficients[0]) * martingale
+    return adjustedValues.mean(axis=axis), adjustedValues.std(axis=axis)
+
+# Least-squares coefficient Cov(G, M) / Var(M) of the returns on the martingale along an axis of simulations
+# (0 where the martingale does not vary)
+def _getControlVariateCoefficient(values, martingale, axis):
+    centeredValues = values - values.mean(axis=axis, keepdims=True)
+    centeredMartingale = martingale - martingale.mean(axis=axis, keepdims=True)
+    martingaleVariance = (centeredMartingale ** 2).sum(axis=axis)
+    return (centeredValues * centeredMartingale).sum(axis=axis) / np.where(martingaleVariance > 0, martingaleVariance, 1)
+
+# Evaluate all sampled controllers of an iteration by racing them against each other
+# Every sample first gets a small batch of simulations. After each round, samples whose upper confidence bound is
+# below the numBestSamples-th best lower confidence bound cannot be in the elite set and are eliminated. The rest
+# of the budget (numSamples*numSimulationsPerSample simulations in total) goes to the remaining contenders,
+# doubling the batch size each round. The rollouts of each round are batched into one multi-trajectory wrapper
+# Inputs:
+#   env: Gym-like environment
+#   MultiEnvWrapper: Multi-trajectory wrapper class to run the rollouts with
+#   batchEvalFn: evaluateSamplesMultiPOMDP or evaluateSamplesMultiDPOMDP
+#   timeHorizon: Time horizon over which to evaluate
+#   sampledActions: (numNodes, numSamples[, numAgents]) int array of chosen actions for each node of each sample
+#   sampledNodes: (numObs, numNodes, numSamples[, numAgents]) int array of chosen node transitions for obs of each sample
+#   numSimulationsPerSample: Average number of simulations per sample. Sets the total budget
+#   numBestSamples: Size of the elite set that samples race for
+#   initialSimulations: Simulations given to every sample in the first round. Defaults to 1/8 of numSimulationsPerSample
+#   confidenceZ: Width of the confidence bounds, in standard errors
+#   commonRandomNumbers: If True, contenders share random streams in each round (vectorized wrappers only)
+#  Output:
+#    values: (numSamples,) discounted total returns, averaged over all simulations each sample received
+#    stdDevs: (numSamples,) standard deviations of discounted total returns over those simulations
+#    numSimulations: (numSamples,) int array of the number of simulations each sample received
+#    eliminated: (numSamples,) bool array, True for samples that were dropped from the race
+def evaluateSamplesRacing(env, MultiEnvWrapper, batchEvalFn, timeHorizon, sampledActions, sampledNodes, numSimulationsPerSample,
+                          numBestSamples, initialSimulations=None, confidenceZ=2.0, commonRandomNumbers=False):
+    numSamples = sampledActions.shape[1]
+    budget = numSamples * numSimulationsPerSample
+    if initialSimulations is None:
+        initialSimulations = max(numSimulationsPerSample // 8, 2)
+    numSimulations = np.zeros(numSamples, dtype=np.int64)
+    values = np.zeros(numSamples, dtype=np.float64)
+    stdDevs = np.zeros(numSamples, dtype=np.float64)
+    eliminated = np.zeros(numSamples, dtype=bool)
+    contenders = np.arange(numSamples)
+    batch = initialSimulations
+    while budget >= contenders.shape[0]:
+        batch = min(batch, budget // contenders.shape[0])
+        if commonRandomNumbers:
+            multiEnv = MultiEnvWrapper(env, contenders.shape[0] * batch, numStreams=batch)
+        else:
+            multiEnv = MultiEnvWrapper(env, contenders.shape[0] * batch)
+        batchValues, batchStdDevs = batchEvalFn(multiEnv, timeHorizon, sampledActions[:, contenders], sampledNodes[:, :, contenders])
+        budget -= contenders.shape[0] * batch
+
+        # Pool this round's statistics with the previous rounds'
+        numSimulations[contenders], values[contenders], stdDevs[contenders] = \
+            poolStatistics(numSimulations[contenders], values[contenders], stdDevs[contenders], batch, batchValues, batchStdDevs)
+
+        # Drop samples that are confidently out of the elite set
+        if contenders.shape[0] > numBestSamples:
+            halfWidths = confidenceZ * stdDevs[contenders] / np.sqrt(numSimulations[contenders])
+            eliteLowerBound = np.sort(values[contenders] - halfWidths)[-numBestSamples]
+            keep = values[contenders] + halfWidths >= eliteLowerBound
+            eliminated[contenders[~keep]] = True
+            contenders = contenders[keep]
+        batch *= 2
+
+    return values, stdDevs, numSimulations, eliminated
+
+# Evaluate all sampled controllers of an iteration with sequential stopping
+# Every sample first gets a small batch of simulations. Samples keep receiving more, doubling their count each round,
+# until the confidence interval of their mean value is at most confidenceWidth wide or they reach maxSimulationsPerSample.
+# Low-variance samples therefore stop early. The rollouts of each round are batched into one multi-trajectory wrapper
+# Inputs:
+#   env: Gym-like environment
+#   MultiEnvWrapper: Multi-trajectory wrapper class to run the rollouts with
+#   batchEvalFn: evaluateSamplesMultiPOMDP or evaluateSamplesMultiDPOMDP
+#   timeHorizon: Time horizon over which to evaluate
+#   sampledActions: (numNodes, numSamples[, numAgents]) int array of chosen actions for each node of each sample
+#   sampledNodes: (numObs, numNodes, numSamples[, numAgents]) int array of chosen node transitions for obs of each sample
+#   confidenceWidth: Full width of the confidence interval at which a sample stops
+#   maxSimulationsPerSample: Cap on the simulations of each sample
+#   initialSimulations: Simulations given to every sample in the first round. Defaults to 1/8 of maxSimulationsPerSample
+#   confidenceZ: Half width of the confidence interval, in standard errors
+#   commonRandomNumbers: If True, the samples still running share random streams in each round (vectorized wrappers only)
+#  Output:
+#    values: (numSamples,) discounted total returns, averaged over all simulations each sample received
+#    stdDevs: (numSamples,) standard deviations of discounted total returns over those simulations
+#    numSimulations: (numSamples,) int array of the number of simulations each sample received
+def evaluateSamplesSequential(env, MultiEnvWrapper, batchEvalFn, timeHorizon, sampledActions, sampledNodes, confidenceWidth,
+                              maxSimulationsPerSample, initialSimulations=None, confidenceZ=2.0, commonRandomNumbers=False):
+    numSamples = sampledActions.shape[1]
+    if initialSimulations is None:
+        initialSimulations = max(maxSimulationsPerSample // 8, 2)
+    numSimulations = np.zeros(numSamples, dtype=np.int64)
+    values = np.zeros(numSamples, dtype=np.float64)
+    stdDevs = np.zeros(numSamples, dtype=np.float64)
+    # Every running sample has received every round, so all of them have the same number of simulations
+    running = np.arange(numSamples)
+    batch = min(initialSimulations, maxSimulationsPerSample)
+    while running.shape[0] > 0 and batch > 0:
+        if commonRandomNumbers:
+            multiEnv = MultiEnvWrapper(env, running.shape[0] * batch, numStreams=batch)
+        else:
+            multiEnv = MultiEnvWrapper(env, running.shape[0] * batch)
+        batchValues, batchStdDevs = batchEvalFn(multiEnv, timeHorizon, sampledActions[:, running], sampledNodes[:, :, running])
+
+        # Pool this round's statistics with the previous rounds'
+        numSimulations[running], values[running], stdDevs[running] = \
+            poolStatistics(numSimulations[running], values[running], stdDevs[running], batch, batchValues, batchStdDevs)
+
+        # Stop samples whose interval is narrow enough
+        widths = 2 * confidenceZ * stdDevs[running] / np.sqrt(numSimulations[running])
+        running = running[widths > confidenceWidth]
+        if running.shape[0] > 0:
+            batch = min(numSimulations[running[0]], maxSimulationsPerSample - numSimulations[running[0]])
+
+    return values, stdDevs, numSimulations
+
+# Evaluate all sampled controllers of an iteration in bounded blocks of trajectories
+# The (numSamples x numSimulationsPerSample) rollouts are split into blocks of at most chunkSize trajectories (whole
+# samples and whole simulation chunks), evaluated one after another and merged with RunningStatistics, so peak memory
+# depends on chunkSize and not on the number of simulations
+# Inputs:
+#   env: Gym-like environment
+#   MultiEnvWrapper: Multi-trajectory wrapper class to run the rollouts with
+#   batchEvalFn: evaluateSamplesMultiPOMDP or evaluateSamplesMultiDPOMDP
+#   timeHorizon: Time horizon over which to evaluate
+#   sampledActions: (numNodes, numSamples[, numAgents]) int array of chosen actions for each node of each sample
+#   sampledNodes: (numObs, numNodes, numSamples[, numAgents]) int array of chosen node transitions for obs of each sample
+#   numSimulationsPerSample: Number of simulations of each sample
+#   chunkSize: Largest number of trajectories simulated at once (at least one simulation of one sample)
+#   commonRandomNumbers: If True, all samples share random streams in each simulation chunk (vectorized wrappers only)
+#  Output:
+#    values: (numSamples,) discounted total returns, averaged over all simulations
+#    stdDevs: (numSamples,) standard deviations of discounted total returns over all simulations
+def evaluateSamplesChunked(env, MultiEnvWrapper, batchEvalFn, timeHorizon, sampledActions, sampledNodes, numSimulationsPerSample,
+                           chunkSize, commonRandomNumbers=False):
+    numSamples = sampledActions.shape[1]
+    simulationsPerChunk = min(max(chunkSize // numSamples, 1), numSimulationsPerSample)
+    samplesPerChunk = min(max(chunkSize // simulationsPerChunk, 1), numSamples)
+    statistics = RunningStatistics(numSamples)
+    for firstSimulation in range(0, numSimulationsPerSample, simulationsPerChunk):
+        numSimulations = min(simulationsPerChunk, numSimulationsPerSample - firstSimulation)
+        # Blocks of samples in the same simulation chunk are reseeded alike to share random streams
+        seed = np.random.randint(2**31 - 1) if commonRandomNumbers and samplesPerChunk < numSamples else None
+        for firstSample in range(0, numSamples, samplesPerChunk):
+            samples = np.arange(firstSample, min(firstSample + samplesPerChunk, numSamples))
+            if commonRandomNumbers:
+                multiEnv = MultiEnvWrapper(env, samples.shape[0] * numSimulations, numStreams=numSimulations)
+            else:
+                multiEnv = MultiEnvWrapper(env, samples.shape[0] * numSimulations)
+            if seed is not None:
+                multiEnv.env.seed(seed)
+            values, stdDevs = batchEvalFn(multiEnv, timeHorizon, sampledActions[:, samples], sampledNodes[:, :, samples])
+            statistics.add(numSimulations, values, stdDevs, samples)
+    return statistics.values, statistics.stdDevs
+
+# Evaluate all sampled controllers of an iteration off-policy, from rollouts of the distribution they were sampled from
+# The rollouts follow the stochastic (mean) controller: each node draws its action, and each (node, observation) its
+# next node, from the distribution's probability tables. A deterministic sample's value is estimated by per-decision
+# importance weighting: the reward at step t is weighted by 1 / (behavior probability of the choices so far) if the
+# sample would have made the same action and node choices up to t, and by 0 otherwise. Samples whose effective sample
+# size (of the full-trajectory weights) is below minEffectiveSampleSize are simulated directly instead
+# Rollouts follow the wrapper's episode ends: with wrappers that keep stepping past the end of an episode (the default),
+# every later step is weighted too, as the sample would keep choosing there. Only wrappers with endEpisodes stop
+# weighting a rollout at the end of its episode. The fallback simulates with the same wrapper
+# The weights multiply over every decision, so the effective sample size shrinks geometrically with the horizon, by
+# about the probability the distribution gives a sample's choices at each step. This pays off for short horizons, or
+# once the distribution has concentrated on a few controllers. Otherwise most samples fall back to direct simulation,
+# and the numTrajectories behavior rollouts come on top of that
+# All choices are drawn from the environment's random generator, so seeding the environment makes runs reproducible
+# Inputs:
+#   env: Gym-like environment
+#   MultiEnvWrapper: Multi-trajectory wrapper class to run the rollouts with
+#   batchEvalFn: evaluateSamplesMultiPOMDP or evaluateSamplesMultiDPOMDP, for the fallback
+#   timeHorizon: Time horizon over which to evaluate
+#   sampledActions: (numNodes, numSamples[, numAgents]) int array of chosen actions for each node of each sample
+#   sampledNodes: (numObs, numNodes, numSamples[, numAgents]) int array of chosen node transitions for obs of each sample
+#   actionProbabilities: (numNodes, numActions[, numAgents]) action probabilities of the distribution(s) sampled from
+#   nodeTransitionProbabilities: (numNodes, numNodes, numObs[, numAgents]) node transition probabilities of the distribution(s)
+#   numTrajectories: Number of rollouts of the stochastic controller
+#   numSimulationsPerSample: Number of simulations of each sample that falls back to direct simulation
+#   minEffectiveSampleSize: Smallest effective sample size at which the importance-weighted estimate is used
+#   expectedRewards: If given (see getExpectedRewards), weight expected rewards instead of sampled rewards
+#  Output:
+#    values: (numSamples,) estimated discounted total returns
+#    stdDevs: (numSamples,) estimated standard deviations of discounted total returns (self-normalized for weighted samples)
+#    numSimulations: (numSamples,) int array of direct simulations spent on each sample (0 if importance-weighted)
+#    effectiveSampleSizes: (numSamples,) effective sample size of each sample's importance weights
+def evaluateSamplesOffPolicy(env, MultiEnvWrapper, batchEvalFn, timeHorizon, sampledActions, sampledNodes, actionProbabilities,
+                             nodeTransitionProbabilities, numTrajectories, numSimulationsPerSample, minEffectiveSampleSize, expectedRewards=None):
+    singleAgent = sampledActions.ndim == 2
+    agentActions, agentNodes = sampledActions, sampledNodes
+    if singleAgent:  # Treat as a single agent of a DPOMDP
+        agentActions, agentNodes = sampledActions[..., None], sampledNodes[..., None]
+        actionProbabilities, nodeTransitionProbabilities = actionProbabilities[..., None], nodeTransitionProbabilities[..., None]
+    numNodes, numSamples, nAgents = agentActions.shape
+    sampleIndices = np.arange(numSamples)[None, :, None]
+    agentIndices = np.arange(nAgents)[None, :]
+    cumActionProbabilities = np.cumsum(actionProbabilities, axis=1)
+    cumNodeTransitionProbabilities = np.cumsum(nodeTransitionProbabilities, axis=1)
+
+    multiEnv = MultiEnvWrapper(env, numTrajectories)
+    gamma = multiEnv.discount if multiEnv.discount is not None else 1
+    multiEnv.reset()
+    currentNodes = np.zeros((numTrajectories, nAgents), dtype=np.int64)
+    weights = np.ones((numTrajectories, numSamples), dtype=np.float64)
+    weightedValues = np.zeros((numTrajectories, numSamples), dtype=np.float64)
+    returns = np.zeros(numTrajectories, dtype=np.float64)
+    currentTimestep = 0
+    isDones = np.zeros(numTrajectories, dtype=bool)
+    endEpisodes = getattr(multiEnv, 'endEpisodes', False)
+    ended = np.zeros(numTrajectories, dtype=bool)
+    while not all(isDones) and currentTimestep < timeHorizon:
+        # Draw the behavior actions, and weight each sample by whether it chooses the same
+        running = ~ended
+        actionRows = cumActionProbabilities[currentNodes, :, agentIndices]
+        actions = _drawFromRows(env.np_random, actionProbabilities[currentNodes, :, agentIndices], actionRows)
+        matches = (agentActions[currentNodes[:, None, :], sampleIndices, agentIndices[None]] == actions[:, None, :]).all(-1)
+        weights[running] *= matches[running] / actionProbabilities[currentNodes, actions, agentIndices].prod(-1)[running, None]
+
+        stepActions = actions[:, 0] if singleAgent else actions
+        jointActions = stepActions if singleAgent or expectedRewards is None else np.ravel_multi_index(tuple(actions.T), multiEnv.actionShape)
+        obs, rewards, isDones = _stepWithEstimator(multiEnv, stepActions, jointActions, gamma, expectedRewards)[:3]
+        weightedValues += weights * (rewards * (gamma ** currentTimestep))[:, None]
+        returns += rewards * (gamma ** currentTimestep)
+
+        # Draw the behavior node transitions, and weight each sample by whether it makes the same
+        if endEpisodes:
+            ended |= isDones
+        running = ~ended
+        agentObs = obs.reshape(numTrajectories, nAgents)
+        nodeRows = cumNodeTransitionProbabilities[currentNodes, :, agentObs, agentIndices]
+        newNodes = _drawFromRows(env.np_random, nodeTransitionProbabilities[currentNodes, :, agentObs, agentIndices], nodeRows)
+        matches = (agentNodes[agentObs[:, None, :], currentNodes[:, None, :], sampleIndices, agentIndices[None]] == newNodes[:, None, :]).all(-1)
+        weights[running] *= matches[running] / nodeTransitionProbabilities[currentNodes, newNodes, agentObs, agentIndices].prod(-1)[running, None]
+        currentNodes = newNodes
+        currentTimestep += 1
+
+    # Per-decision estimates, with the spread of the returns the weighted rollouts saw
+    values = weightedValues.mean(axis=0)
+    totalWeights = weights.sum(axis=0)
+    effectiveSampleSizes = totalWeights ** 2 / np.maximum((weights ** 2).sum(axis=0), np.finfo(np.float64).tiny)
+    normalizedWeights = weights / np.maximum(totalWeights, np.finfo(np.float64).tiny)
+    weightedMeans = normalizedWeights.T @ returns
+    stdDevs = np.sqrt(np.maximum((normalizedWeights * (returns[:, None] - weightedMeans) ** 2).sum(axis=0), 0.0))
+
+    # Simulate the samples the rollouts say too little about
+    numSimulations = np.zeros(numSamples, dtype=np.int64)
+    fallback = np.where(effectiveSampleSizes < minEffectiveSampleSize)[0]
+    if fallback.shape[0] > 0:
+        multiEnv = MultiEnvWrapper(env, fallback.shape[0] * numSimulationsPerSample)
+        values[fallback], stdDevs[fallback] = batchEvalFn(multiEnv, timeHorizon, sampledActions[:, fallback], sampledNodes[:, :, fallback])
+        numSimulations[fallback] = numSimulationsPerSample
+    return values, stdDevs, numSimulations, effectiveSampleSizes
+
+# Draw one index from each row of probability tables by inverse-CDF (searching the cumulative row), never drawing an
+# index of probability 0 (rows that do not sum to exactly 1 are scaled by their total)
+# Inputs:
+#   np_random: Random generator to draw with
+#   rows: (..., n) nparray of probability rows
+#   cumRows: (..., n) cumulative sums of rows
+#  Output:
+#    indices: (...) int nparray of drawn indices
+def _drawFromRows(np_random, rows, cumRows):
+    uniforms = np_random.uniform(size=cumRows.shape[:-1] + (1,)) * cumRows[..., -1:]
+    indices = (uniforms >= cumRows).sum(-1)  # First index whose cumulative probability exceeds the draw
+    lastPositive = rows.shape[-1] - 1 - np.argmax(rows[..., ::-1] > 0, axis=-1)  # In case rounding put the draw past the end
+    return np.minimum(indices, lastPositive)
+
+# Build the Markov chain over (state, node) pairs that a deterministic controller induces on a tabular model
+# Row/column index of pair (s, n) is s*numNodes + n. Tables may be joint tables of a DPOMDP (flattened joint
+# actions and observations), in which case nodes are joint nodes
+# By default the chain keeps going past the end of an episode through T, as the default multi-trajectory wrappers
+# (MultiPOMDP, MultiDPOMDP and the vectorized wrappers without endEpisodes) keep stepping
+# Inputs:
+#   T: (nStates, nActions, nStates) transition table
+#   O: (nStates, nActions, nStates, nObs) observation table
+#   R: (nStates, nActions, nStates, nObs) reward table
+#   D: None if not episodic, else (nStates, nActions) bool array of whether a transition ends the episode
+#   nodeActions: (numNodes,) int array of the action taken at each node
+#   nextNodes: (nObs, numNodes) int array of the node transitioned to for each observation from each node
+#   endEpisodes: If True, leave out transitions that end the episode, as wrappers with endEpisodes do
+#  Output:
+#    P: Sparse (nStates*numNodes, nStates*numNodes) transition matrix
+#    PR: Sparse matrix like P, weighted by the reward received on each transition
+#    expectedRewards: (nStates*numNodes,) expected immediate reward of each pair
+#    expectedSquaredRewards: (nStates*numNodes,) expected squared immediate reward of each pair
+#    dones: (nStates*numNodes,) bool array of whether the transition from each pair ends the episode
+def _buildControllerChain(T, O, R, D, nodeActions, nextNodes, endEpisodes=False):
+    nStates, numNodes = T.shape[0], nodeActions.shape[0]
+    probs = T[:, nodeActions, :, None] * O[:, nodeActions]  # (nStates, numNodes, nStates, nObs)
+    s, n, s1, o = np.nonzero(probs)
+    p = probs[s, n, s1, o]
+    r = R[:, nodeActions][s, n, s1, o]
+    dones = np.zeros(nStates * numNodes, dtype=bool) if D is None else np.asarray(D[:, nodeActions], dtype=bool).ravel()
+    pc = p * (1.0 - dones[s * numNodes + n]) if endEpisodes else p
+    rows = s * numNodes + n
+    cols = s1 * numNodes + nextNodes[o, n]
+    size = nStates * numNodes
+    P = coo_matrix((pc, (rows, cols)), shape=(size, size)).tocsr()
+    PR = coo_matrix((pc * r, (rows, cols)), shape=(size, size)).tocsr()
+    expectedRewards = np.bincount(rows, weights=p * r, minlength=size)
+    expectedSquaredRewards = np.bincount(rows, weights=p * r ** 2, minlength=size)
+    return P, PR, expectedRewards, expectedSquaredRewards, dones
+
+# Solve for the exact discounted value (and return standard deviation) of a controller chain from node 0
+# Uses V = r + gamma*P*V for the mean and M = r2 + 2*gamma*PR*V + gamma^2*P*M for the second moment of the return
+# Inputs:
+#   P, PR, expectedRewards, expectedSquaredRewards: First outputs of _buildControllerChain
+#   start: (nStates,) start state distribution
+#   gamma: Discount factor
+#  Output:
+#    value: Expected discounted total return of the controller, starting from node 0
+#    stdDev: Standard deviation of discounted total return
+def _solveControllerChain(P, PR, expectedRewards, expectedSquaredRewards, start, gamma):
+    size = expectedRewards.shape[0]
+    numNodes = size // start.shape[0]
+    I = identity(size, format='csr')
+    V = spsolve(I - gamma * P, expectedRewards)
+    M = spsolve(I - (gamma ** 2) * P, expectedSquaredRewards + 2 * gamma * PR.dot(V))
+    value = start.dot(V.reshape(-1, numNodes)[:, 0])
+    secondMoment = start.dot(M.reshape(-1, numNodes)[:, 0])
+    return value, np.sqrt(max(secondMoment - value ** 2, 0.0))
+
+# First timestep at which every trajectory of the chains surely reports done, or None if there is none
+# The simulation loops stop at such a step (see evaluateSamplesMultiPOMDP), also with wrappers that keep stepping past
+# the end of an episode. Follows the set of (state, node) pairs reachable at each step until it only holds pairs whose
+# transition ends the episode, or until the sequence of reachable sets repeats
+# Inputs:
+#   chains: List of outputs of _buildControllerChain, evaluated together (as the samples of one batched simulation)
+#   start: (nStates,) start state distribution
+def _getAllDoneStep(chains, start):
+    dones = np.concatenate([chain[4] for chain in chains])
+    if not dones.any():
+        return None
+    numNodes = chains[0][2].shape[0] // start.shape[0]
+    PT = block_diag([chain[0] for chain in chains], format='csr').T.tocsr()
+    reachable = np.zeros((len(chains), start.shape[0], numNodes), dtype=bool)
+    reachable[:, :, 0] = start > 0
+    reachable = reachable.ravel()
+    seen = set()
+    timestep = 0
+    while reachable[~dones].any():
+        key = np.packbits(reachable).tobytes()
+        if key in seen:
+            return None
+        seen.add(key)
+        reachable = PT.dot(reachable.astype(np.float64)) > 0
+        timestep += 1
+    return timestep
+
+# Exact infinite-horizon values of controller chains evaluated together (see _solveControllerChain)
+# If every trajectory surely reports done at some step, simulation stops there, so the chains are propagated up to it instead
+# Inputs:
+#   chains: List of outputs of _buildControllerChain
+#   start: (nStates,) start state distribution
+#   gamma: Discount factor
+#   episodesEnd: Whether the chains leave out transitions that end the episode (endEpisodes on an episodic model)
+#  Output:
+#    values, stdDevs: (numChains,) expected discounted total returns and their standard deviations
+def _solveControllerChains(chains, start, gamma, episodesEnd):
+    allDoneStep = _getAllDoneStep(chains, start)
+    if allDoneStep is not None:
+        return _propagateControllerChains(chains, start, gamma, allDoneStep + 1)
+    assert gamma < 1 or episodesEnd, 'Exact infinite-horizon evaluation needs a discount below 1, or episodes that end'
+    res = [_solveControllerChain(*chain[:4], start, gamma) for chain in chains]
+    return np.array([ent[0] for ent in res]), np.array([ent[1] for ent in res])
+
+# Propagate the (state, node) occupancy of several controller chains forward together for a finite horizon
+# Chains are stacked block-diagonally, so each timestep is one sparse product for all of them.
+# Alongside the occupancy d_t, tracks g_t (expected return collected so far on each pair), which gives the exact
+# second moment of the return: E[G^2] = sum_t 2*gamma^t*g_t.r + gamma^(2t)*d_t.r2
+# Stops after a step where every occupied pair's transition ends the episode, since every trajectory of a batched
+# simulation of the chains reports done there (see evaluateSamplesMultiPOMDP)
+# Inputs:
+#   chains: List of outputs of _buildControllerChain (one per sample), all of the same size
+#   start: (nStates,) start state distribution
+#   gamma: Discount factor
+#   timeHorizon: Number of timesteps to propagate
+#  Output:
+#    values: (numChains,) expected discounted total return over timeHorizon, starting from node 0
+#    stdDevs: (numChains,) standard deviation of discounted total return over timeHorizon
+def _propagateControllerChains(chains, start, gamma, timeHorizon):
+    numChains = len(chains)
+    size = chains[0][2].shape[0]
+    numNodes = size // start.shape[0]
+    PT = block_diag([chain[0] for chain in chains], format='csr').T.tocsr()
+    PRT = block_diag([chain[1] for chain in chains], format='csr').T.tocsr()
+    r = np.stack([chain[2] for chain in chains])
+    r2 = np.stack([chain[3] for chain in chains])
+    occupancy = np.zeros((numChains, size), dtype=np.float64)
+    occupancy.reshape(numChains, -1, numNodes)[:, :, 0] = start
+    returnSoFar = np.zeros((numChains, size), dtype=np.float64)
+    values = np.zeros(numChains, dtype=np.float64)
+    secondMoments = np.zeros(numChains, dtype=np.float64)
+    dones = np.stack([chain[4] for chain in chains])
+    for t in range(timeHorizon):
+        discount = gamma ** t
+        values += discount * (occupancy * r).sum(axis=1)
+        secondMoments += 2 * discount * (returnSoFar * r).sum(axis=1) + (discount ** 2) * (occupancy * r2).sum(axis=1)
+        if not occupancy[~dones].any():  # Every trajectory is done
+            break
+        returnSoFar = (PT.dot(returnSoFar.ravel()) + discount * PRT.dot(occupancy.ravel())).reshape(numChains, size)
+        occupancy = PT.dot(occupancy.ravel()).reshape(numChains, size)
+    return values, np.sqrt(np.maximum(secondMoments - values ** 2, 0.0))
+
+# Get the normalized start distribution of an environment (uniform if unspecified)
+def _getStartDistribution(env):
+    start = env.start if env.start is not None else np.ones(env.state_space.n)
+    return start / np.sum(start)
+
+# Evaluate a single sample exactly over an infinite horizon, starting from first node
+# The controller and POMDP form a Markov chain over (state, node) pairs, so the discounted value is the
+# solution of a nStates*numNodes sparse linear system. No simulation, so no evaluation noise
+# Gives the value evaluateSampleMultiPOMDP converges to with many trajectories and a long horizon, with the same
+# episode ends as the wrapper: trajectories keep going past the end of an episode unless endEpisodes is set, and
+# simulation stops at a step where every trajectory surely reports done
+# Requires gamma < 1 (or endEpisodes on an episodic environment whose episodes end). timeHorizon is not used
+# Inputs:
+#   env: POMDP environment (or any wrapper of one) in which to evaluate
+#   actionTransitions: (numNodes,) int array of chosen actions for each node
+#   nodeObservationTransitions: (numObs, numNodes) int array of chosen node transitions for obs
+#   endEpisodes: Whether episodes end, as in the wrapper simulated with (see VectorizedMultiPOMDP)
+#  Output:
+#    value: Expected discounted total return over an infinite horizon
+#    stdDev: Standard deviation of discounted total return (of the return distribution, not of the estimate)
+def evaluateSampleExactPOMDP(env, actionTransitions, nodeObservationTransitions, endEpisodes=False):
+    values, stdDevs = evaluateSamplesExactPOMDP(env, actionTransitions[:, None], nodeObservationTransitions[:, :, None], endEpisodes)
+    return values[0], stdDevs[0]
+
+# Evaluate all sampled controllers of an iteration exactly (see evaluateSampleExactPOMDP)
+# Samples are evaluated together, as evaluateSamplesMultiPOMDP simulates them: simulation only stops early at a step
+# where the trajectories of every sample surely report done
+# Inputs:
+#   env: POMDP environment in which to evaluate
+#   sampledActions: (numNodes, numSamples) int array of chosen actions for each node of each sample
+#   sampledNodes: (numObs, numNodes, numSamples) int array of chosen node transitions for obs of each sample
+#   endEpisodes: Whether episodes end, as in the wrapper simulated with (see VectorizedMultiPOMDP)
+#  Output:
+#    values: (numSamples,) expected discounted total returns
+#    stdDevs: (numSamples,) standard deviations of discounted total returns
+def evaluateSamplesExactPOMDP(env, sampledActions, sampledNodes, endEpisodes=False):
+    gamma = env.discount if env.discount is not None else 1
+    assert not getattr(env, 'sparse', False), 'Exact evaluation needs dense model tables'
+    D = env.D if env.episodic else None
+    chains = [_buildControllerChain(env.T, env.O, env.R, D, sampledActions[:, i], sampledNodes[:, :, i], endEpisodes)
+              for i in range(sampledActions.shape[-1])]
+    return _solveControllerChains(chains, _getStartDistribution(env), gamma, endEpisodes and env.episodic)
+
+# Evaluate all sampled controllers of an iteration exactly over a finite horizon, starting from first node
+# Propagates each controller's (state, node) occupancy forward timeHorizon steps (see _propagateControllerChains),
+# giving the exact truncated value that simulation estimates, at a cost independent of the number of simulations
+# Episode ends follow the wrapper simulated with, as in evaluateSamplesExactPOMDP
+# Inputs:
+#   env: POMDP environment in which to evaluate
+#   timeHorizon: Time horizon over which to evaluate
+#   sampledActions: (numNodes, numSamples) int array of chosen actions for each node of each sample
+#   sampledNodes: (numObs, numNodes, numSamples) int array of chosen node transitions for obs of each sample
+#   endEpisodes: Whether episodes end, as in the wrapper simulated with (see VectorizedMultiPOMDP)
+#  Output:
+#    values: (numSamples,) expected discounted total returns over timeHorizon (or until every trajectory is done)
+#    stdDevs: (numSamples,) standard deviations of discounted total returns
+def evaluateSamplesFiniteHorizonPOMDP(env, timeHorizon, sampledActions, sampledNodes, endEpisodes=False):
+    gamma = env.discount if env.discount is not None else 1
+    assert not getattr(env, 'sparse', False), 'Exact evaluation needs dense model tables'
+    D = env.D if env.episodic else None
+    chains = [_buildControllerChain(env.T, env.O, env.R, D, sampledActions[:, i], sampledNodes[:, :, i], endEpisodes)
+              for i in range(sampledActions.shape[-1])]
+    return _propagateControllerChains(chains, _getStartDistribution(env), gamma, timeHorizon)
+
+# Get a DPOMDP's model tables with agent actions and observations flattened into joint indices
+#  Output:
+#    T: (nStates, nJointActions, nStates), O and R: (nStates, nJointActions, nStates, nJointObs)
+#    D: None if not episodic, else (nStates, nJointActions)
+def _getJointTablesDPOMDP(env):
+    assert not getattr(env, 'sparse', False), 'Exact evaluation needs dense model tables'
+    nStates = env.state_space.n
+    actionShape = tuple(aSpace.n for aSpace in env.action_space)
+    T = env.T.reshape(nStates, -1, nStates)
+    O = env.O.reshape(nStates, T.shape[1], nStates, -1)
+    R = env.R.reshape(O.shape)
+    D = None
+    if env.episodic:
+        D = env.D[(slice(None),) + np.unravel_index(np.arange(T.shape[1]), actionShape)]
+    return T, O, R, D
+
+# Build the joint controller of a decentralized sample, over the product of the agents' nodes
+# Joint node index is the raveled (node_1, ..., node_n); joint node 0 has every agent in its first node
+# Inputs:
+#   actionTransitions: (numNodes, numAgents) int array of chosen actions for each node of each agent
+#   nodeObservationTransitions: (numObs, numNodes, numAgents) int array of chosen node transitions of each agent
+#   actionShape: Number of actions of each agent
+#   obsShape: Number of observations of each agent
+#  Output:
+#    jointActions: (numNodes^numAgents,) joint action index at each joint node
+#    jointNextNodes: (nJointObs, numNodes^numAgents) joint node reached from each joint node on each joint observation
+def _buildJointController(actionTransitions, nodeObservationTransitions, actionShape, obsShape):
+    numNodes, nAgents = actionTransitions.shape
+    nodeShape = (numNodes,) * nAgents
+    agentNodes = np.unravel_index(np.arange(numNodes ** nAgents), nodeShape)  # Each agent's node at each joint node
+    agentObs = np.unravel_index(np.arange(np.prod(obsShape)), obsShape)  # Each agent's obs in each joint obs
+    jointActions = np.ravel_multi_index(tuple(actionTransitions[agentNodes[a], a] for a in range(nAgents)), actionShape)
+    jointNextNodes = np.ravel_multi_index(tuple(nodeObservationTransitions[agentObs[a][:, None], agentNodes[a][None, :], a]
+                                                for a in range(nAgents)), nodeShape)
+    return jointActions, jointNextNodes
+
+# Build the (state, joint node) chains of all samples of an iteration on a DPOMDP
+def _buildJointControllerChains(env, sampledActions, sampledNodes, endEpisodes=False):
+    T, O, R, D = _getJointTablesDPOMDP(env)
+    actionShape = tuple(aSpace.n for aSpace in env.action_space)
+    obsShape = tuple(oSpace.n for oSpace in env.observation_space)
+    return [_buildControllerChain(T, O, R, D, *_buildJointController(sampledActions[:, i], sampledNodes[:, :, i], actionShape, obsShape), endEpisodes)
+            for i in range(sampledActions.shape[1])]
+
+# Evaluate all sampled joint controllers of an iteration exactly over an infinite horizon, each agent starting from first node
+# The joint controller and DPOMDP form a Markov chain over (state, node_1, ..., node_n), which is solved as in
+# evaluateSamplesExactPOMDP, with the same episode ends. timeHorizon is not used
+# Inputs:
+#   env: DPOMDP environment in which to evaluate
+#   sampledActions: (numNodes, numSamples, numAgents) int array of chosen actions for each node of each sample
+#   sampledNodes: (numObs, numNodes, numSamples, numAgents) int array of chosen node transitions for obs of each sample
+#   endEpisodes: Whether episodes end, as in the wrapper simulated with (see VectorizedMultiDPOMDP)
+#  Output:
+#    values: (numSamples,) expected discounted total returns
+#    stdDevs: (numSamples,) standard deviations of discounted total returns
+def evaluateSamplesExactDPOMDP(env, sampledActions, sampledNodes, endEpisodes=False):
+    gamma = env.discount if env.discount is not None else 1
+    chains = _buildJointControllerChains(env, sampledActions, sampledNodes, endEpisodes)
+    return _solveControllerChains(chains, _getStartDistribution(env), gamma, endEpisodes and env.episodic)
+
+# Evaluate all sampled joint controllers of an iteration exactly over a finite horizon, each agent starting from first node
+# Inputs:
+#   env: DPOMDP environment in which to evaluate
+#   timeHorizon: Time horizon over which to evaluate
+#   sampledActions: (numNodes, numSamples, numAgents) int array of chosen actions for each node of each sample
+#   sampledNodes: (numObs, numNodes, numSamples, numAgents) int array of chosen node transitions for obs of each sample
+#   endEpisodes: Whether episodes end, as in the wrapper simulated with (see VectorizedMultiDPOMDP)
+#  Output:
+#    values: (numSamples,) expected discounted total returns over timeHorizon (or until every trajectory is done)
+#    stdDevs: (numSamples,) standard deviations of discounted total returns
+def evaluateSamplesFiniteHorizonDPOMDP(env, timeHorizon, sampledActions, sampledNodes, endEpisodes=False):
+    gamma = env.discount if env.discount is not None else 1
+    chains = _buildJointControllerChains(env, sampledActions, sampledNodes, endEpisodes)
+    return _propagateControllerChains(chains, _getStartDistribution(env), gamma, timeHorizon)
 
 def runDeterministicControllerOnEnvironment(env, controller, timeHorizon, printMsgs=False):
     gamma = env.discount if env.discount is not None else 1
@@ -0,0 +1,106 @@
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from .Evaluation import poolStatistics
+from .Controllers import canonicalizeController
+
+
+# Hash of a sampled controller's tables. Identical tables (single-agent or per-agent layout) give identical keys
+# Inputs:
+#   actionTransitions: (numNodes[, numAgents]) int array of chosen actions for each node
+#   nodeObservationTransitions: (numObs, numNodes[, numAgents]) int array of chosen node transitions for obs
+#  Output:
+#    key: Hex digest of the shapes and contents of both tables
+def hashController(actionTransitions, nodeObservationTransitions):
+    h = hashlib.sha1()
+    for table in (actionTransitions, nodeObservationTransitions):
+        table = np.ascontiguousarray(table, dtype=np.int64)
+        h.update(str(table.shape).encode())
+        h.update(table.tobytes())
+    return h.hexdigest()
+
+
+# Key of a sampled controller: hash of its canonical form with bisimilar nodes merged (see canonicalizeController),
+# so samples that differ only in unreachable nodes, node numbering or bisimilar nodes share a key
+def controllerKey(actionTransitions, nodeObservationTransitions):
+    return hashController(*canonicalizeController(actionTransitions, nodeObservationTransitions, mergeBisimilar=True))
+
+
+# Bounded cache of controller evaluations within a run, with least-recently-used eviction
+# Sampled controllers are keyed by controllerKey, so behaviorally identical samples share an entry
+# Each entry holds (numSimulations, value, stdDev) for one controller. Adding to an existing entry pools the statistics
+# Inputs:
+#   maxSize: Maximum number of controllers to keep
+class EvaluationCache(object):
+    def __init__(self, maxSize=10000):
+        assert maxSize > 0
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Fraction of lookups served from the cache so far
+    @property
+    def hitRate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    # Statistics for a key, or None if not cached. Marks the entry as recently used
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    # Add statistics for a key, pooling them with any already cached. Evicts least recently used entries if full
+    def add(self, key, numSimulations, value, stdDev):
+        if key in self.entries:
+            numSimulations, value, stdDev = poolStatistics(*self.entries[key], numSimulations, value, stdDev)
+        self.entries[key] = (numSimulations, value, stdDev)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    # Evaluate sampled controllers, only running evaluateFn on the first occurrence of each controller not in the cache
+    # Inputs:
+    #   evaluateFn: Function (sampledActions, sampledNodes) -> values, stdDevs, numSimulations, eliminated for those samples
+    #   sampledActions: (numNodes, numSamples[, numAgents]) int array of chosen actions for each node of each sample
+    #   sampledNodes: (numObs, numNodes, numSamples[, numAgents]) int array of chosen node transitions for obs of each sample
+    #  Output:
+    #    values, stdDevs: (numSamples,) cached or newly computed statistics
+    #    numSimulations: (numSamples,) number of simulations spent on each sample now (0 for hits)
+    #    eliminated: (numSamples,) as returned by evaluateFn, False for hits
+    def evaluateSamples(self, evaluateFn, sampledActions, sampledNodes):
+        numSamples = sampledActions.shape[1]
+        keys = [controllerKey(sampledActions[:, i], sampledNodes[:, :, i]) for i in range(numSamples)]
+        values = np.zeros(numSamples, dtype=np.float64)
+        stdDevs = np.zeros(numSamples, dtype=np.float64)
+        numSimulations = np.zeros(numSamples, dtype=np.int64)
+        eliminated = np.zeros(numSamples, dtype=bool)
+
+        # Serve cached samples, collect the first sample of each new controller
+        newSampleIndices = OrderedDict()
+        for i, key in enumerate(keys):
+            entry = self.get(key)
+            if entry is not None:
+                values[i], stdDevs[i] = entry[1:]
+            elif key not in newSampleIndices:
+                newSampleIndices[key] = i
+
+        if newSampleIndices:
+            evalIndices = np.array(list(newSampleIndices.values()))
+            newValues, newStdDevs, newNumSimulations, newEliminated = evaluateFn(sampledActions[:, evalIndices], sampledNodes[:, :, evalIndices])
+            values[evalIndices] = newValues
+            stdDevs[evalIndices] = newStdDevs
+            numSimulations[evalIndices] = newNumSimulations
+            eliminated[evalIndices] = newEliminated
+            # Repeats of a new controller within this batch share its statistics
+            for i, key in enumerate(keys):
+                if key in newSampleIndices and i != newSampleIndices[key]:
+                    values[i], stdDevs[i] = values[newSampleIndices[key]], stdDevs[newSampleIndices[key]]
+            for key, i in newSampleIndices.items():
+                self.add(key, numSimulations[i], values[i], stdDevs[i])
+
+        self.misses += len(newSampleIndices)
+        self.hits += numSamples - len(newSampleIndices)
+        return values, stdDevs, numSimulations, eliminated
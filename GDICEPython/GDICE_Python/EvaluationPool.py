@@ -0,0 +1,269 @@
+import copy
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, cpu_count
+from scipy.sparse import csr_matrix, issparse
+from .Domains import getExpectedRewards, getMDPBaseline
+from .Evaluation import evaluateSampleMultiPOMDP, evaluateSampleMultiDPOMDP, evaluateSamplesMultiPOMDP, evaluateSamplesMultiDPOMDP
+from .EvaluationStore import getEnvironmentFingerprint
+
+# Environment of a pool worker, set once when the worker starts
+_workerEnv = None
+# Shared memory blocks a worker's environment views, kept open for the worker's lifetime
+_workerBlocks = []
+
+# Arrays smaller than this are sent to workers by value
+_minSharedBytes = 1 << 16
+
+
+# Pool of worker processes that keep the environment loaded between tasks
+# Workers receive the environment once, when they start (inherited on fork, pickled once per worker otherwise).
+# Tasks then only carry the sampled controller's int32 tables, so the model tensors are not sent again every
+# iteration. The pool is kept while the environment stays the same (by fingerprint, see getEnvironmentFingerprint),
+# so it can be reused across runs and parameter sets, and is restarted when a different environment is evaluated
+# Pass it as parallel to runGDICEOnEnvironment in place of a multiprocessing Pool. Use it as a context manager (or call
+# close) so the workers are stopped and the shared memory blocks are unlinked even if a run fails
+# With sharedMemory, the environment's model tensors (and the tables derived from them, such as cumulative tables,
+# expected rewards and the MDP baseline, which are built once in the parent) are placed in shared memory blocks.
+# Workers attach read-only views of them instead of holding copies, so memory use does not grow with the worker count
+# Inputs:
+#   processes: Number of worker processes. Defaults to the number of CPUs
+#   sharedMemory: If True, share the model tensors with the workers through multiprocessing.shared_memory (Python 3.8+,
+#                 imported only when this is used)
+class EvaluationPool(object):
+    def __init__(self, processes=None, sharedMemory=False):
+        self.processes = processes
+        self.sharedMemory = sharedMemory
+        self.pool = None
+        self.envKey = None
+        self.blocks = []
+
+    # Make sure the workers hold env, restarting them if they hold another environment
+    def setEnvironment(self, env):
+        envKey = getEnvironmentFingerprint(env)
+        if self.pool is not None and envKey == self.envKey:
+            return
+        self.close()
+        sharedTables = {}
+        if self.sharedMemory:
+            env, sharedTables = self._shareTables(env)
+        self.pool = Pool(self.processes, initializer=_initWorker, initargs=(env, sharedTables))
+        self.envKey = envKey
+
+    # Move the large tables of env into shared memory blocks
+    # Output:
+    #   workerEnv: Shallow copy of env without the shared tables, to send to the workers
+    #   sharedTables: Dictionary of attribute name to the layout of its shared table (see _attachTable)
+    def _shareTables(self, env):
+        workerEnv = copy.copy(env)
+        sharedTables = {}
+        for name, table in vars(env).items():
+            layout = self._shareTable(table)
+            if layout is not None:
+                sharedTables[name] = layout
+                setattr(workerEnv, name, None)
+        return workerEnv, sharedTables
+
+    def _shareTable(self, table):
+        from multiprocessing.shared_memory import SharedMemory
+        if isinstance(table, np.ndarray) and table.dtype != object and table.nbytes >= _minSharedBytes:
+            block = SharedMemory(create=True, size=table.nbytes)
+            np.ndarray(table.shape, dtype=table.dtype, buffer=block.buf)[...] = table
+            self.blocks.append(block)
+            return 'array', block.name, table.shape, table.dtype.str
+        if issparse(table):
+            table = table.tocsr()
+            arrays = [self._shareTable(array) or ('value', array) for array in (table.data, table.indices, table.indptr)]
+            return 'csr', arrays, table.shape
+        if isinstance(table, tuple):
+            entries = [self._shareTable(entry) for entry in table]
+            if any(entry is not None for entry in entries):
+                return 'tuple', [entry or ('value', value) for entry, value in zip(entries, table)]
+        return None
+
+    # Evaluate samples on the workers
+    # Inputs:
+    #   env: Environment to evaluate on (see setEnvironment)
+    #   MultiEnvWrapper: Multi-trajectory wrapper class the workers run the rollouts with
+    #   timeHorizon: Time horizon over which to evaluate
+    #   tasks: List of (numSimulations, seed, actionTransitions, nodeObservationTransitions), one per task. Each task
+    #          simulates one sample numSimulations times. seed reseeds the worker's environment first, unless None
+    #   raoBlackwell, controlVariate: Whether to accumulate expected rewards / use the MDP control variate (see GDICEParams)
+    #  Output:
+    #    List of (value, stdDev) of each task
+    def evaluate(self, env, MultiEnvWrapper, timeHorizon, tasks, raoBlackwell=False, controlVariate=False):
+        self._prepareEnvironment(env, MultiEnvWrapper, raoBlackwell, controlVariate)
+        return self.pool.starmap(_evaluateInWorker, [(MultiEnvWrapper, numSimulations, seed, timeHorizon,
+                                                      np.asarray(actionTransitions, dtype=np.int32), np.asarray(nodeObservationTransitions, dtype=np.int32),
+                                                      raoBlackwell, controlVariate)
+                                                     for numSimulations, seed, actionTransitions, nodeObservationTransitions in tasks])
+
+    # Evaluate batches of samples on the workers, advancing the rollouts of each batch together
+    # Inputs:
+    #   env, MultiEnvWrapper, timeHorizon, raoBlackwell, controlVariate: As in evaluate
+    #   tasks: List of (numSimulations, numStreams, seed, sampledActions, sampledNodes), one per task. Each task simulates
+    #          every sample of its tables numSimulations times, in a wrapper with numStreams random streams (all if None)
+    #  Output:
+    #    List of (values, stdDevs) of each task
+    def evaluateBatches(self, env, MultiEnvWrapper, timeHorizon, tasks, raoBlackwell=False, controlVariate=False):
+        self._prepareEnvironment(env, MultiEnvWrapper, raoBlackwell, controlVariate)
+        return self.pool.starmap(_evaluateBatchInWorker, [(MultiEnvWrapper, numSimulations, numStreams, seed, timeHorizon,
+                                                           np.asarray(sampledActions, dtype=np.int32), np.asarray(sampledNodes, dtype=np.int32),
+                                                           raoBlackwell, controlVariate)
+                                                          for numSimulations, numStreams, seed, sampledActions, sampledNodes in tasks])
+
+    # Start the workers on env if needed
+    def _prepareEnvironment(self, env, MultiEnvWrapper, raoBlackwell, controlVariate):
+        if self.sharedMemory and (self.pool is None or getEnvironmentFingerprint(env) != self.envKey):
+            # Build the derived tables the workers will use once, so they are shared too
+            MultiEnvWrapper(env, 1)
+            if raoBlackwell:
+                getExpectedRewards(env)
+            if controlVariate:
+                getMDPBaseline(env)
+        self.setEnvironment(env)
+
+    # Stop the workers and free the shared memory
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.pool = None
+        self.envKey = None
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+# Store the environment in a starting worker, attaching its shared tables. Each worker gets its own random stream
+def _initWorker(env, sharedTables):
+    global _workerEnv
+    _workerEnv = env
+    for name, layout in sharedTables.items():
+        setattr(_workerEnv, name, _attachTable(layout))
+    _workerEnv.seed(None)
+
+
+# Rebuild a table from its shared layout, as read-only views of the shared memory blocks
+def _attachTable(layout):
+    kind = layout[0]
+    if kind == 'array':
+        from multiprocessing.shared_memory import SharedMemory
+        block = SharedMemory(name=layout[1])
+        _workerBlocks.append(block)
+        array = np.ndarray(layout[2], dtype=np.dtype(layout[3]), buffer=block.buf)
+        array.flags.writeable = False
+        return array
+    if kind == 'csr':
+        data, indices, indptr = (_attachTable(entry) for entry in layout[1])
+        return csr_matrix((data, indices, indptr), shape=layout[2], copy=False)
+    if kind == 'tuple':
+        return tuple(_attachTable(entry) for entry in layout[1])
+    return layout[1]
+
+
+# Evaluate one sample on the worker's environment
+def _evaluateInWorker(*args):
+    return _evaluateOnEnvironment(_workerEnv, *args)
+
+
+# Evaluate a batch of samples on the worker's environment
+def _evaluateBatchInWorker(*args):
+    return _evaluateBatchOnEnvironment(_workerEnv, *args)
+
+
+# Evaluate one sample on env, reseeding env first unless seed is None
+def _evaluateOnEnvironment(env, MultiEnvWrapper, numSimulations, seed, timeHorizon, actionTransitions, nodeObservationTransitions, raoBlackwell, controlVariate):
+    multiEnv = MultiEnvWrapper(env, numSimulations)
+    if seed is not None:
+        env.seed(seed)
+    envEvalFn = evaluateSampleMultiDPOMDP if actionTransitions.ndim > 1 else evaluateSampleMultiPOMDP
+    expectedRewards = getExpectedRewards(env) if raoBlackwell else None
+    baseline = getMDPBaseline(env) if controlVariate else None
+    return envEvalFn(multiEnv, timeHorizon, actionTransitions, nodeObservationTransitions, expectedRewards, baseline)
+
+
+# Evaluate a batch of samples on env, reseeding env first unless seed is None
+def _evaluateBatchOnEnvironment(env, MultiEnvWrapper, numSimulations, numStreams, seed, timeHorizon, sampledActions, sampledNodes, raoBlackwell, controlVariate):
+    numSamples = sampledActions.shape[1]
+    if numStreams is None:
+        multiEnv = MultiEnvWrapper(env, numSamples * numSimulations)
+    else:
+        multiEnv = MultiEnvWrapper(env, numSamples * numSimulations, numStreams=numStreams)
+    if seed is not None:
+        env.seed(seed)
+    batchEvalFn = evaluateSamplesMultiDPOMDP if sampledActions.ndim > 2 else evaluateSamplesMultiPOMDP
+    expectedRewards = getExpectedRewards(env) if raoBlackwell else None
+    baseline = getMDPBaseline(env) if controlVariate else None
+    return batchEvalFn(multiEnv, timeHorizon, sampledActions, sampledNodes, expectedRewards, baseline)
+
+
+# Pool of threads evaluating samples in the parent process with a compiled rollout kernel that releases the GIL
+# (see NumbaEvaluation), so the threads run on separate cores. Threads avoid pickling anything: every task reads the
+# same copy of the model tensors, of the tables derived from them and of the sampled controller arrays
+# Each task seeds the kernel's random generator, so tasks never share a random stream and results do not depend on
+# thread scheduling. Derived tables are built once, before tasks are started
+# Pass it as parallel to runGDICEOnEnvironment in place of a multiprocessing Pool, with envType 2 on a dense model and
+# without common random numbers, quasiRandom or antithetic streams, which the kernel does not draw. Needs numba (the threads extra)
+# Inputs:
+#   threads: Number of threads. Defaults to the number of CPUs
+class ThreadEvaluationPool(EvaluationPool):
+    def __init__(self, threads=None):
+        super(ThreadEvaluationPool, self).__init__(threads or cpu_count())
+        try:  # numba is only needed for this pool
+            from .NumbaEvaluation import evaluateSamplesKernel
+        except ImportError as e:
+            raise ImportError('ThreadEvaluationPool needs numba, install it with pip install GDICE_Python[threads]') from e
+        self.evaluateSamplesKernel = evaluateSamplesKernel
+        self.executor = None
+
+    # Threads share env directly, there is nothing to send
+    def setEnvironment(self, env):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.processes)
+
+    def evaluate(self, env, MultiEnvWrapper, timeHorizon, tasks, raoBlackwell=False, controlVariate=False):
+        multiEnv = self._prepareEnvironment(env, MultiEnvWrapper, raoBlackwell, controlVariate)
+        seeds = self._getTaskSeeds([task[1] for task in tasks])
+        res = self.executor.map(lambda task, seed: self.evaluateSamplesKernel(multiEnv, timeHorizon, task[0], seed,
+                                                                              np.expand_dims(task[2], 1), np.expand_dims(task[3], 2),
+                                                                              raoBlackwell, controlVariate),
+                                tasks, seeds)
+        return [(values[0], stdDevs[0]) for values, stdDevs in res]
+
+    def evaluateBatches(self, env, MultiEnvWrapper, timeHorizon, tasks, raoBlackwell=False, controlVariate=False):
+        assert all(task[1] is None for task in tasks), 'The evaluation kernel does not share random streams'
+        multiEnv = self._prepareEnvironment(env, MultiEnvWrapper, raoBlackwell, controlVariate)
+        seeds = self._getTaskSeeds([task[2] for task in tasks])
+        return list(self.executor.map(lambda task, seed: self.evaluateSamplesKernel(multiEnv, timeHorizon, task[0], seed, task[3], task[4],
+                                                                                    raoBlackwell, controlVariate),
+                                      tasks, seeds))
+
+    # Build the derived tables on env itself (no-op once cached), so every task reads the same ones
+    # Output:
+    #   multiEnv: Small wrapper of env, telling the kernel which wrapper (and episode ends) the rollouts follow
+    def _prepareEnvironment(self, env, MultiEnvWrapper, raoBlackwell, controlVariate):
+        multiEnv = MultiEnvWrapper(env, 1)
+        assert hasattr(multiEnv, 'endEpisodes'), 'The evaluation kernel follows the vectorized wrappers (envType 2)'
+        if raoBlackwell:
+            getExpectedRewards(env)
+        if controlVariate:
+            getMDPBaseline(env)
+        self.setEnvironment(env)
+        return multiEnv
+
+    # Tasks without a seed get a fresh one
+    def _getTaskSeeds(self, seeds):
+        return [int(np.random.randint(2**31 - 1)) if seed is None else seed for seed in seeds]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.executor = None
@@ -0,0 +1,153 @@
+import os
+import hashlib
+import sqlite3
+import filelock
+import numpy as np
+from scipy.sparse import issparse
+from .Evaluation import poolStatistics
+from .EvaluationCache import controllerKey
+
+
+# Fingerprint of an environment's model, so that stored evaluations are only shared between identical models
+# Hashes the discount and the start, transition, observation, reward and done tables (sparse tables by their CSR
+# arrays, so a sparse and a dense copy of one model have different fingerprints). Environments without tables
+# fall back to their registered id. Computed once and cached on the environment
+def getEnvironmentFingerprint(env):
+    if getattr(env, 'fingerprint', None) is not None:
+        return env.fingerprint
+    if not hasattr(env, 'T'):
+        env.fingerprint = env.spec.id
+        return env.fingerprint
+    h = hashlib.sha1()
+    h.update(repr(env.discount).encode())
+    for name in ('start', 'T', 'O', 'R', 'D'):
+        table = getattr(env, name, None)
+        if table is None:
+            continue
+        h.update(name.encode())
+        if issparse(table):
+            table = table.tocsr()
+            table.sort_indices()
+            arrays = (np.array(table.shape), table.indptr, table.indices, table.data)
+        else:
+            arrays = (np.array(np.shape(table)), np.asarray(table))
+        for array in arrays:
+            h.update(np.ascontiguousarray(array).tobytes())
+    env.fingerprint = h.hexdigest()
+    return env.fingerprint
+
+
+# Key of the return estimator a parameter set evaluates controllers with (see GDICEParams). Estimates from different
+# estimators have the same mean but different variances, so their statistics are kept apart
+def getEstimatorKey(params):
+    flags = ((params.raoBlackwell, '_rb'), (params.controlVariate, '_cv'),
+             (params.quasiRandom is not None, '_qmc' + str(params.quasiRandom)), (params.antithetic, '_anti'))
+    return 'mc' + ''.join(suffix for flag, suffix in flags if flag)
+
+
+# Persistent store of controller evaluations, shared by every run and parameter set that points at the same file
+# Rows are keyed by environment fingerprint, return estimator (see getEstimatorKey), controller key (see controllerKey),
+# evaluation horizon and numSimulationsPerSample, and hold the number of simulations with the sum and sum of squares of their returns,
+# so statistics from any number of runs merge by addition
+# The database lives in an SQLite file under baseDir. Every access holds a file lock next to it (as the run lists in
+# Scripts do), and the default rollback journal is used, so several processes can share it on one node or a shared filesystem
+# Inputs:
+#   baseDir: Directory to keep the database in
+#   fileName: Name of the database file
+#   timeout: Seconds to wait for the database before giving up
+class EvaluationStore(object):
+    def __init__(self, baseDir='', fileName='GDICEEvaluations.sqlite', timeout=600):
+        if baseDir:
+            os.makedirs(baseDir, exist_ok=True)
+        self.path = os.path.join(baseDir, fileName)
+        self.timeout = timeout
+        with filelock.FileLock(self.path + '.lock', timeout=self.timeout):
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            with connection:
+                connection.execute('CREATE TABLE IF NOT EXISTS evaluations (envKey TEXT, estimatorKey TEXT, controllerKey TEXT, timeHorizon INTEGER, '
+                                   'numSimulationsPerSample INTEGER, numSimulations INTEGER, sumReturns REAL, sumSquaredReturns REAL, '
+                                   'PRIMARY KEY (envKey, estimatorKey, controllerKey, timeHorizon, numSimulationsPerSample))')
+            connection.close()
+
+    # Stored statistics for controller keys
+    # Output:
+    #   Dictionary of controller key to (numSimulations, value, stdDev), for the keys that have been stored
+    def get(self, envKey, estimatorKey, controllerKeys, timeHorizon, numSimulationsPerSample):
+        with filelock.FileLock(self.path + '.lock', timeout=self.timeout):
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            rows = []
+            uniqueKeys = list(set(controllerKeys))
+            # Stay below SQLite's limit on query parameters
+            for start in range(0, len(uniqueKeys), 500):
+                chunk = uniqueKeys[start:start + 500]
+                rows += connection.execute('SELECT controllerKey, numSimulations, sumReturns, sumSquaredReturns FROM evaluations '
+                                           'WHERE envKey = ? AND estimatorKey = ? AND timeHorizon = ? AND numSimulationsPerSample = ? AND controllerKey IN (' +
+                                           ','.join('?' * len(chunk)) + ')',
+                                           [envKey, estimatorKey, timeHorizon, numSimulationsPerSample] + chunk).fetchall()
+            connection.close()
+        stored = {}
+        for key, numSimulations, sumReturns, sumSquaredReturns in rows:
+            value = sumReturns / numSimulations
+            stored[key] = (numSimulations, value, np.sqrt(max(sumSquaredReturns / numSimulations - value ** 2, 0.0)))
+        return stored
+
+    # Add new simulation statistics, merging them with whatever is stored under the same key
+    # Inputs:
+    #   records: Iterable of (controllerKey, numSimulations, value, stdDev). Records with no simulations are skipped
+    def add(self, envKey, estimatorKey, records, timeHorizon, numSimulationsPerSample):
+        rows = [(envKey, estimatorKey, key, timeHorizon, numSimulationsPerSample, int(n), n * value, n * (stdDev ** 2 + value ** 2))
+                for key, n, value, stdDev in records if n > 0]
+        with filelock.FileLock(self.path + '.lock', timeout=self.timeout):
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            with connection:
+                connection.executemany('INSERT INTO evaluations VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                                       'ON CONFLICT (envKey, estimatorKey, controllerKey, timeHorizon, numSimulationsPerSample) DO UPDATE SET '
+                                       'numSimulations = numSimulations + excluded.numSimulations, '
+                                       'sumReturns = sumReturns + excluded.sumReturns, '
+                                       'sumSquaredReturns = sumSquaredReturns + excluded.sumSquaredReturns', rows)
+            connection.close()
+
+    # Evaluate sampled controllers, reusing stored statistics for controllers that already have numSimulationsPerSample
+    # stored simulations. The others are evaluated, their new simulations are added to the store, and the statistics
+    # returned for them pool the new simulations with any stored ones
+    # Inputs:
+    #   evaluateFn: Function (sampledActions, sampledNodes) -> values, stdDevs, numSimulations, eliminated for those samples
+    #   envKey: Environment fingerprint (see getEnvironmentFingerprint)
+    #   estimatorKey: Return estimator the samples are evaluated with (see getEstimatorKey)
+    #   timeHorizon: Horizon the samples are evaluated over
+    #   numSimulationsPerSample: Simulations a controller needs in the store to be reused
+    #   sampledActions: (numNodes, numSamples[, numAgents]) int array of chosen actions for each node of each sample
+    #   sampledNodes: (numObs, numNodes, numSamples[, numAgents]) int array of chosen node transitions for obs of each sample
+    #  Output:
+    #    values, stdDevs: (numSamples,) statistics over all stored and new simulations (as returned by evaluateFn for
+    #                     samples it estimated without simulating them)
+    #    numSimulations: (numSamples,) number of simulations spent on each sample now (0 if reused)
+    #    eliminated: (numSamples,) as returned by evaluateFn, False if reused
+    def evaluateSamples(self, evaluateFn, envKey, estimatorKey, timeHorizon, numSimulationsPerSample, sampledActions, sampledNodes):
+        numSamples = sampledActions.shape[1]
+        keys = [controllerKey(sampledActions[:, i], sampledNodes[:, :, i]) for i in range(numSamples)]
+        stored = self.get(envKey, estimatorKey, keys, timeHorizon, numSimulationsPerSample)
+        values = np.zeros(numSamples, dtype=np.float64)
+        stdDevs = np.zeros(numSamples, dtype=np.float64)
+        numSimulations = np.zeros(numSamples, dtype=np.int64)
+        eliminated = np.zeros(numSamples, dtype=bool)
+
+        evalIndices = np.array([i for i, key in enumerate(keys) if key not in stored or stored[key][0] < numSimulationsPerSample], dtype=np.int64)
+        reuseIndices = np.setdiff1d(np.arange(numSamples), evalIndices)
+        for i in reuseIndices:
+            values[i], stdDevs[i] = stored[keys[i]][1:]
+
+        if evalIndices.size:
+            newValues, newStdDevs, newNumSimulations, newEliminated = evaluateFn(sampledActions[:, evalIndices], sampledNodes[:, :, evalIndices])
+            newNumSimulations = np.broadcast_to(newNumSimulations, evalIndices.shape)
+            self.add(envKey, estimatorKey, [(keys[i], newNumSimulations[j], newValues[j], newStdDevs[j]) for j, i in enumerate(evalIndices)],
+                     timeHorizon, numSimulationsPerSample)
+            for j, i in enumerate(evalIndices):
+                if newNumSimulations[j] == 0:  # Estimated without simulating it (e.g. off-policy), nothing to pool or store
+                    values[i], stdDevs[i] = newValues[j], newStdDevs[j]
+                    continue
+                previous = stored.get(keys[i], (0, 0.0, 0.0))
+                values[i], stdDevs[i] = poolStatistics(*previous, newNumSimulations[j], newValues[j], newStdDevs[j])[1:]
+            numSimulations[evalIndices] = newNumSimulations
+            eliminated[evalIndices] = newEliminated
+        return values, stdDevs, numSimulations, eliminated
@@ -17,6 +17,9 @@ class GDICEEnvWrapper(gym.Wrapper):
         self.reset()
 
     def __getattr__(self, attr):
+        # env is not set yet while unpickling (e.g. in pool workers)
+        if attr == 'env':
+            raise AttributeError(attr)
         return getattr(self.env, attr)
 
     def reset(self):
@@ -0,0 +1,188 @@
+import os
+import sys
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+import filelock
+from contextlib import contextmanager
+
+
+# Queue of {run}/{env}/{param} sets to evaluate, shared by many jobs through an SQLite database
+# Replaces the POMDPsToEval.txt / _inprog.txt / _done.txt lists (see Scripts.claimRunEnvParamSet). Claims are single
+# transactions on an indexed table, so they do not rewrite the lists and do not grow with their length.
+# A claimed set is leased to its owner until its lease expires. Owners renew their leases with heartbeats while they
+# work (see keepAlive); sets whose lease expired (the job was killed, timed out or crashed) are claimable again, so
+# unfinished sets are picked up without assuming nobody else is working on them. A set that was claimed maxAttempts
+# times without being completed is marked 'failed' instead of being queued again
+# As in EvaluationStore, every access holds a file lock next to the database and the default rollback journal is used,
+# so the queue works on the shared filesystems the jobs run from
+# Inputs:
+#   filepath: Path of the database file. Created if it does not exist
+#   leaseSeconds: How long a claim is held without a heartbeat
+#   maxAttempts: Number of claims a set gets before it is marked failed
+#   owner: Name of this worker in the queue. Defaults to host:pid (with the SLURM job id if there is one)
+#   timeout: Seconds to wait for the database before giving up
+class JobQueue(object):
+    def __init__(self, filepath='POMDPsToEval.db', leaseSeconds=600, maxAttempts=3, owner=None, timeout=600):
+        self.filepath = filepath
+        self.leaseSeconds = leaseSeconds
+        self.maxAttempts = maxAttempts
+        if owner is None:
+            owner = socket.gethostname() + ':' + str(os.getpid())
+            if 'SLURM_JOB_ID' in os.environ:
+                owner += ':' + os.environ['SLURM_JOB_ID']
+        self.owner = owner
+        self.timeout = timeout
+        self.held = set()  # Sets this owner claimed and has not completed or released yet
+        self.heldLock = threading.Lock()  # The heartbeat thread reads held while the owner updates it
+        with self._transaction() as c:
+            c.execute('CREATE TABLE IF NOT EXISTS jobs (position INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, '
+                      'status TEXT NOT NULL DEFAULT \'pending\', owner TEXT, leaseExpiry REAL, attempts INTEGER NOT NULL DEFAULT 0)')
+            c.execute('CREATE INDEX IF NOT EXISTS jobsByStatus ON jobs (status, leaseExpiry)')
+
+    # Run statements in one write transaction, holding the file lock (so claims cannot interleave)
+    @contextmanager
+    def _transaction(self):
+        with filelock.FileLock(self.filepath + '.lock', timeout=self.timeout):
+            # Autocommit mode, the transaction is opened explicitly
+            connection = sqlite3.connect(self.filepath, timeout=self.timeout, isolation_level=None)
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                try:
+                    yield connection
+                except BaseException:
+                    connection.execute('ROLLBACK')
+                    raise
+                connection.execute('COMMIT')
+            finally:
+                connection.close()
+
+    # Add sets to the end of the queue. Sets already in the queue are left as they are
+    # Inputs:
+    #   names: Iterable of {run}/{env}/{param} strings
+    #   status: 'pending' to queue them, or 'done' to record them as finished
+    def addJobs(self, names, status='pending'):
+        assert status in ('pending', 'done')
+        with self._transaction() as c:
+            c.executemany('INSERT OR IGNORE INTO jobs (name, status) VALUES (?, ?)', [(name, status) for name in names])
+
+    # Import a text list and its _inprog / _done lists (see writePOMDPGridSearchParamsToFile)
+    # Sets in progress are queued again, since their owners cannot be told apart from dead jobs. Sets already in the
+    # queue keep their state, except that sets listed as done are marked done
+    # Inputs:
+    #   filepath: Path of the list of sets to evaluate, e.g. POMDPsToEval.txt
+    def importListFile(self, filepath):
+        base = os.path.splitext(filepath)[0]
+        for path, status in ((filepath, 'pending'), (base + '_inprog.txt', 'pending'), (base + '_done.txt', 'done')):
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    names = [line.strip() for line in f if line.strip()]
+                self.addJobs(names, status)
+                if status == 'done':
+                    with self._transaction() as c:
+                        c.executemany('UPDATE jobs SET status = \'done\', owner = NULL, leaseExpiry = NULL WHERE name = ?', [(name,) for name in names])
+
+    # Lease the next sets in queue order, including sets whose lease expired
+    # Expired sets that already used up their attempts are marked failed instead
+    # Inputs:
+    #   count: Maximum number of sets to claim
+    #  Output:
+    #    List of claimed {run}/{env}/{param} strings (empty if none are left)
+    def claim(self, count=1):
+        now = time.time()
+        with self._transaction() as c:
+            c.execute('UPDATE jobs SET status = \'failed\', owner = NULL, leaseExpiry = NULL '
+                      'WHERE status = \'leased\' AND leaseExpiry < ? AND attempts >= ?', (now, self.maxAttempts))
+            rows = c.execute('SELECT position, name FROM jobs WHERE status = \'pending\' OR (status = \'leased\' AND leaseExpiry < ?) '
+                             'ORDER BY position LIMIT ?', (now, count)).fetchall()
+            c.executemany('UPDATE jobs SET status = \'leased\', owner = ?, leaseExpiry = ?, attempts = attempts + 1 WHERE position = ?',
+                          [(self.owner, now + self.leaseSeconds, position) for position, _ in rows])
+        names = [name for _, name in rows]
+        with self.heldLock:
+            self.held.update(names)
+        return names
+
+    # Claim a single set, as claimRunEnvParamSet. Returns None if none are left
+    def claimOne(self):
+        names = self.claim(1)
+        return names[0] if names else None
+
+    # Renew the leases this owner holds on sets
+    #  Output:
+    #    Names of the sets whose lease was renewed. Sets missing from it were lost (the lease expired and another job
+    #    claimed the set) and should not be completed
+    def heartbeat(self, names):
+        expiry = time.time() + self.leaseSeconds
+        with self._transaction() as c:
+            c.executemany('UPDATE jobs SET leaseExpiry = ? WHERE name = ? AND status = \'leased\' AND owner = ?',
+                          [(expiry, name, self.owner) for name in names])
+            return [name for name, in c.execute('SELECT name FROM jobs WHERE status = \'leased\' AND owner = ?', (self.owner,)) if name in names]
+
+    # Renew the leases on sets from a background thread while the body runs, every third of the lease
+    # Sets are dropped from the heartbeat once they are completed or released. Failed heartbeats and lost leases are
+    # reported on stderr, and the thread keeps trying until the body is done
+    @contextmanager
+    def keepAlive(self, names, interval=None):
+        interval = self.leaseSeconds / 3 if interval is None else interval
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                with self.heldLock:
+                    heldNames = [name for name in names if name in self.held]
+                if not heldNames:
+                    continue
+                try:
+                    lost = set(heldNames) - set(self.heartbeat(heldNames))
+                except Exception:
+                    print('Heartbeat failed for ' + ', '.join(names), file=sys.stderr)
+                    traceback.print_exc()
+                    continue
+                if lost:
+                    with self.heldLock:
+                        self.held -= lost  # Reported once, the sets now belong to another job
+                    print('Lost the lease on ' + ', '.join(sorted(lost)), file=sys.stderr)
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    # Mark a set finished, as registerRunEnvParamSetCompletion
+    #  Output:
+    #    True if this owner held the lease, False if it was lost to another job (the set is left to that job)
+    def complete(self, name):
+        with self.heldLock:
+            self.held.discard(name)
+        with self._transaction() as c:
+            return c.execute('UPDATE jobs SET status = \'done\', owner = NULL, leaseExpiry = NULL '
+                             'WHERE name = ? AND status = \'leased\' AND owner = ?', (name, self.owner)).rowcount > 0
+
+    # Give up a lease, so another job can claim the set right away, or mark the set failed if it used up its attempts
+    #  Output:
+    #    New status of the set ('pending' or 'failed'), or None if this owner did not hold its lease
+    def release(self, name):
+        with self.heldLock:
+            self.held.discard(name)
+        with self._transaction() as c:
+            row = c.execute('SELECT attempts FROM jobs WHERE name = ? AND status = \'leased\' AND owner = ?', (name, self.owner)).fetchone()
+            if row is None:
+                return None
+            status = 'failed' if row[0] >= self.maxAttempts else 'pending'
+            c.execute('UPDATE jobs SET status = ?, owner = NULL, leaseExpiry = NULL WHERE name = ?', (status, name))
+        return status
+
+    # Number of sets by state: pending, leased (with a live lease), expired (leased, lease expired), done and failed
+    def counts(self):
+        now = time.time()
+        counts = dict(pending=0, leased=0, expired=0, done=0, failed=0)
+        with self._transaction() as c:
+            rows = c.execute('SELECT status, leaseExpiry < ?, COUNT(*) FROM jobs GROUP BY status, leaseExpiry < ?', (now, now)).fetchall()
+        for status, expired, count in rows:
+            counts['expired' if status == 'leased' and expired else status] += count
+        return counts
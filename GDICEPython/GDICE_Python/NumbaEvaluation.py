@@ -0,0 +1,119 @@
+import numpy as np
+from numba import njit
+from .Domains import getCumulativeTables, getExpectedRewards, getMDPBaseline
+from .Evaluation import _summarizeReturns
+
+
+# Draw an index from a cumulative row by inverse-CDF (first index whose cumulative probability exceeds u), as
+# sampleFromCumulativeRows does
+@njit(nogil=True, cache=True)
+def _drawFromCumulativeRow(cumRow, u):
+    index = 0
+    while index < cumRow.shape[0] - 1 and cumRow[index] <= u:
+        index += 1
+    return index
+
+
+# Simulate every sample numSimulations times on dense flattened tables, without holding the GIL
+# Follows evaluateSamplesMultiPOMDP / evaluateSamplesMultiDPOMDP on a vectorized wrapper: all trajectories advance in
+# lockstep until the horizon or until they are all done in the same step, and trajectories of episodic models keep
+# stepping past the end of an episode unless endEpisodes is set. Draws come from numba's generator, seeded by seed
+# Inputs:
+#   cumStart, cumT, cumO: Cumulative start, transition and observation tables over joint actions and observations
+#   R: (nStates, nJointActions, nStates, nJointObs) reward table
+#   notDone: (nStates, nJointActions) 0 for transitions that end the episode, 1 otherwise
+#   nodeActions: (numNodes, numSamples, nAgents) actions of each sample's controllers
+#   nextNodes: (numObs, numNodes, numSamples, nAgents) node transitions of each sample's controllers
+#   actionShape, obsShape: (nAgents,) number of actions and observations of each agent
+#   expectedRewards: (nStates, nJointActions) expected rewards to accumulate instead of sampled ones, or empty
+#   stateValues, expectedNextValues, expectedStartValue: Baseline of the control variate (see getMDPBaseline), or empty
+# Outputs:
+#   values: (numSamples, numSimulations) discounted returns
+#   martingale: (numSamples, numSimulations) baseline martingale of each rollout (0 without a baseline)
+@njit(nogil=True, cache=True)
+def _simulateSamples(cumStart, cumT, cumO, R, notDone, endEpisodes, gamma, timeHorizon, nodeActions, nextNodes, actionShape,
+                     obsShape, numSimulations, seed, expectedRewards, stateValues, expectedNextValues, expectedStartValue):
+    np.random.seed(seed)
+    numSamples, nAgents = nodeActions.shape[1], nodeActions.shape[2]
+    n = numSamples * numSimulations
+    useExpectedRewards = expectedRewards.shape[0] > 0
+    useBaseline = stateValues.shape[0] > 0
+    states = np.empty(n, dtype=np.int64)
+    nodes = np.zeros((n, nAgents), dtype=np.int64)
+    ended = np.zeros(n, dtype=np.bool_)
+    values = np.zeros(n, dtype=np.float64)
+    martingale = np.zeros(n, dtype=np.float64)
+    for k in range(n):
+        states[k] = _drawFromCumulativeRow(cumStart, np.random.random())
+        if useBaseline:
+            martingale[k] = stateValues[states[k]] - expectedStartValue
+
+    discount = 1.0
+    currentTimestep = 0
+    allDone = False
+    while not allDone and currentTimestep < timeHorizon:
+        allDone = True
+        for k in range(n):
+            if ended[k]:
+                continue
+            sample = k // numSimulations
+            s = states[k]
+            a = 0
+            for i in range(nAgents):
+                a = a * actionShape[i] + nodeActions[nodes[k, i], sample, i]
+            s1 = _drawFromCumulativeRow(cumT[s, a], np.random.random())
+            o = _drawFromCumulativeRow(cumO[s, a, s1], np.random.random())
+            values[k] += discount * (expectedRewards[s, a] if useExpectedRewards else R[s, a, s1, o])
+            if useBaseline:
+                martingale[k] += discount * gamma * (notDone[s, a] * stateValues[s1] - expectedNextValues[s, a])
+            for i in range(nAgents - 1, -1, -1):  # Unravel the joint observation
+                nodes[k, i] = nextNodes[o % obsShape[i], nodes[k, i], sample, i]
+                o //= obsShape[i]
+            states[k] = s1
+            if notDone[s, a] == 0:
+                ended[k] = endEpisodes
+            else:
+                allDone = False
+        discount *= gamma
+        currentTimestep += 1
+    return values.reshape(numSamples, numSimulations), martingale.reshape(numSamples, numSimulations)
+
+
+# Evaluate sampled controllers with the nogil kernel, from a probe of the vectorized wrapper the rollouts would use
+# Only dense models with plain uniform streams are supported (no sparse tables, random stream modes or CRN)
+# Inputs:
+#   multiEnv: VectorizedMultiPOMDP or VectorizedMultiDPOMDP built on the environment (any number of trajectories)
+#   timeHorizon: Time horizon over which to evaluate. If None, run until every trajectory is done, which needs episodes that end
+#   numSimulations: Number of simulations of each sample
+#   seed: Seed of the kernel's random generator
+#   sampledActions: (numNodes, numSamples[, numAgents]) int array of chosen actions for each node of each sample
+#   sampledNodes: (numObs, numNodes, numSamples[, numAgents]) int array of chosen node transitions for obs of each sample
+#   raoBlackwell, controlVariate: Whether to accumulate expected rewards / use the MDP control variate (see GDICEParams)
+#  Output:
+#    values: (numSamples,) discounted total returns, averaged over all simulations
+#    stdDevs: (numSamples,) standard deviations of discounted total returns over all simulations
+def evaluateSamplesKernel(multiEnv, timeHorizon, numSimulations, seed, sampledActions, sampledNodes, raoBlackwell=False, controlVariate=False):
+    env = multiEnv.env
+    assert not getattr(env, 'sparse', False), 'The evaluation kernel needs dense model tables'
+    assert multiEnv.streams.method == 'uniform' and not multiEnv.streams.antithetic, 'The evaluation kernel only draws plain uniforms'
+    singleAgent = not hasattr(env, 'agents')
+    if singleAgent:
+        sampledActions, sampledNodes = sampledActions[..., None], sampledNodes[..., None]
+        actionShape, obsShape = (env.action_space.n,), (env.observation_space.n,)
+    else:
+        actionShape, obsShape = multiEnv.actionShape, multiEnv.obsShape
+    cumStart, cumT, cumO = getCumulativeTables(env)
+    notDone = 1 - np.asarray(env.D, dtype=np.float64).reshape(cumT.shape[:2]) if env.episodic else np.ones(cumT.shape[:2])
+    expectedRewards = getExpectedRewards(env) if raoBlackwell else np.zeros((0, 0))
+    stateValues, expectedNextValues, expectedStartValue = getMDPBaseline(env)[:3] if controlVariate else (np.zeros(0), np.zeros((0, 0)), 0.0)
+    gamma = env.discount if env.discount is not None else 1
+    # The nogil loop needs an integer horizon
+    if timeHorizon is None:
+        assert multiEnv.endEpisodes and env.episodic, 'Without a timeHorizon, rollouts only stop on an episodic environment with endEpisodes'
+        timeHorizon = np.iinfo(np.int64).max
+    values, martingale = _simulateSamples(cumStart, cumT, cumO, np.ascontiguousarray(env.R, dtype=np.float64).reshape(cumO.shape), notDone,
+                                          multiEnv.endEpisodes, float(gamma), int(timeHorizon),
+                                          np.ascontiguousarray(sampledActions, dtype=np.int64), np.ascontiguousarray(sampledNodes, dtype=np.int64),
+                                          np.array(actionShape, dtype=np.int64), np.array(obsShape, dtype=np.int64), numSimulations, seed,
+                                          expectedRewards, stateValues, expectedNextValues, float(expectedStartValue))
+    return _summarizeReturns(values, martingale if controlVariate else None, axis=1)
@@ -8,8 +8,27 @@
 #   learningRate: 0-1 alpha value, learning rate at which controller shifts probabilities
 #   valueThreshold: If not None, ignore all samples with worse values, even if that means there aren't numBestSamples
 #   timeHorizon: If not None, run each sampled policy on the environment for this number of timesteps
+#   centralized: For multiple agents, whether to use one controller distribution shared by all agents
+#   commonRandomNumbers: If True, all samples of an iteration are evaluated on the same random streams (start states,
+#                        transitions, observations), so differences between samples are not masked by simulation noise
+#   horizonTolerance: If not None, cut timeHorizon to the point where the discounted tail of a rollout is provably below
+#                     this tolerance (from the discount and reward range of the environment). Must be positive
+#   raoBlackwell: If True, rollouts accumulate the expected immediate reward of each (state, action) instead of the sampled
+#                 reward, integrating out the successor state and observation (same expected value, less variance)
+#   controlVariate: If True, rollouts subtract a zero-mean control variate built from the MDP state values of the
+#                   environment, with a cross-fitted coefficient (same expected value, less variance)
+#   quasiRandom: If not None, 'stratified' or 'sobol' draws for the rollouts' start states, transitions and observations
+#                (see RandomStreams). Needs the vectorized wrapper
+#   antithetic: If True, pair the rollouts' random streams antithetically. Needs the vectorized wrapper
+#   confidenceWidth: If not None, simulate each sample in growing batches until the confidence interval of its value is
+#                    at most this wide, with numSimulationsPerSample as the cap (see evaluateSamplesSequential)
+#   chunkSize: If not None, simulate at most this many trajectories at once, merging the statistics of the chunks
+#              (see evaluateSamplesChunked). Bounds memory use regardless of numSimulationsPerSample
+#   highFidelitySimulations: If not None, numSimulationsPerSample and timeHorizon are a cheap search budget, and the
+#                            best controller found is re-evaluated with this many simulations to report its value
+#   highFidelityTimeHorizon: Time horizon of the re-evaluations. Defaults to timeHorizon
 class GDICEParams(object):
-    def __init__(self, numNodes=10, numIterations=30, numSamples=50, numSimulationsPerSample=1000, numBestSamples=5, learningRate=0.1, valueThreshold=None, timeHorizon=100, centralized=True):
+    def __init__(self, numNodes=10, numIterations=30, numSamples=50, numSimulationsPerSample=1000, numBestSamples=5, learningRate=0.1, valueThreshold=None, timeHorizon=100, centralized=True, commonRandomNumbers=False, horizonTolerance=None, raoBlackwell=False, controlVariate=False, quasiRandom=None, antithetic=False, confidenceWidth=None, chunkSize=None, highFidelitySimulations=None, highFidelityTimeHorizon=None):
         self.numNodes = numNodes
         self.numIterations = numIterations
         self.numSamples = numSamples
@@ -19,6 +38,17 @@ class GDICEParams(object):
         self.valueThreshold = valueThreshold
         self.timeHorizon = timeHorizon
         self.centralized = centralized
+        self.commonRandomNumbers = commonRandomNumbers
+        self.horizonTolerance = horizonTolerance
+        self.raoBlackwell = raoBlackwell
+        self.controlVariate = controlVariate
+        self.quasiRandom = quasiRandom
+        self.antithetic = antithetic
+        self.confidenceWidth = confidenceWidth
+        self.chunkSize = chunkSize
+        self.highFidelitySimulations = highFidelitySimulations
+        self.highFidelityTimeHorizon = highFidelityTimeHorizon
+        assert horizonTolerance is None or horizonTolerance > 0, 'horizonTolerance must be positive'
         self.buildName()
 
     # Name for use in saving files
@@ -34,6 +64,34 @@ class GDICEParams(object):
                     str(self.numSimulationsPerSample) + '_B' + str(self.numBestSamples) + '_lr' + \
                     str(self.learningRate) + '_vT' + ('None' if self.valueThreshold is None else str(self.valueThreshold)) + \
                                                                                                 '_tH' + str(self.timeHorizon)
+        # Append if evaluating with common random numbers
+        if self.commonRandomNumbers:
+            self.name += '_crn'
+        # Append if cutting the horizon at a tolerance
+        if self.horizonTolerance is not None:
+            self.name += '_eps' + str(self.horizonTolerance)
+        # Append if accumulating expected rewards
+        if self.raoBlackwell:
+            self.name += '_rb'
+        # Append if using the MDP control variate
+        if self.controlVariate:
+            self.name += '_cv'
+        # Append if using variance-reduced random streams
+        if self.quasiRandom is not None:
+            self.name += '_qmc' + self.quasiRandom
+        if self.antithetic:
+            self.name += '_anti'
+        # Append if stopping simulations at a confidence interval width
+        if self.confidenceWidth is not None:
+            self.name += '_ci' + str(self.confidenceWidth)
+        # Append if simulating in chunks
+        if self.chunkSize is not None:
+            self.name += '_chunk' + str(self.chunkSize)
+        # Append if reporting values from high-fidelity re-evaluations
+        if self.highFidelitySimulations is not None:
+            self.name += '_hf' + str(self.highFidelitySimulations)
+        if self.highFidelityTimeHorizon is not None:
+            self.name += '_hfH' + str(self.highFidelityTimeHorizon)
         # Prepend if using decentralized controllers
         if not self.centralized:
             self.name = 'De_' + self.name
@@ -49,7 +107,26 @@ class GDICEParams(object):
         self.numBestSamples = int((name.split('_B'))[1].split('_lr')[0])
         self.learningRate = float((name.split('_lr'))[1].split('_vT')[0])
         self.valueThreshold = None if (name.split('_vT'))[1].split('_tH')[0] == 'None' else float((name.split('_lr'))[1].split('_vT')[0])
-        self.timeHorizon = int((name.split('_tH'))[1])
+        self.timeHorizon = int((name.split('_tH'))[1].split('_')[0])
+        # Optional suffixes after the time horizon
+        suffixes = (name.split('_tH'))[1].split('_')[1:]
+        self.commonRandomNumbers = 'crn' in suffixes
+        tolerances = [float(suffix[len('eps'):]) for suffix in suffixes if suffix.startswith('eps')]
+        self.horizonTolerance = tolerances[0] if tolerances else None
+        assert self.horizonTolerance is None or self.horizonTolerance > 0, 'horizonTolerance must be positive'
+        self.raoBlackwell = 'rb' in suffixes
+        self.controlVariate = 'cv' in suffixes
+        quasiRandom = [suffix[len('qmc'):] for suffix in suffixes if suffix.startswith('qmc')]
+        self.quasiRandom = quasiRandom[0] if quasiRandom else None
+        self.antithetic = 'anti' in suffixes
+        widths = [float(suffix[len('ci'):]) for suffix in suffixes if suffix.startswith('ci')]
+        self.confidenceWidth = widths[0] if widths else None
+        chunkSizes = [int(suffix[len('chunk'):]) for suffix in suffixes if suffix.startswith('chunk')]
+        self.chunkSize = chunkSizes[0] if chunkSizes else None
+        highFidelityHorizons = [int(suffix[len('hfH'):]) for suffix in suffixes if suffix.startswith('hfH')]
+        self.highFidelityTimeHorizon = highFidelityHorizons[0] if highFidelityHorizons else None
+        highFidelitySimulations = [int(suffix[len('hf'):]) for suffix in suffixes if suffix.startswith('hf') and not suffix.startswith('hfH')]
+        self.highFidelitySimulations = highFidelitySimulations[0] if highFidelitySimulations else None
         self.buildName()
         return self
 
@@ -0,0 +1,49 @@
+import warnings
+import numpy as np
+from scipy.stats import qmc
+
+
+# Provider of the uniform draws consumed by the vectorized multi-trajectory wrappers (see drawUniforms in Domains)
+# Every draw is a (numDraws, numStreams) array with one column per random stream. Each entry is marginally uniform
+# in all modes, so estimates stay unbiased; the modes only change how draws are spread across streams
+# Inputs:
+#   method: 'uniform' for independent draws
+#           'stratified' to place the streams' draws in distinct strata of [0, 1) (Latin hypercube over streams)
+#           'sobol' to use a freshly scrambled Sobol point set across streams, in a random stream order
+#   antithetic: If True, pair streams (2k, 2k+1) so that the second draws 1 - u wherever the first draws u
+class RandomStreams(object):
+    def __init__(self, method='uniform', antithetic=False):
+        assert method in ('uniform', 'stratified', 'sobol')
+        self.method = method
+        self.antithetic = antithetic
+
+    # Draw uniforms for all streams
+    # Inputs:
+    #   np_random: Random generator of the environment
+    #   numDraws: Number of draws for each stream (e.g. 1 for the start state, 2 for a transition and an observation)
+    #   numStreams: Number of random streams
+    # Outputs:
+    #   uniforms: (numDraws, numStreams) nparray of uniform [0, 1) draws
+    def draw(self, np_random, numDraws, numStreams):
+        if not self.antithetic:
+            return self._drawPoints(np_random, numDraws, numStreams)
+        numPairs = numStreams // 2
+        base = self._drawPoints(np_random, numDraws, numStreams - numPairs)
+        uniforms = np.empty((numDraws, numStreams), dtype=np.float64)
+        uniforms[:, 0:2 * numPairs:2] = base[:, :numPairs]
+        uniforms[:, 1:2 * numPairs:2] = 1 - base[:, :numPairs]
+        uniforms[:, 2 * numPairs:] = base[:, numPairs:]  # Unpaired last stream if numStreams is odd
+        return np.minimum(uniforms, np.nextafter(1, 0))
+
+    def _drawPoints(self, np_random, numDraws, numPoints):
+        if self.method == 'uniform':
+            return np_random.uniform(size=(numDraws, numPoints))
+        if self.method == 'stratified':
+            strata = np.argsort(np_random.uniform(size=(numDraws, numPoints)), axis=1)
+            return (strata + np_random.uniform(size=(numDraws, numPoints))) / numPoints
+        seed = int(np_random.uniform() * (2**32 - 1))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # Point sets that are not a power of 2 lose balance, but stay uniform
+            points = qmc.Sobol(numDraws, scramble=True, seed=seed).random(numPoints)
+        order = np.argsort(np_random.uniform(size=numPoints))
+        return points[order].T
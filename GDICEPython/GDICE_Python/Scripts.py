@@ -142,11 +142,14 @@ def saveResults(baseDir, envName, testParams, results):
     savePath = os.path.join(baseDir, 'GDICEResults', envName)  # relative to current path
     os.makedirs(savePath, exist_ok=True)
     bestValue, bestValueStdDev, bestActionTransitions, bestNodeObservationTransitions, updatedControllerDistribution, \
-    estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration = results
+    estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration = results[:10]
+    # Evaluation log entries (if given) are saved with an 'eval_' prefix
+    evaluationLog = results[10] if len(results) > 10 else {}
     np.savez(os.path.join(savePath, testParams.name)+'.npz', bestValue=bestValue, bestValueStdDev=bestValueStdDev,
              bestActionTransitions=bestActionTransitions, bestNodeObservationTransitions=bestNodeObservationTransitions,
              estimatedConvergenceIteration=estimatedConvergenceIteration, allValues=allValues, allStdDev=allStdDev,
-             bestValueAtEachIteration=bestValueAtEachIteration, bestStdDevAtEachIteration=bestStdDevAtEachIteration)
+             bestValueAtEachIteration=bestValueAtEachIteration, bestStdDevAtEachIteration=bestStdDevAtEachIteration,
+             **{'eval_' + key: value for key, value in evaluationLog.items()})
     pickle.dump(updatedControllerDistribution, open(os.path.join(savePath, testParams.name)+'.pkl', 'wb'))
     pickle.dump(testParams, open(os.path.join(savePath, testParams.name+'_params') + '.pkl', 'wb'))
 
@@ -165,7 +168,8 @@ def loadResults(filePath):
     keys = ('bestValue', 'bestValueStdDev', 'bestActionTransitions', 'bestNodeObservationTransitions',
             'estimatedConvergenceIteration', 'allValues', 'allStdDev', 'bestValueAtEachIteration',
             'bestStdDevAtEachIteration')
-    results = tuple([fileDict[key] for key in keys])
+    evaluationLog = {key[len('eval_'):]: fileDict[key] for key in fileDict.files if key.startswith('eval_')}
+    results = tuple([fileDict[key] for key in keys]) + (evaluationLog,)
     updatedControllerDistribution = pickle.load(open(baseName+'.pkl', 'rb'))
     params = pickle.load(open(baseName + '_params.pkl', 'rb'))
     return results, updatedControllerDistribution, params
@@ -20,6 +20,24 @@ def sampleFromControllerDistribution(controller, numSamples, numAgents=1):
             return np.stack([controller.sampleActionFromAllNodes(numSamples) for _ in range(numAgents)], axis=-1), \
                    np.stack([controller.sampleAllObservationTransitionsFromAllNodes(numSamples) for _ in range(numAgents)], axis=-1)
 
+# Get the probability tables of controller distribution(s), laid out like one sample of sampleFromControllerDistribution
+# Agents with fewer actions than others have their action tables padded with zero-probability actions
+# Output:
+#   actionProbabilities: (numNodes, numActions[, numAgents]) probability of each action at each node (numActions is the
+#                        largest number of actions of any agent)
+#   nodeTransitionProbabilities: (numNodes, numNodes, numObs[, numAgents]) probability of each next node given node and obs
+def getControllerDistributionTables(controller, numAgents=1):
+    if isinstance(controller, (list, tuple)):
+        numActions = max(c.actionProbabilities.shape[1] for c in controller)
+        return np.stack([np.pad(c.actionProbabilities, ((0, 0), (0, numActions - c.actionProbabilities.shape[1])), 'constant')
+                         for c in controller], axis=-1), \
+               np.stack([c.nodeTransitionProbabilities for c in controller], axis=-1)
+    elif numAgents == 1:
+        return controller.actionProbabilities, controller.nodeTransitionProbabilities
+    else:
+        return np.stack([controller.actionProbabilities] * numAgents, axis=-1), \
+               np.stack([controller.nodeTransitionProbabilities] * numAgents, axis=-1)
+
 # Update controller distribution(s) using sampled actions/obs and learning rate
 def updateControllerDistribution(controller, sActions, sNodeObs, lr):
     injectedNoise = False
@@ -84,13 +102,35 @@ def _initGDICERunVariables(params):
     allStdDev = np.zeros((params.numIterations, params.numSamples), dtype=np.float64)
     estimatedConvergenceIteration = 0
     startIter = 0
+    evaluationLog = _initEvaluationLog(params)
     return bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs, estimatedConvergenceIteration, \
-    allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration, startIter, worstValueOfPreviousIteration
-
-
+    allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration, startIter, worstValueOfPreviousIteration, \
+    evaluationLog
+
+
+# Per-sample bookkeeping of how each sample was evaluated, saved alongside allValues
+#   numSimulations: (numIterations, numSamples) number of simulations spent on each sample (0 if evaluated exactly or cached)
+#   eliminated: (numIterations, numSamples) whether a sample was dropped early by racing evaluation
+#   timeHorizon: (numIterations,) horizon samples were evaluated over, after any epsilon cut. -1 for infinite horizon
+#   cacheHits: (numIterations,) number of samples served from the evaluation cache instead of being evaluated
+def _initEvaluationLog(params):
+    return {'numSimulations': np.zeros((params.numIterations, params.numSamples), dtype=np.int64),
+            'eliminated': np.zeros((params.numIterations, params.numSamples), dtype=bool),
+            'timeHorizon': np.full(params.numIterations, -1, dtype=np.int64),
+            'cacheHits': np.zeros(params.numIterations, dtype=np.int64),
+            'searchBestValue': np.full(params.numIterations, np.nan, dtype=np.float64),
+            'searchBestStdDev': np.full(params.numIterations, np.nan, dtype=np.float64),
+            'highFidelityValue': np.full(params.numIterations, np.nan, dtype=np.float64),
+            'highFidelityStdDev': np.full(params.numIterations, np.nan, dtype=np.float64)}
+
+
+# Results from older runs have no evaluation log, missing entries are filled with defaults
 def _parsePartialResultsToGDICERunVariables(params, results):
     bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs, estimatedConvergenceIteration, \
-    allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration = results
+    allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration = results[:9]
+    evaluationLog = _initEvaluationLog(params)
+    if len(results) > 9:
+        evaluationLog.update(results[9])
     startIter = np.where(np.isnan(bestValueAtEachIteration))[0][0]  # Start after last calculated value
     worstValueOfPreviousIteration = allValues[
         startIter - 1, (np.argsort(allValues[startIter - 1, :])[-params.numBestSamples:])]
@@ -105,7 +145,8 @@ def _parsePartialResultsToGDICERunVariables(params, results):
                 np.min(worstValueOfPreviousIteration[worstValueOfPreviousIteration >= params.valueThreshold])
 
     return bestValue, bestValueVariance, bestActionProbs, bestNodeTransitionProbs, estimatedConvergenceIteration, \
-    allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration, startIter, worstValueOfPreviousIteration
+    allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration, startIter, worstValueOfPreviousIteration, \
+    evaluationLog
 
 
 
@@ -13,4 +13,4 @@ if __name__ == "__main__":
     testParams = GDICEParams([10, 10], centralized=False)
     controllers = [FiniteStateControllerDistribution(testParams.numNodes[a], env.action_space[a].n, env.observation_space[a].n, True) for a in range(env.agents)]
     pool = Pool()
-    bestValue, bestValueStdDev, bestActionTransitions, bestNodeObservationTransitions, updatedControllerDistribution, estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration = runGDICEOnEnvironment(env, controllers, testParams, parallel=pool)
\ No newline at end of file
+    bestValue, bestValueStdDev, bestActionTransitions, bestNodeObservationTransitions, updatedControllerDistribution, estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration, evaluationLog = runGDICEOnEnvironment(env, controllers, testParams, parallel=pool)
\ No newline at end of file
@@ -4,10 +4,13 @@ import argparse
 import sys
 from gym_dpomdps import list_dpomdps
 from gym_pomdps import list_pomdps
-from multiprocessing import Pool
 from GDICE_Python.Parameters import GDICEParams
 from GDICE_Python.Controllers import FiniteStateControllerDistribution, DeterministicFiniteStateController
 from GDICE_Python.Algorithms import runGDICEOnEnvironment
+from GDICE_Python.Domains import sparsifyPOMDP
+from GDICE_Python.EvaluationPool import EvaluationPool
+from GDICE_Python.EvaluationStore import EvaluationStore
+from GDICE_Python.JobQueue import JobQueue
 from GDICE_Python.Scripts import getGridSearchGDICEParams, saveResults, loadResults, checkIfFinished, checkIfPartial, claimRunEnvParamSet, registerRunEnvParamSetCompletion, claimRunEnvParamSet_unfinished, registerRunEnvParamSetCompletion_unfinished
 import glob
 
@@ -16,10 +19,10 @@ def runBasicDPOMDP():
     env = gym.make(envName)
     testParams = GDICEParams([10, 10])
     controllers = [FiniteStateControllerDistribution(testParams.numNodes[a], env.action_space[a].n, env.observation_space[a].n) for a in range(env.agents)]
-    pool = Pool()
-    bestValue, bestValueStdDev, bestActionTransitions, bestNodeObservationTransitions, updatedControllerDistribution, \
-    estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration = \
-        runGDICEOnEnvironment(env, controllers, testParams, parallel=pool)
+    with EvaluationPool() as pool:
+        bestValue, bestValueStdDev, bestActionTransitions, bestNodeObservationTransitions, updatedControllerDistribution, \
+        estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration, evaluationLog = \
+            runGDICEOnEnvironment(env, controllers, testParams, parallel=pool)
 
 def runBasic():
     envName = 'POMDP-4x3-episodic-v0'
@@ -32,7 +35,7 @@ def runBasic():
     # Run GDICE. Return the best average value, its standard deviation,
     # tables of the best deterministic transitions, and the updated distribution of controllers
     bestValue, bestValueStdDev, bestActionTransitions, bestNodeObservationTransitions, updatedControllerDistribution, \
-    estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration = \
+    estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration, evaluationLog = \
         runGDICEOnEnvironment(env, controllerDistribution, testParams, parallel=pool)
 
     # Create a deterministic controller from the tables above
@@ -40,166 +43,170 @@ def runBasic():
 
     # Test on environment
 
-def runOnListFile(baseSavePath, listFilePath='POMDPsToEval.txt', injectEntropy=False):
-    # For now, can't go back to inprogress ones
-    pool = Pool()
-    pString = claimRunEnvParamSet(listFilePath)
-    while pString is not None:
-        splitPString = pString.split('/')  # {run}/{env}/{param}
-        run = splitPString[0]
-        os.makedirs(os.path.join(baseSavePath, run), exist_ok=True)
-        envName = splitPString[1]
-        params = GDICEParams().fromName(name=splitPString[2])
-        try:
-            env = gym.make(envName)
-        except MemoryError:
-            print(envName + ' too large for memory', file=sys.stderr)
-            return
-        except Exception as e:
-            print(envName + ' encountered error in creation', file=sys.stderr)
-            print(e, file=sys.stderr)
-            return
-
-        FSCDist = FiniteStateControllerDistribution(params.numNodes, env.action_space.n,
-                                                    env.observation_space.n)
-        prevResults = None
-        env.reset()
-        try:
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=pool, results=prevResults, baseDir=os.path.join(baseSavePath, run))
-        except MemoryError:
-            print(envName + ' too large for parallel processing. Switching to MultiEnv...', file=sys.stderr)
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=None, results=prevResults, baseDir=os.path.join(baseSavePath, run))
-        except Exception as e:
-            print(envName + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
-            print(e, file=sys.stderr)
-            return
-        saveResults(os.path.join(os.path.join(baseSavePath, run), 'EndResults'), envName, params, results)
-
-        # Remove from in progress
-        registerRunEnvParamSetCompletion(pString, listFilePath)
-        # Delete the temp results
-        try:
-            for filename in glob.glob(os.path.join(os.path.join(baseSavePath, run), 'GDICEResults', envName, params.name) + '*'):
-                os.remove(filename)
-        except:
-            return
-
-        # Claim next one
-        pString = claimRunEnvParamSet(listFilePath)
-
-def runOnListFile_unfinished(baseSavePath, listFilePath='POMDPsToEval.txt'):
-    pool = Pool()
-    pString = claimRunEnvParamSet_unfinished(listFilePath)
-    while pString is not None:
-        splitPString = pString.split('/')  # {run}/{env}/{param}
-        run = splitPString[0]
-        os.makedirs(os.path.join(baseSavePath, run), exist_ok=True)
-        envName = splitPString[1]
-        params = GDICEParams().fromName(name=splitPString[2])
-        try:
-            env = gym.make(envName)
-        except MemoryError:
-            print(envName + ' too large for memory', file=sys.stderr)
-            return
-        except Exception as e:
-            print(envName + ' encountered error in creation', file=sys.stderr)
-            print(e, file=sys.stderr)
-            return
-
-        wasPartiallyRun, npzFilename = checkIfPartial(envName, params.name)
-        prevResults = None
-        if wasPartiallyRun:
-            print(params.name + ' partially finished for ' + envName + ', loading...', file=sys.stderr)
-            prevResults, FSCDist = loadResults(npzFilename)[:2]
-        else:
-            FSCDist = FiniteStateControllerDistribution(params.numNodes, env.action_space.n,
-                                                        env.observation_space.n)
-        env.reset()
-        try:
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=pool, results=prevResults, baseDir=os.path.join(baseSavePath, run))
-        except MemoryError:
-            print(envName + ' too large for parallel processing. Switching to MultiEnv...', file=sys.stderr)
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=None, results=prevResults, baseDir=os.path.join(baseSavePath, run))
-        except Exception as e:
-            print(envName + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
-            print(e, file=sys.stderr)
-            return
-        saveResults(os.path.join(os.path.join(baseSavePath, run), 'EndResults'), envName, params, results)
-
-        # Remove from in progress
-        registerRunEnvParamSetCompletion(pString, listFilePath)
-        # Delete the temp results
-        try:
-            for filename in glob.glob(os.path.join(os.path.join(baseSavePath, run), 'GDICEResults', envName, params.name) + '*'):
-                os.remove(filename)
-        except:
-            return
+# Run GDICE on env, falling back to evaluating without the pool and then to sparse model tables when out of memory
+# The sparse fallback converts env's tables in place (see sparsifyPOMDP), freeing the dense ones
+# evaluationStore is an optional EvaluationStore shared by the runs and parameter sets of a save path (see getEvaluationStore)
+def runGDICEWithMemoryFallback(env, envName, FSCDist, params, pool, prevResults, baseDir, evaluationStore=None):
+    try:
+        return runGDICEOnEnvironment(env, FSCDist, params, parallel=pool, results=prevResults, baseDir=baseDir, evaluationStore=evaluationStore)
+    except MemoryError:
+        print(envName + ' too large for parallel processing. Switching to MultiEnv...', file=sys.stderr)
+    try:
+        return runGDICEOnEnvironment(env, FSCDist, params, parallel=None, results=prevResults, baseDir=baseDir, evaluationStore=evaluationStore)
+    except MemoryError:
+        if getattr(env, 'sparse', False):
+            raise
+        print(envName + ' too large for dense tables. Switching to sparse...', file=sys.stderr)
+    sparsifyPOMDP(env.unwrapped)
+    env.reset()
+    return runGDICEOnEnvironment(env, FSCDist, params, parallel=None, results=prevResults, baseDir=baseDir, evaluationStore=evaluationStore)
+
+# Evaluation store shared by every run (replicate) and parameter set under baseSavePath, or None if not storing evaluations
+# Entries are keyed by environment fingerprint and return estimator (see getEstimatorKey), so runs only share
+# evaluations of the same model made the same way. Replicates still sample and update their controller distributions
+# independently; only the value estimates of controllers that several of them sample are shared, pooled over all of
+# their simulations. Those estimates are correlated across replicates, so compare replicates by their high-fidelity
+# values (GDICEParams.highFidelitySimulations), which are always simulated afresh and never read from the store
+def getEvaluationStore(baseSavePath, useEvaluationStore):
+    return EvaluationStore(baseSavePath) if useEvaluationStore else None
+
+# Make a DPOMDP environment, falling back to sparse model tables if the dense ones don't fit in memory
+def makeDPOMDPEnv(envName):
+    try:
+        return gym.make(envName)
+    except MemoryError:
+        print(envName + ' too large for dense tables. Switching to sparse...', file=sys.stderr)
+        return gym.make(envName, sparse=True)
+
+# Fresh controller distribution for params on env: a single one for POMDPs and centralized DPOMDP controllers, one per
+# agent otherwise
+def makeControllerDistribution(env, envType, params):
+    if envType == 'POMDP':
+        return FiniteStateControllerDistribution(params.numNodes, env.action_space.n, env.observation_space.n)
+    if params.centralized:
+        return FiniteStateControllerDistribution(params.numNodes, env.action_space[0].n, env.observation_space[0].n)
+    return [FiniteStateControllerDistribution(params.numNodes, env.action_space[a].n, env.observation_space[a].n)
+            for a in range(env.agents)]
+
+# Run one {run}/{env}/{param} set of a list file or job queue and save its end results under baseSavePath/{run}
+# Inputs:
+#   pString: Claimed {run}/{env}/{param} set
+#   envType: 'POMDP' or 'DPOMDP'
+#   pool: EvaluationPool to run on
+#   evaluationStore: Optional EvaluationStore (see getEvaluationStore)
+#   resume: If True, continue from the set's temp results if it was partially run
+#  Output:
+#    Prefix of the set's temp result files (see deleteTempResults), or None if the set could not be created or run
+def runEnvParamSet(baseSavePath, pString, envType, pool, evaluationStore=None, resume=False):
+    splitPString = pString.split('/')  # {run}/{env}/{param}
+    runDir = os.path.join(baseSavePath, splitPString[0])
+    os.makedirs(runDir, exist_ok=True)
+    envName = splitPString[1]
+    params = GDICEParams().fromName(name=splitPString[2])
+    try:
+        env = gym.make(envName) if envType == 'POMDP' else makeDPOMDPEnv(envName)
+    except MemoryError:
+        print(envName + ' too large for memory', file=sys.stderr)
+        return None
+    except Exception as e:
+        print(envName + ' encountered error in creation', file=sys.stderr)
+        print(e, file=sys.stderr)
+        return None
 
-        # Claim next one
-        pString = claimRunEnvParamSet_unfinished(listFilePath)
+    wasPartiallyRun, npzFilename = checkIfPartial(envName, params.name, baseDir=runDir) if resume else (False, None)
+    prevResults = None
+    if wasPartiallyRun:
+        print(params.name + ' partially finished for ' + envName + ', loading...', file=sys.stderr)
+        prevResults, FSCDist = loadResults(npzFilename)[:2]
+    else:
+        FSCDist = makeControllerDistribution(env, envType, params)
+    env.reset()
+    try:
+        results = runGDICEWithMemoryFallback(env, envName, FSCDist, params, pool, prevResults, runDir, evaluationStore)
+    except Exception as e:
+        print(envName + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
+        print(e, file=sys.stderr)
+        return None
+    saveResults(os.path.join(runDir, 'EndResults'), envName, params, results)
+    return os.path.join(runDir, 'GDICEResults', envName, params.name)
 
-def runOnListFileDPOMDP(baseSavePath, listFilePath='DPOMDPsToEval.txt', injectEntropy=False):
+# Delete the temp results of a set once it is registered complete
+def deleteTempResults(tempResultsPrefix):
+    try:
+        for filename in glob.glob(tempResultsPrefix + '*'):
+            os.remove(filename)
+    except:
+        pass
+
+# Run the sets of a list file until none are left to claim, or until a set fails
+# claimFn and registerFn claim a set from the list and register its completion (see Scripts.claimRunEnvParamSet)
+def runSetsOnListFile(baseSavePath, listFilePath, envType, claimFn, registerFn, resume=False, useEvaluationStore=False, sharedMemory=False):
+    with EvaluationPool(sharedMemory=sharedMemory) as pool:
+        evaluationStore = getEvaluationStore(baseSavePath, useEvaluationStore)
+        pString = claimFn(listFilePath)
+        while pString is not None:
+            tempResultsPrefix = runEnvParamSet(baseSavePath, pString, envType, pool, evaluationStore, resume)
+            if tempResultsPrefix is None:
+                return
+            # Remove from in progress
+            registerFn(pString, listFilePath)
+            deleteTempResults(tempResultsPrefix)
+            # Claim next one
+            pString = claimFn(listFilePath)
+
+def runOnListFile(baseSavePath, listFilePath='POMDPsToEval.txt', injectEntropy=False, useEvaluationStore=False, sharedMemory=False):
     # For now, can't go back to inprogress ones
-    pool = Pool()
-    pString = claimRunEnvParamSet(listFilePath)
-    while pString is not None:
-        splitPString = pString.split('/')  # {run}/{env}/{param}
-        run = splitPString[0]
-        os.makedirs(os.path.join(baseSavePath, run), exist_ok=True)
-        envName = splitPString[1]
-        params = GDICEParams().fromName(name=splitPString[2])
-        try:
-            env = gym.make(envName)
-        except MemoryError:
-            print(envName + ' too large for memory', file=sys.stderr)
-            return
-        except Exception as e:
-            print(envName + ' encountered error in creation', file=sys.stderr)
-            print(e, file=sys.stderr)
-            return
+    runSetsOnListFile(baseSavePath, listFilePath, 'POMDP', claimRunEnvParamSet, registerRunEnvParamSetCompletion,
+                      useEvaluationStore=useEvaluationStore, sharedMemory=sharedMemory)
 
-        if params.centralized:
-            FSCDist = FiniteStateControllerDistribution(params.numNodes, env.action_space[0].n,
-                                                        env.observation_space[0].n)
-        else:
-            FSCDist = [FiniteStateControllerDistribution(params.numNodes, env.action_space[a].n,
-                                                         env.observation_space[a].n) for a in range(env.agents)]
-        prevResults = None
-        env.reset()
-        try:
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=pool, results=prevResults, baseDir=os.path.join(baseSavePath, run))
-        except MemoryError:
-            print(envName + ' too large for parallel processing. Switching to MultiEnv...', file=sys.stderr)
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=None, results=prevResults, baseDir=os.path.join(baseSavePath, run))
-        except Exception as e:
-            print(envName + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
-            print(e, file=sys.stderr)
-            return
-        saveResults(os.path.join(os.path.join(baseSavePath, run), 'EndResults'), envName, params, results)
+def runOnListFile_unfinished(baseSavePath, listFilePath='POMDPsToEval.txt', useEvaluationStore=False, sharedMemory=False):
+    runSetsOnListFile(baseSavePath, listFilePath, 'POMDP', claimRunEnvParamSet_unfinished, registerRunEnvParamSetCompletion,
+                      resume=True, useEvaluationStore=useEvaluationStore, sharedMemory=sharedMemory)
 
-        # Remove from in progress
-        registerRunEnvParamSetCompletion(pString, listFilePath)
-        # Delete the temp results
-        try:
-            for filename in glob.glob(os.path.join(os.path.join(baseSavePath, run), 'GDICEResults', envName, params.name) + '*'):
-                os.remove(filename)
-        except:
-            return
-
-        # Claim next one
-        pString = claimRunEnvParamSet(listFilePath)
+def runOnListFileDPOMDP(baseSavePath, listFilePath='DPOMDPsToEval.txt', injectEntropy=False, useEvaluationStore=False, sharedMemory=False):
+    # For now, can't go back to inprogress ones
+    runSetsOnListFile(baseSavePath, listFilePath, 'DPOMDP', claimRunEnvParamSet, registerRunEnvParamSetCompletion,
+                      useEvaluationStore=useEvaluationStore, sharedMemory=sharedMemory)
 
 # Clean up unfinished runs
-def runOnListFileDPOMDP_unfinished(baseSavePath, listFilePath='DPOMDPsToEval.txt'):
-    # For now, can't go back to inprogress ones
-    pool = Pool()
-    pString = claimRunEnvParamSet_unfinished(listFilePath)
-    while pString is not None:
-        splitPString = pString.split('/')  # {run}/{env}/{param}
-        run = splitPString[0]
-        os.makedirs(os.path.join(baseSavePath, run), exist_ok=True)
-        envName = splitPString[1]
-        params = GDICEParams().fromName(name=splitPString[2])
+def runOnListFileDPOMDP_unfinished(baseSavePath, listFilePath='DPOMDPsToEval.txt', useEvaluationStore=False, sharedMemory=False):
+    runSetsOnListFile(baseSavePath, listFilePath, 'DPOMDP', claimRunEnvParamSet_unfinished, registerRunEnvParamSetCompletion_unfinished,
+                      resume=True, useEvaluationStore=useEvaluationStore, sharedMemory=sharedMemory)
+
+
+# Put a set that could not be run back on the queue, unless it used up its attempts
+def releaseJobQueueSet(queue, pString):
+    if queue.release(pString) == 'failed':
+        print(pString + ' failed ' + str(queue.maxAttempts) + ' times, marking it failed', file=sys.stderr)
+
+# Run the sets of a job queue (see JobQueue), claiming batchSize sets at a time and holding their leases while they run
+# Sets left by jobs that died are claimed again once their lease expires, resuming from their temp results
+def runOnJobQueue(baseSavePath, queueFilePath='POMDPsToEval.db', envType='POMDP', batchSize=1, useEvaluationStore=False, sharedMemory=False):
+    with EvaluationPool(sharedMemory=sharedMemory) as pool:
+        evaluationStore = getEvaluationStore(baseSavePath, useEvaluationStore)
+        queue = JobQueue(queueFilePath)
+        pStrings = queue.claim(batchSize)
+        while pStrings:
+            with queue.keepAlive(pStrings):
+                for pString in pStrings:
+                    tempResultsPrefix = runEnvParamSet(baseSavePath, pString, envType, pool, evaluationStore, resume=True)
+                    if tempResultsPrefix is None:
+                        releaseJobQueueSet(queue, pString)
+                        continue
+                    if not queue.complete(pString):
+                        print(pString + ' was claimed by another job while running, leaving it to that job', file=sys.stderr)
+                        continue  # Its temp results are the other job's now
+                    deleteTempResults(tempResultsPrefix)
+
+            # Claim next ones
+            pStrings = queue.claim(batchSize)
+
+
+def runGridSearchOnOneEnv(baseSavePath, envName, useEvaluationStore=False, sharedMemory=False):
+    #pool = None
+    with EvaluationPool(sharedMemory=sharedMemory) as pool:
+        evaluationStore = getEvaluationStore(baseSavePath, useEvaluationStore)
+        GDICEList = getGridSearchGDICEParams()[1]
         try:
             env = gym.make(envName)
         except MemoryError:
@@ -210,256 +217,194 @@ def runOnListFileDPOMDP_unfinished(baseSavePath, listFilePath='DPOMDPsToEval.txt
             print(e, file=sys.stderr)
             return
 
-        wasPartiallyRun, npzFilename = checkIfPartial(envName, params.name)
-        prevResults = None
-        if wasPartiallyRun:
-            print(params.name + ' partially finished for ' + envName + ', loading...', file=sys.stderr)
-            prevResults, FSCDist = loadResults(npzFilename)[:2]
-        else:
-            if params.centralized:
-                FSCDist = FiniteStateControllerDistribution(params.numNodes, env.action_space[0].n,
-                                                            env.observation_space[0].n)
-            else:
-                FSCDist = [FiniteStateControllerDistribution(params.numNodes, env.action_space[a].n,
-                                                             env.observation_space[a].n) for a in range(env.agents)]
-        env.reset()
-        try:
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=pool, results=prevResults, baseDir=os.path.join(baseSavePath, run))
-        except MemoryError:
-            print(envName + ' too large for parallel processing. Switching to MultiEnv...', file=sys.stderr)
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=None, results=prevResults, baseDir=os.path.join(baseSavePath, run))
-        except Exception as e:
-            print(envName + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
-            print(e, file=sys.stderr)
-            return
-        saveResults(os.path.join(os.path.join(baseSavePath, run), 'EndResults'), envName, params, results)
-
-        # Remove from in progress
-        registerRunEnvParamSetCompletion_unfinished(pString, listFilePath)
-        # Delete the temp results
-        try:
-            for filename in glob.glob(os.path.join(os.path.join(baseSavePath, run), 'GDICEResults', envName, params.name) + '*'):
-                os.remove(filename)
-        except:
-            return
-
-        # Claim next one
-        pString = claimRunEnvParamSet_unfinished(listFilePath)
-
-
-def runGridSearchOnOneEnv(baseSavePath, envName):
-    #pool = None
-    pool = Pool()
-    GDICEList = getGridSearchGDICEParams()[1]
-    try:
-        env = gym.make(envName)
-    except MemoryError:
-        print(envName + ' too large for memory', file=sys.stderr)
-        return
-    except Exception as e:
-        print(envName + ' encountered error in creation', file=sys.stderr)
-        print(e, file=sys.stderr)
-        return
-
-    for params in GDICEList:
-        # Skip this permutation if we already have final results
-        if checkIfFinished(envName, params.name, baseDir=baseSavePath)[0]:
-            print(params.name + ' already finished for ' + envName + ', skipping...', file=sys.stderr)
-            continue
-        wasPartiallyRun, npzFilename = checkIfPartial(envName, params.name)
-        prevResults = None
-        if wasPartiallyRun:
-            print(params.name + ' partially finished for ' + envName + ', loading...', file=sys.stderr)
-            prevResults, FSCDist = loadResults(npzFilename)[:2]
-        else:
-            FSCDist = FiniteStateControllerDistribution(params.numNodes, env.action_space.n,
-                                                        env.observation_space.n)
-        env.reset()
-        try:
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=pool, results=prevResults, baseDir=baseSavePath)
-        except MemoryError:
-            print(envName + ' too large for parallel processing. Switching to MultiEnv...', file=sys.stderr)
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=None, results=prevResults, baseDir=baseSavePath)
-        except Exception as e:
-            print(envName + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
-            print(e, file=sys.stderr)
-            continue
-        saveResults(os.path.join(baseSavePath, 'EndResults'), envName, params, results)
-        # Delete the temp results
-        try:
-            for filename in glob.glob(os.path.join(baseSavePath, 'GDICEResults', envName, params.name)+'*'):
-                os.remove(filename)
-        except:
-            continue
-
-
-# Run a grid search on all registered environments
-def runGridSearchOnAllEnv(baseSavePath):
-    pool = Pool()
-    envList, GDICEList = getGridSearchGDICEParams()
-    for envStr in envList:
-        try:
-            env = gym.make(envStr)
-        except MemoryError:
-            print(envStr + ' too large for memory', file=sys.stderr)
-            continue
-        except Exception as e:
-            print(envStr + ' encountered error in creation, skipping', file=sys.stderr)
-            print(e, file=sys.stderr)
-            continue
         for params in GDICEList:
             # Skip this permutation if we already have final results
-            if checkIfFinished(envStr, params.name, baseDir=baseSavePath)[0]:
-                print(params.name +' already finished for ' +envStr+ ', skipping...', file=sys.stderr)
+            if checkIfFinished(envName, params.name, baseDir=baseSavePath)[0]:
+                print(params.name + ' already finished for ' + envName + ', skipping...', file=sys.stderr)
                 continue
-
-            wasPartiallyRun, npzFilename = checkIfPartial(envStr, params.name)
+            wasPartiallyRun, npzFilename = checkIfPartial(envName, params.name)
             prevResults = None
             if wasPartiallyRun:
-                print(params.name + ' partially finished for ' + envStr + ', loading...', file=sys.stderr)
+                print(params.name + ' partially finished for ' + envName + ', loading...', file=sys.stderr)
                 prevResults, FSCDist = loadResults(npzFilename)[:2]
             else:
-                FSCDist = FiniteStateControllerDistribution(params.numNodes, env.action_space.n,
-                                                            env.observation_space.n)
+                FSCDist = makeControllerDistribution(env, 'POMDP', params)
             env.reset()
             try:
-                results = runGDICEOnEnvironment(env, FSCDist, params, parallel=pool, results=prevResults, baseDir=baseSavePath)
-            except MemoryError:
-                print(envStr + ' too large for parallel processing. Switching to MultiEnv...', file=sys.stderr)
-                results = runGDICEOnEnvironment(env, FSCDist, params, parallel=None, results=prevResults, baseDir=baseSavePath)
+                results = runGDICEWithMemoryFallback(env, envName, FSCDist, params, pool, prevResults, baseSavePath, evaluationStore)
             except Exception as e:
-                print(envStr + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
+                print(envName + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
                 print(e, file=sys.stderr)
                 continue
-
-            saveResults(os.path.join(baseSavePath, 'EndResults'), envStr, params, results)
+            saveResults(os.path.join(baseSavePath, 'EndResults'), envName, params, results)
             # Delete the temp results
             try:
-                for filename in glob.glob(os.path.join(baseSavePath, 'GDICEResults', envStr, params.name) + '*'):
+                for filename in glob.glob(os.path.join(baseSavePath, 'GDICEResults', envName, params.name)+'*'):
                     os.remove(filename)
             except:
                 continue
 
-def runGridSearchOnOneEnvDPOMDP(baseSavePath, envName):
-    #pool = None
-    pool = Pool()
-    GDICEList = getGridSearchGDICEParams()[1]
-    try:
-        env = gym.make(envName)
-    except MemoryError:
-        print(envName + ' too large for memory', file=sys.stderr)
-        return
-    except Exception as e:
-        print(envName + ' encountered error in creation', file=sys.stderr)
-        print(e, file=sys.stderr)
-        return
-
-    for params in GDICEList:
-        # Skip this permutation if we already have final results
-        if checkIfFinished(envName, params.name, baseDir=baseSavePath)[0]:
-            print(params.name + ' already finished for ' + envName + ', skipping...', file=sys.stderr)
-            continue
-        wasPartiallyRun, npzFilename = checkIfPartial(envName, params.name)
-        prevResults = None
-        if wasPartiallyRun:
-            print(params.name + ' partially finished for ' + envName + ', loading...', file=sys.stderr)
-            prevResults, FSCDist = loadResults(npzFilename)[:2]
-        else:
-            if params.centralized:
-                FSCDist = FiniteStateControllerDistribution(params.numNodes, env.action_space[0].n,
-                                                            env.observation_space[0].n)
-            else:
-                FSCDist = [FiniteStateControllerDistribution(params.numNodes, env.action_space[a].n,
-                                                            env.observation_space[a].n) for a in range(env.agents)]
-        env.reset()
-        try:
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=pool, results=prevResults, baseDir=baseSavePath)
-        except MemoryError:
-            print(envName + ' too large for parallel processing. Switching to MultiEnv...', file=sys.stderr)
-            results = runGDICEOnEnvironment(env, FSCDist, params, parallel=None, results=prevResults, baseDir=baseSavePath)
-        except Exception as e:
-            print(envName + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
-            print(e, file=sys.stderr)
-            continue
-        saveResults(os.path.join(baseSavePath, 'EndResults'), envName, params, results)
-        # Delete the temp results
-        try:
-            for filename in glob.glob(os.path.join(baseSavePath, 'GDICEResults', envName, params.name)+'*'):
-                os.remove(filename)
-        except:
-            continue
-
 
 # Run a grid search on all registered environments
-def runGridSearchOnAllEnvDPOMDP(baseSavePath):
-    pool = Pool()
-    envList, GDICEList = getGridSearchGDICEParams()
-    for envStr in envList:
+def runGridSearchOnAllEnv(baseSavePath, useEvaluationStore=False, sharedMemory=False):
+    with EvaluationPool(sharedMemory=sharedMemory) as pool:
+        evaluationStore = getEvaluationStore(baseSavePath, useEvaluationStore)
+        envList, GDICEList = getGridSearchGDICEParams()
+        for envStr in envList:
+            try:
+                env = gym.make(envStr)
+            except MemoryError:
+                print(envStr + ' too large for memory', file=sys.stderr)
+                continue
+            except Exception as e:
+                print(envStr + ' encountered error in creation, skipping', file=sys.stderr)
+                print(e, file=sys.stderr)
+                continue
+            for params in GDICEList:
+                # Skip this permutation if we already have final results
+                if checkIfFinished(envStr, params.name, baseDir=baseSavePath)[0]:
+                    print(params.name +' already finished for ' +envStr+ ', skipping...', file=sys.stderr)
+                    continue
+
+                wasPartiallyRun, npzFilename = checkIfPartial(envStr, params.name)
+                prevResults = None
+                if wasPartiallyRun:
+                    print(params.name + ' partially finished for ' + envStr + ', loading...', file=sys.stderr)
+                    prevResults, FSCDist = loadResults(npzFilename)[:2]
+                else:
+                    FSCDist = makeControllerDistribution(env, 'POMDP', params)
+                env.reset()
+                try:
+                    results = runGDICEWithMemoryFallback(env, envStr, FSCDist, params, pool, prevResults, baseSavePath, evaluationStore)
+                except Exception as e:
+                    print(envStr + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
+                    print(e, file=sys.stderr)
+                    continue
+
+                saveResults(os.path.join(baseSavePath, 'EndResults'), envStr, params, results)
+                # Delete the temp results
+                try:
+                    for filename in glob.glob(os.path.join(baseSavePath, 'GDICEResults', envStr, params.name) + '*'):
+                        os.remove(filename)
+                except:
+                    continue
+
+def runGridSearchOnOneEnvDPOMDP(baseSavePath, envName, useEvaluationStore=False, sharedMemory=False):
+    #pool = None
+    with EvaluationPool(sharedMemory=sharedMemory) as pool:
+        evaluationStore = getEvaluationStore(baseSavePath, useEvaluationStore)
+        GDICEList = getGridSearchGDICEParams()[1]
         try:
-            env = gym.make(envStr)
+            env = makeDPOMDPEnv(envName)
         except MemoryError:
-            print(envStr + ' too large for memory', file=sys.stderr)
-            continue
+            print(envName + ' too large for memory', file=sys.stderr)
+            return
         except Exception as e:
-            print(envStr + ' encountered error in creation, skipping', file=sys.stderr)
+            print(envName + ' encountered error in creation', file=sys.stderr)
             print(e, file=sys.stderr)
-            continue
+            return
+
         for params in GDICEList:
             # Skip this permutation if we already have final results
-            if checkIfFinished(envStr, params.name, baseDir=baseSavePath)[0]:
-                print(params.name +' already finished for ' +envStr+ ', skipping...', file=sys.stderr)
+            if checkIfFinished(envName, params.name, baseDir=baseSavePath)[0]:
+                print(params.name + ' already finished for ' + envName + ', skipping...', file=sys.stderr)
                 continue
-
-            wasPartiallyRun, npzFilename = checkIfPartial(envStr, params.name)
+            wasPartiallyRun, npzFilename = checkIfPartial(envName, params.name)
             prevResults = None
             if wasPartiallyRun:
-                print(params.name + ' partially finished for ' + envStr + ', loading...', file=sys.stderr)
+                print(params.name + ' partially finished for ' + envName + ', loading...', file=sys.stderr)
                 prevResults, FSCDist = loadResults(npzFilename)[:2]
             else:
-                if params.centralized:
-                    FSCDist = FiniteStateControllerDistribution(params.numNodes, env.action_space[0].n,
-                                                                env.observation_space[0].n)
-                else:
-                    FSCDist = [FiniteStateControllerDistribution(params.numNodes, env.action_space[a].n,
-                                                                 env.observation_space[a].n) for a in range(env.agents)]
+                FSCDist = makeControllerDistribution(env, 'DPOMDP', params)
             env.reset()
             try:
-                results = runGDICEOnEnvironment(env, FSCDist, params, parallel=pool, results=prevResults, baseDir=baseSavePath)
-            except MemoryError:
-                print(envStr + ' too large for parallel processing. Switching to MultiEnv...', file=sys.stderr)
-                results = runGDICEOnEnvironment(env, FSCDist, params, parallel=None, results=prevResults, baseDir=baseSavePath)
+                results = runGDICEWithMemoryFallback(env, envName, FSCDist, params, pool, prevResults, baseSavePath, evaluationStore)
             except Exception as e:
-                print(envStr + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
+                print(envName + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
                 print(e, file=sys.stderr)
                 continue
-
-            saveResults(os.path.join(baseSavePath, 'EndResults'), envStr, params, results)
+            saveResults(os.path.join(baseSavePath, 'EndResults'), envName, params, results)
             # Delete the temp results
             try:
-                for filename in glob.glob(os.path.join(baseSavePath, 'GDICEResults', envStr, params.name) + '*'):
+                for filename in glob.glob(os.path.join(baseSavePath, 'GDICEResults', envName, params.name)+'*'):
                     os.remove(filename)
             except:
                 continue
 
 
+# Run a grid search on all registered environments
+def runGridSearchOnAllEnvDPOMDP(baseSavePath, useEvaluationStore=False, sharedMemory=False):
+    with EvaluationPool(sharedMemory=sharedMemory) as pool:
+        evaluationStore = getEvaluationStore(baseSavePath, useEvaluationStore)
+        envList, GDICEList = getGridSearchGDICEParams()
+        for envStr in envList:
+            try:
+                env = makeDPOMDPEnv(envStr)
+            except MemoryError:
+                print(envStr + ' too large for memory', file=sys.stderr)
+                continue
+            except Exception as e:
+                print(envStr + ' encountered error in creation, skipping', file=sys.stderr)
+                print(e, file=sys.stderr)
+                continue
+            for params in GDICEList:
+                # Skip this permutation if we already have final results
+                if checkIfFinished(envStr, params.name, baseDir=baseSavePath)[0]:
+                    print(params.name +' already finished for ' +envStr+ ', skipping...', file=sys.stderr)
+                    continue
+
+                wasPartiallyRun, npzFilename = checkIfPartial(envStr, params.name)
+                prevResults = None
+                if wasPartiallyRun:
+                    print(params.name + ' partially finished for ' + envStr + ', loading...', file=sys.stderr)
+                    prevResults, FSCDist = loadResults(npzFilename)[:2]
+                else:
+                    FSCDist = makeControllerDistribution(env, 'DPOMDP', params)
+                env.reset()
+                try:
+                    results = runGDICEWithMemoryFallback(env, envStr, FSCDist, params, pool, prevResults, baseSavePath, evaluationStore)
+                except Exception as e:
+                    print(envStr + ' encountered error in runnning' + params.name + ', skipping to next param', file=sys.stderr)
+                    print(e, file=sys.stderr)
+                    continue
+
+                saveResults(os.path.join(baseSavePath, 'EndResults'), envStr, params, results)
+                # Delete the temp results
+                try:
+                    for filename in glob.glob(os.path.join(baseSavePath, 'GDICEResults', envStr, params.name) + '*'):
+                        os.remove(filename)
+                except:
+                    continue
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Choose save dir and environment')
     parser.add_argument('--save_path', type=str, default='/scratch/slayback.d/GDICE', help='Base save path')
     parser.add_argument('--env_name', type=str, default='', help='Environment to run')
     parser.add_argument('--env_type', type=str, default='POMDP', help='Environment type to run')
     parser.add_argument('--set_list', type=str, default='', help='If provided, uses a list of run/env/param sets instead')
+    parser.add_argument('--job_queue', type=str, default='', help='If provided, claims run/env/param sets from this job queue database instead (importing --set_list into it, if given)')
+    parser.add_argument('--batch_size', type=int, default=1, help='Number of sets to claim at once from the job queue')
+    parser.add_argument('--import_only', action='store_true', help='Only import --set_list into --job_queue, once before submitting the jobs that claim from it')
+    parser.add_argument('--evaluation_store', action='store_true', help='Store controller evaluations under the save path and reuse them across runs and parameter sets')
+    parser.add_argument('--shared_memory', action='store_true', help='Share the model tables with the evaluation workers instead of giving each worker a copy')
     args = parser.parse_args()
-    if not args.set_list:
+    if args.job_queue:
+        if args.set_list:
+            JobQueue(args.job_queue).importListFile(args.set_list)
+        if not args.import_only:
+            runOnJobQueue(args.save_path, args.job_queue, args.env_type, args.batch_size, args.evaluation_store, args.shared_memory)
+    elif not args.set_list:
         runAllFn = runGridSearchOnAllEnv if args.env_name == 'POMDP' else runGridSearchOnAllEnvDPOMDP
         runOneFn = runGridSearchOnOneEnv if args.env_name == 'POMDP' else runGridSearchOnOneEnvDPOMDP
         baseSavePath = args.save_path
         if not args.env_name:
-            runAllFn(baseSavePath)
+            runAllFn(baseSavePath, args.evaluation_store, args.shared_memory)
         else:
-            runOneFn(baseSavePath, args.env_name)
+            runOneFn(baseSavePath, args.env_name, args.evaluation_store, args.shared_memory)
     else:
         useEntropy = False
         runFn = runOnListFile if args.env_type =='POMDP' else runOnListFileDPOMDP
         if args.set_list.startswith('Ent'):
             useEntropy = True
-        runFn(args.save_path, args.set_list, injectEntropy=useEntropy)
+        runFn(args.save_path, args.set_list, injectEntropy=useEntropy, useEvaluationStore=args.evaluation_store, sharedMemory=args.shared_memory)
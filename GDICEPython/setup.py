@@ -5,6 +5,8 @@ setup(
     name='GDICE_Python',
     version='0.1.2',
     packages=find_packages(),
-    install_requires=['numpy', 'gym', 'rl_parsers', 'gym_pomdps', 'gym_dpomdps', 'filelock'],
+    install_requires=['numpy', 'scipy', 'gym', 'rl_parsers', 'gym_pomdps', 'gym_dpomdps', 'filelock'],
+    extras_require={'threads': ['numba']},
+    test_suite='tests',
     scripts=['testUAV.py', 'generalGDICE.py', 'cleanTempResults.py', 'clearFinalResults.py', 'PlottingScript.py']
 )
\ No newline at end of file
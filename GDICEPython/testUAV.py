@@ -15,7 +15,7 @@ def runDomain(env, testParams):
     # Run GDICE. Return the best average value, its standard deviation,
     # tables of the best deterministic transitions, and the updated distribution of controllers
     bestValue, bestValueStdDev, bestActionTransitions, bestNodeObservationTransitions, updatedControllerDistribution, \
-    estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration = \
+    estimatedConvergenceIteration, allValues, allStdDev, bestValueAtEachIteration, bestStdDevAtEachIteration, evaluationLog = \
         runGDICEOnEnvironment(env, controllerDistribution, testParams, parallel=pool, envType=1)
 
     # Create a deterministic controller from the tables above
@@ -0,0 +1,7 @@
+import numpy as np
+
+
+# Random deterministic controllers, (numNodes, numSamples[, nAgents]) actions and (numObs, numNodes, numSamples[, nAgents]) nodes
+def randomControllers(rng, numNodes, numSamples, nActions, nObs, nAgents=None):
+    shape = (numSamples,) if nAgents is None else (numSamples, nAgents)
+    return rng.randint(nActions, size=(numNodes,) + shape), rng.randint(numNodes, size=(nObs, numNodes) + shape)
@@ -0,0 +1,50 @@
+import unittest
+
+import gym
+import gym_pomdps
+
+import numpy as np
+
+from GDICE_Python.Algorithms import runGDICEOnEnvironment, _reevaluateCandidates
+from GDICE_Python.Controllers import FiniteStateControllerDistribution
+from GDICE_Python.Parameters import GDICEParams
+
+
+class TwoTierGDICE_Test(unittest.TestCase):
+    def runTwoTier(self, **kwargs):
+        env = gym.make('POMDP-tiger-v0')
+        env.seed(0)
+        np.random.seed(0)
+        params = GDICEParams(numNodes=3, numIterations=6, numSamples=10, numSimulationsPerSample=20, timeHorizon=20,
+                             highFidelitySimulations=200)
+        controller = FiniteStateControllerDistribution(params.numNodes, env.action_space.n, env.observation_space.n)
+        return runGDICEOnEnvironment(env, controller, params, saveFrequency=0, envType=2, **kwargs)
+
+    # The reported best is the latest high-fidelity value, updated in the iteration the search best changes
+    def test_reevaluate_when_search_best_changes(self):
+        results = self.runTwoTier()
+        bestValueAtEachIteration, evaluationLog = results[8], results[10]
+        searchBestValue, highFidelityValue = evaluationLog['searchBestValue'], evaluationLog['highFidelityValue']
+        searchBestChanged = np.concatenate(([True], searchBestValue[1:] != searchBestValue[:-1]))
+        np.testing.assert_array_equal(~np.isnan(highFidelityValue), searchBestChanged)
+        latestReevaluation = np.maximum.accumulate(np.where(searchBestChanged, np.arange(searchBestChanged.size), 0))
+        np.testing.assert_array_equal(bestValueAtEachIteration, highFidelityValue[latestReevaluation])
+        self.assertEqual(results[0], bestValueAtEachIteration[-1])
+
+    # The previous best is re-evaluated with the candidates, so its stored (lucky) value is never compared or reported
+    def test_reevaluate_incumbent(self):
+        reevaluateFn = lambda actions, nodes: (actions[0].astype(np.float64), np.zeros(actions.shape[1]))  # True value is node 0's action
+        nodes = np.zeros((2, 3, 1), dtype=int)
+        for incumbentAction, expectedValue in ((0, 1.0), (2, 2.0)):
+            evaluationLog = {'highFidelityValue': np.full(1, np.nan), 'highFidelityStdDev': np.full(1, np.nan)}
+            incumbentActions = np.full(3, incumbentAction)
+            res = _reevaluateCandidates(reevaluateFn, np.ones((3, 1), dtype=int), nodes, 100.0, 0.0, incumbentActions, nodes[:, :, 0],
+                                        evaluationLog, 0)
+            self.assertEqual(res[0], expectedValue)
+            self.assertEqual(res[2][0], expectedValue)
+            self.assertEqual(evaluationLog['highFidelityValue'][0], expectedValue)
+
+    def test_reevaluate_frequency(self):
+        evaluationLog = self.runTwoTier(reevaluateFrequency=3)[10]
+        reevaluated = np.nonzero(~np.isnan(evaluationLog['highFidelityValue']))[0]
+        self.assertTrue(reevaluated.size > 0 and np.all((reevaluated + 1) % 3 == 0))
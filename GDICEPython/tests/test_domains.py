@@ -0,0 +1,74 @@
+import unittest
+
+import gym
+import gym_pomdps
+import gym_dpomdps
+
+import numpy as np
+
+from GDICE_Python.Domains import MultiPOMDP, VectorizedMultiPOMDP, VectorizedMultiDPOMDP
+from GDICE_Python.Evaluation import evaluateSampleMultiPOMDP, evaluateSampleMultiDPOMDP
+
+from .controllers import randomControllers
+
+
+class VectorizedWrappers_Test(unittest.TestCase):
+    numTrajectories = 4000
+    timeHorizon = 20
+
+    # Means of two sets of returns agree within 5 standard errors of their difference
+    def assertSameMean(self, stats1, stats2):
+        standardError = np.sqrt((stats1[1] ** 2 + stats2[1] ** 2) / self.numTrajectories)
+        self.assertLessEqual(abs(stats1[0] - stats2[0]), 5 * standardError + 1e-9)
+
+    def assertSameReturnsPOMDP(self, envName):
+        env = gym.make(envName)
+        env.seed(3)
+        actions, nodes = randomControllers(np.random.RandomState(0), 4, 1, env.action_space.n, env.observation_space.n)
+        actions, nodes = actions[:, 0], nodes[:, :, 0]
+        stats = evaluateSampleMultiPOMDP(MultiPOMDP(env, self.numTrajectories), self.timeHorizon, actions, nodes)
+        vectorizedStats = evaluateSampleMultiPOMDP(VectorizedMultiPOMDP(env, self.numTrajectories), self.timeHorizon, actions, nodes)
+        self.assertSameMean(stats, vectorizedStats)
+
+    def test_same_returns_pomdp(self):
+        self.assertSameReturnsPOMDP('POMDP-tiger-v0')
+
+    def test_same_returns_episodic_pomdp(self):
+        self.assertSameReturnsPOMDP('POMDP-4x3-episodic-v0')
+
+    def test_same_returns_episodic_dpomdp(self):
+        env = gym.make('DPOMDP-dectiger-episodic-v0')
+        env.seed(3)
+        actions, nodes = randomControllers(np.random.RandomState(0), 3, 1, env.action_space[0].n, env.observation_space[0].n, env.agents)
+        actions, nodes = actions[:, 0], nodes[:, :, 0]
+        stats = evaluateSampleMultiDPOMDP(gym_dpomdps.MultiDPOMDP(env, self.numTrajectories), self.timeHorizon, actions, nodes)
+        vectorizedStats = evaluateSampleMultiDPOMDP(VectorizedMultiDPOMDP(env, self.numTrajectories), self.timeHorizon, actions, nodes)
+        self.assertSameMean(stats, vectorizedStats)
+
+    def test_same_state_distribution(self):
+        env = gym.make('POMDP-4x3-episodic-v0')
+        env.seed(5)
+        nStates = env.state_space.n
+        multiEnv = MultiPOMDP(env, self.numTrajectories)
+        vectorizedEnv = VectorizedMultiPOMDP(env, self.numTrajectories)
+        rng = np.random.RandomState(1)
+        for timestep in range(10):
+            actions = np.full(self.numTrajectories, rng.randint(env.action_space.n))
+            done = multiEnv.step(actions)[2]
+            vectorizedDone = vectorizedEnv.step(actions)[2]
+            self.assertTrue(np.all(vectorizedEnv.state >= 0))  # Episodes do not end by default
+            frequencies = np.bincount(multiEnv.state, minlength=nStates) / self.numTrajectories
+            vectorizedFrequencies = np.bincount(vectorizedEnv.state, minlength=nStates) / self.numTrajectories
+            tolerance = 5 * np.sqrt(2 * np.maximum(frequencies, 1 / self.numTrajectories) / self.numTrajectories)
+            self.assertTrue(np.all(np.abs(frequencies - vectorizedFrequencies) <= tolerance))
+            self.assertLessEqual(abs(done.mean() - vectorizedDone.mean()), 5 * np.sqrt(0.5 / self.numTrajectories))
+
+    def test_end_episodes(self):
+        env = gym.make('POMDP-4x3-episodic-v0')
+        multiEnv = VectorizedMultiPOMDP(env, 200, endEpisodes=True)
+        ended = np.zeros(200, dtype=bool)
+        for timestep in range(50):
+            obs, rewards, done = multiEnv.step(np.zeros(200, dtype=int))[:3]
+            self.assertTrue(np.all(rewards[ended] == 0) and np.all(obs[ended] == -1))
+            ended |= done
+            self.assertTrue(np.array_equal(multiEnv.state == -1, ended))
@@ -0,0 +1,183 @@
+import unittest
+
+import gym
+import gym_pomdps
+import gym_dpomdps
+
+import numpy as np
+from types import SimpleNamespace
+
+from GDICE_Python.Domains import MultiPOMDP, VectorizedMultiPOMDP, VectorizedMultiDPOMDP, getExpectedRewards, getMDPBaseline
+from GDICE_Python.Evaluation import evaluateSampleMultiPOMDP, evaluateSamplesMultiPOMDP, evaluateSamplesMultiDPOMDP, evaluateSampleExactPOMDP, \
+    evaluateSamplesExactPOMDP, evaluateSamplesFiniteHorizonPOMDP, evaluateSamplesExactDPOMDP, evaluateSamplesFiniteHorizonDPOMDP, \
+    evaluateSamplesOffPolicy, getEpsilonHorizon
+
+from .controllers import randomControllers
+
+
+# Exact evaluators against simulation of the same controllers, with the same episode ends: the default wrappers keep
+# stepping past the end of an episode, and endEpisodes stops there. Simulations run long enough for the discounted
+# tail to vanish when checking infinite-horizon values
+class ExactEvaluation_Test(unittest.TestCase):
+    numSimulations = 20000
+    numSamples = 3
+
+    # Exact values and standard deviations agree with simulated ones, within 5 standard errors for the values
+    def assertMatchesSimulation(self, exact, simulated):
+        exactValues, exactStdDevs = exact
+        values, stdDevs = simulated
+        np.testing.assert_array_less(np.abs(exactValues - values), 5 * stdDevs / np.sqrt(self.numSimulations) + 1e-9)
+        np.testing.assert_allclose(exactStdDevs, stdDevs, rtol=0.05, atol=1e-6)
+
+    def simulatePOMDP(self, env, timeHorizon, actions, nodes, endEpisodes=True):
+        env.seed(7)
+        multiEnv = VectorizedMultiPOMDP(env, actions.shape[1] * self.numSimulations, endEpisodes=endEpisodes)
+        return evaluateSamplesMultiPOMDP(multiEnv, timeHorizon, actions, nodes)
+
+    def simulateDPOMDP(self, env, timeHorizon, actions, nodes, endEpisodes=True):
+        env.seed(7)
+        multiEnv = VectorizedMultiDPOMDP(env, actions.shape[1] * self.numSimulations, endEpisodes=endEpisodes)
+        return evaluateSamplesMultiDPOMDP(multiEnv, timeHorizon, actions, nodes)
+
+    def test_exact_pomdp(self):
+        env = gym.make('POMDP-tiger-v0')
+        actions, nodes = randomControllers(np.random.RandomState(0), 3, self.numSamples, env.action_space.n, env.observation_space.n)
+        exact = evaluateSamplesExactPOMDP(env, actions, nodes)
+        self.assertMatchesSimulation(exact, self.simulatePOMDP(env, 400, actions, nodes))
+        self.assertEqual(exact[0][0], evaluateSampleExactPOMDP(env, actions[:, 0], nodes[:, :, 0])[0])
+
+    def test_exact_episodic_pomdp(self):
+        env = gym.make('POMDP-4x3-episodic-v0')
+        actions, nodes = randomControllers(np.random.RandomState(1), 4, self.numSamples, env.action_space.n, env.observation_space.n)
+        self.assertMatchesSimulation(evaluateSamplesExactPOMDP(env, actions, nodes, endEpisodes=True), self.simulatePOMDP(env, 400, actions, nodes))
+
+    def test_exact_episodic_pomdp_default_wrappers(self):
+        env = gym.make('POMDP-tiger-episodic-v0')
+        actions, nodes = randomControllers(np.random.RandomState(1), 4, self.numSamples, env.action_space.n, env.observation_space.n)
+        self.assertMatchesSimulation(evaluateSamplesExactPOMDP(env, actions, nodes),
+                                     self.simulatePOMDP(env, 400, actions, nodes, endEpisodes=False))
+
+    # Simulation stops at a step where every trajectory is done, even when the wrapper would keep stepping
+    def test_exact_stops_when_all_done(self):
+        env = gym.make('POMDP-tiger-episodic-v0')
+        env.unwrapped.D = np.array(env.D, dtype=bool)
+        env.unwrapped.D[:, 0] = True  # Action 0 ends the episode from every state
+        actions, nodes = randomControllers(np.random.RandomState(9), 3, 1, env.action_space.n, env.observation_space.n)
+        actions[0] = 0
+        env.seed(7)
+        simulated = evaluateSampleMultiPOMDP(MultiPOMDP(env, self.numSimulations), 400, actions[:, 0], nodes[:, :, 0])
+        self.assertMatchesSimulation(evaluateSampleExactPOMDP(env, actions[:, 0], nodes[:, :, 0]), simulated)
+        np.testing.assert_allclose(evaluateSampleExactPOMDP(env, actions[:, 0], nodes[:, :, 0]),
+                                   np.ravel(evaluateSamplesFiniteHorizonPOMDP(env, 1, actions, nodes)), rtol=1e-9)
+
+    def test_finite_horizon_pomdp(self):
+        env = gym.make('POMDP-4x3-episodic-v0')
+        actions, nodes = randomControllers(np.random.RandomState(2), 4, self.numSamples, env.action_space.n, env.observation_space.n)
+        self.assertMatchesSimulation(evaluateSamplesFiniteHorizonPOMDP(env, 10, actions, nodes, endEpisodes=True),
+                                     self.simulatePOMDP(env, 10, actions, nodes))
+
+    def test_finite_horizon_pomdp_default_wrappers(self):
+        env = gym.make('POMDP-tiger-episodic-v0')
+        actions, nodes = randomControllers(np.random.RandomState(2), 4, self.numSamples, env.action_space.n, env.observation_space.n)
+        self.assertMatchesSimulation(evaluateSamplesFiniteHorizonPOMDP(env, 10, actions, nodes),
+                                     self.simulatePOMDP(env, 10, actions, nodes, endEpisodes=False))
+
+    def test_finite_horizon_matches_exact(self):
+        env = gym.make('POMDP-tiger-v0')
+        actions, nodes = randomControllers(np.random.RandomState(3), 3, self.numSamples, env.action_space.n, env.observation_space.n)
+        np.testing.assert_allclose(evaluateSamplesFiniteHorizonPOMDP(env, 1000, actions, nodes),
+                                   evaluateSamplesExactPOMDP(env, actions, nodes), rtol=1e-6, atol=1e-6)
+        env = gym.make('POMDP-tiger-episodic-v0')
+        for endEpisodes in (False, True):
+            np.testing.assert_allclose(evaluateSamplesFiniteHorizonPOMDP(env, 1000, actions, nodes, endEpisodes),
+                                       evaluateSamplesExactPOMDP(env, actions, nodes, endEpisodes), rtol=1e-6, atol=1e-6)
+
+    def test_exact_dpomdp(self):
+        env = gym.make('DPOMDP-recycling-v0')
+        actions, nodes = randomControllers(np.random.RandomState(4), 2, self.numSamples, env.action_space[0].n,
+                                           env.observation_space[0].n, env.agents)
+        self.assertMatchesSimulation(evaluateSamplesExactDPOMDP(env, actions, nodes), self.simulateDPOMDP(env, 300, actions, nodes))
+
+    def test_finite_horizon_dpomdp(self):
+        env = gym.make('DPOMDP-dectiger-episodic-v0')
+        actions, nodes = randomControllers(np.random.RandomState(5), 2, self.numSamples, env.action_space[0].n,
+                                           env.observation_space[0].n, env.agents)
+        self.assertMatchesSimulation(evaluateSamplesFiniteHorizonDPOMDP(env, 8, actions, nodes, endEpisodes=True),
+                                     self.simulateDPOMDP(env, 8, actions, nodes))
+
+    def test_exact_dpomdp_default_wrappers(self):
+        env = gym.make('DPOMDP-dectiger-episodic-v0')
+        actions, nodes = randomControllers(np.random.RandomState(6), 2, self.numSamples, env.action_space[0].n,
+                                           env.observation_space[0].n, env.agents)
+        self.assertMatchesSimulation(evaluateSamplesExactDPOMDP(env, actions, nodes),
+                                     self.simulateDPOMDP(env, 300, actions, nodes, endEpisodes=False))
+        self.assertMatchesSimulation(evaluateSamplesFiniteHorizonDPOMDP(env, 8, actions, nodes),
+                                     self.simulateDPOMDP(env, 8, actions, nodes, endEpisodes=False))
+
+
+# Variance-reduced estimators keep the mean of plain simulation, with the wrappers that step on past episode ends
+class VarianceReduction_Test(unittest.TestCase):
+    numSimulations = 20000
+
+    def assertUnbiased(self, env, **estimator):
+        actions, nodes = randomControllers(np.random.RandomState(6), 4, 1, env.action_space.n, env.observation_space.n)
+        env.seed(11)
+        value, stdDev = evaluateSampleMultiPOMDP(MultiPOMDP(env, self.numSimulations), 30, actions[:, 0], nodes[:, :, 0])
+        env.seed(12)
+        reducedValue = evaluateSampleMultiPOMDP(MultiPOMDP(env, self.numSimulations), 30, actions[:, 0], nodes[:, :, 0], **estimator)[0]
+        self.assertLessEqual(abs(value - reducedValue), 5 * np.sqrt(2) * stdDev / np.sqrt(self.numSimulations))
+
+    def test_rao_blackwell_episodic(self):
+        env = gym.make('POMDP-4x3-episodic-v0')
+        self.assertUnbiased(env, expectedRewards=getExpectedRewards(env))
+
+    def test_control_variate_episodic(self):
+        env = gym.make('POMDP-4x3-episodic-v0')
+        self.assertUnbiased(env, baseline=getMDPBaseline(env))
+
+
+# Off-policy estimates against direct simulation of the same samples with the same wrapper, on an episodic model
+# The distribution is concentrated on the first sample, so its importance weights keep a large effective sample size
+class OffPolicy_Test(unittest.TestCase):
+    numTrajectories = 40000
+    timeHorizon = 5
+
+    def assertUnbiased(self, endEpisodes):
+        env = gym.make('POMDP-tiger-episodic-v0')
+        nActions, nObs = env.action_space.n, env.observation_space.n
+        actions, nodes = randomControllers(np.random.RandomState(8), 2, 2, nActions, nObs)
+        actionProbabilities = np.full((2, nActions), 0.1 / (nActions - 1))
+        actionProbabilities[np.arange(2), actions[:, 0]] = 0.9
+        nodeTransitionProbabilities = np.full((2, 2, nObs), 0.1)
+        nodeTransitionProbabilities[np.arange(2)[None, :], nodes[:, :, 0], np.arange(nObs)[:, None]] = 0.9
+        MultiEnvWrapper = lambda env, n: VectorizedMultiPOMDP(env, n, endEpisodes=endEpisodes)
+        env.seed(13)
+        values, stdDevs, numSimulations, effectiveSampleSizes = evaluateSamplesOffPolicy(
+            env, MultiEnvWrapper, evaluateSamplesMultiPOMDP, self.timeHorizon, actions, nodes, actionProbabilities,
+            nodeTransitionProbabilities, self.numTrajectories, self.numTrajectories, 0)
+        self.assertTrue(np.all(numSimulations == 0) and effectiveSampleSizes[0] > self.numTrajectories / 20)
+        env.seed(14)
+        directValues, directStdDevs = evaluateSamplesMultiPOMDP(MultiEnvWrapper(env, 2 * self.numTrajectories), self.timeHorizon, actions, nodes)
+        standardError = np.sqrt(directStdDevs[0] ** 2 / self.numTrajectories + stdDevs[0] ** 2 / effectiveSampleSizes[0])
+        self.assertLessEqual(abs(values[0] - directValues[0]), 5 * standardError)
+
+    def test_unbiased_episodic(self):
+        self.assertUnbiased(endEpisodes=False)
+
+    def test_unbiased_end_episodes(self):
+        self.assertUnbiased(endEpisodes=True)
+
+
+class EpsilonHorizon_Test(unittest.TestCase):
+    def test_tail_below_tolerance(self):
+        env = SimpleNamespace(discount=0.9, reward_range=(-10.0, 5.0))
+        horizon = getEpsilonHorizon(env, 0.01)
+        self.assertLessEqual(0.9 ** horizon * 10.0 / 0.1, 0.01)
+        self.assertGreater(0.9 ** (horizon - 1) * 10.0 / 0.1, 0.01)
+
+    def test_at_least_one_step(self):
+        self.assertEqual(getEpsilonHorizon(SimpleNamespace(discount=0.9, reward_range=(-1.0, 1.0)), 100.0), 1)
+        self.assertEqual(getEpsilonHorizon(SimpleNamespace(discount=0.9, reward_range=(0.0, 0.0)), 0.01), 1)
+
+    def test_undiscounted(self):
+        self.assertIsNone(getEpsilonHorizon(SimpleNamespace(discount=1.0, reward_range=(-1.0, 1.0)), 0.01))
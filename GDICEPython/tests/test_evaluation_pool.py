@@ -0,0 +1,131 @@
+import unittest
+
+import gym
+import gym_pomdps
+import gym_dpomdps
+
+import numpy as np
+
+from GDICE_Python.Algorithms import runGDICEOnEnvironment
+from GDICE_Python.Controllers import FiniteStateControllerDistribution
+from GDICE_Python.Domains import VectorizedMultiPOMDP, VectorizedMultiDPOMDP
+from GDICE_Python.Evaluation import evaluateSamplesMultiPOMDP, evaluateSamplesMultiDPOMDP, getEpsilonHorizon
+import GDICE_Python.EvaluationPool
+from GDICE_Python.EvaluationPool import EvaluationPool, ThreadEvaluationPool
+from GDICE_Python.Parameters import GDICEParams
+
+from .controllers import randomControllers
+
+
+# The thread pool's kernel against the vectorized evaluators it replaces
+class ThreadEvaluationPool_Test(unittest.TestCase):
+    numSimulations = 10000
+    numSamples = 2
+    timeHorizon = 20
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = ThreadEvaluationPool(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    # Means agree within 5 standard errors of their difference, and standard deviations within 5%
+    def assertSameStatistics(self, stats1, stats2):
+        values1, stdDevs1 = np.asarray(stats1[0]), np.asarray(stats1[1])
+        values2, stdDevs2 = np.asarray(stats2[0]), np.asarray(stats2[1])
+        standardErrors = np.sqrt((stdDevs1 ** 2 + stdDevs2 ** 2) / self.numSimulations)
+        np.testing.assert_array_less(np.abs(values1 - values2), 5 * standardErrors + 1e-9)
+        np.testing.assert_allclose(stdDevs1, stdDevs2, rtol=0.05, atol=1e-6)
+
+    def assertKernelMatchesPOMDP(self, envName, endEpisodes=False, raoBlackwell=False, controlVariate=False):
+        env = gym.make(envName)
+        actions, nodes = randomControllers(np.random.RandomState(0), 3, self.numSamples, env.action_space.n, env.observation_space.n)
+        MultiEnvWrapper = lambda env, n, **kwargs: VectorizedMultiPOMDP(env, n, endEpisodes=endEpisodes, **kwargs)
+        res = self.pool.evaluateBatches(env, MultiEnvWrapper, self.timeHorizon, [(self.numSimulations, None, 1, actions, nodes)],
+                                        raoBlackwell, controlVariate)[0]
+        env.seed(2)
+        expected = evaluateSamplesMultiPOMDP(MultiEnvWrapper(env, self.numSamples * self.numSimulations), self.timeHorizon, actions, nodes)
+        self.assertSameStatistics(res, expected)
+
+    def test_pomdp(self):
+        self.assertKernelMatchesPOMDP('POMDP-tiger-v0')
+
+    def test_episodic_pomdp(self):
+        self.assertKernelMatchesPOMDP('POMDP-4x3-episodic-v0')
+        self.assertKernelMatchesPOMDP('POMDP-4x3-episodic-v0', endEpisodes=True)
+
+    def test_estimators(self):
+        env = gym.make('POMDP-4x3-episodic-v0')
+        actions, nodes = randomControllers(np.random.RandomState(1), 3, 1, env.action_space.n, env.observation_space.n)
+        plain = self.pool.evaluate(env, VectorizedMultiPOMDP, self.timeHorizon, [(self.numSimulations, 1, actions[:, 0], nodes[:, :, 0])])[0]
+        for raoBlackwell, controlVariate in ((True, False), (False, True)):
+            reduced = self.pool.evaluate(env, VectorizedMultiPOMDP, self.timeHorizon, [(self.numSimulations, 2, actions[:, 0], nodes[:, :, 0])],
+                                         raoBlackwell, controlVariate)[0]
+            self.assertLessEqual(abs(plain[0] - reduced[0]), 5 * np.sqrt(2) * plain[1] / np.sqrt(self.numSimulations))
+
+    def test_dpomdp(self):
+        env = gym.make('DPOMDP-dectiger-episodic-v0')
+        actions, nodes = randomControllers(np.random.RandomState(3), 2, self.numSamples, env.action_space[0].n,
+                                           env.observation_space[0].n, env.agents)
+        res = self.pool.evaluateBatches(env, VectorizedMultiDPOMDP, self.timeHorizon, [(self.numSimulations, None, 4, actions, nodes)])[0]
+        env.seed(5)
+        expected = evaluateSamplesMultiDPOMDP(VectorizedMultiDPOMDP(env, self.numSamples * self.numSimulations), self.timeHorizon, actions, nodes)
+        self.assertSameStatistics(res, expected)
+
+    def test_seeded_tasks_repeat(self):
+        env = gym.make('POMDP-tiger-v0')
+        actions, nodes = randomControllers(np.random.RandomState(4), 3, 1, env.action_space.n, env.observation_space.n)
+        tasks = [(100, 7, actions[:, 0], nodes[:, :, 0])] * 4
+        res = self.pool.evaluate(env, VectorizedMultiPOMDP, self.timeHorizon, tasks)
+        self.assertTrue(all(ent == res[0] for ent in res))
+
+    # Without a horizon, rollouts run until every trajectory is done, which needs episodes that end
+    def test_unbounded_horizon(self):
+        env = gym.make('POMDP-tiger-episodic-v0')
+        env.unwrapped.D[:, 0] = True  # Every trajectory is done after its first step
+        actions, nodes = randomControllers(np.random.RandomState(5), 3, self.numSamples, env.action_space.n, env.observation_space.n)
+        actions[0] = 0
+        MultiEnvWrapper = lambda env, n: VectorizedMultiPOMDP(env, n, endEpisodes=True)
+        tasks = [(self.numSimulations, None, 3, actions, nodes)]
+        np.testing.assert_array_equal(self.pool.evaluateBatches(env, MultiEnvWrapper, None, tasks)[0],
+                                      self.pool.evaluateBatches(env, MultiEnvWrapper, 1, tasks)[0])
+        with self.assertRaises(AssertionError):
+            self.pool.evaluateBatches(env, VectorizedMultiPOMDP, None, tasks)
+
+    # An epsilon horizon (params.timeHorizon None, cut by horizonTolerance) reaches the kernel as a number of steps
+    def test_epsilon_horizon(self):
+        env = gym.make('POMDP-tiger-v0')
+        np.random.seed(0)
+        params = GDICEParams(numNodes=3, numIterations=2, numSamples=4, numSimulationsPerSample=50, timeHorizon=None, horizonTolerance=1.0)
+        controller = FiniteStateControllerDistribution(params.numNodes, env.action_space.n, env.observation_space.n)
+        results = runGDICEOnEnvironment(env, controller, params, parallel=self.pool, saveFrequency=0, envType=2, evalType='batched')
+        np.testing.assert_array_equal(results[10]['timeHorizon'], getEpsilonHorizon(env, params.horizonTolerance))
+        self.assertTrue(np.isfinite(results[0]))
+
+
+# The process pool frees its workers and shared memory blocks when its with block exits, even on errors
+class EvaluationPool_Test(unittest.TestCase):
+    def setUp(self):
+        self.minSharedBytes = GDICE_Python.EvaluationPool._minSharedBytes
+        GDICE_Python.EvaluationPool._minSharedBytes = 0  # Share every table of the small test model
+
+    def tearDown(self):
+        GDICE_Python.EvaluationPool._minSharedBytes = self.minSharedBytes
+
+    def test_shared_memory_unlinked_on_exit(self):
+        from multiprocessing.shared_memory import SharedMemory
+        env = gym.make('POMDP-tiger-v0')
+        actions, nodes = randomControllers(np.random.RandomState(0), 3, 1, env.action_space.n, env.observation_space.n)
+        with self.assertRaises(RuntimeError):
+            with EvaluationPool(2, sharedMemory=True) as pool:
+                value = pool.evaluate(env, VectorizedMultiPOMDP, 10, [(100, 1, actions[:, 0], nodes[:, :, 0])])[0][0]
+                blockNames = [block.name for block in pool.blocks]
+                raise RuntimeError('run failed')
+        self.assertTrue(np.isfinite(value))
+        self.assertTrue(blockNames)
+        self.assertIsNone(pool.pool)
+        for name in blockNames:
+            with self.assertRaises(FileNotFoundError):
+                SharedMemory(name=name)
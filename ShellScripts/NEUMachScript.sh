@@ -1,4 +1,4 @@
 #!/bin/bash
 
 fullDir="/home/david/GDICERes/Entropy/"
-python /home/david/NortheasternStuff/Research/G-DICE/GDICEPython/generalGDICE.py "--save_path" $fullDir "--env_type" "POMDP" "--set_list" "EntPOMDPsToEval.txt"
\ No newline at end of file
+python /home/david/NortheasternStuff/Research/G-DICE/GDICEPython/generalGDICE.py "--save_path" $fullDir "--env_type" "POMDP" "--job_queue" "EntPOMDPsToEval.db" "--set_list" "EntPOMDPsToEval.txt"
\ No newline at end of file
@@ -5,4 +5,4 @@
 #SBATCH --mem=32Gb
 #SBATCH --partition=phi
 
-srun python /scratch/slayback.d/GDICE/G-DICE/GDICEPython/generalGDICE.py $1 $2 $3 $4 $5 $6
\ No newline at end of file
+srun python /scratch/slayback.d/GDICE/G-DICE/GDICEPython/generalGDICE.py "$@"
\ No newline at end of file
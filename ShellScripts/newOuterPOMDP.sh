@@ -1,7 +1,9 @@
 #!/bin/bash
 
 fullDir="/scratch/slayback.d/GDICE/"
+# Import the list into the queue once, the jobs only claim sets from it
+python /scratch/slayback.d/GDICE/G-DICE/GDICEPython/generalGDICE.py "--job_queue" "POMDPsToEval.db" "--set_list" "POMDPsToEval.txt" "--import_only"
 for jobInd in {1..100..1}
 do
-    sbatch /scratch/slayback.d/GDICE/G-DICE/ShellScripts/newInnerPhi.sh "--save_path" $fullDir "--env_type" "POMDP" "--set_list" "POMDPsToEval.txt"
+    sbatch /scratch/slayback.d/GDICE/G-DICE/ShellScripts/newInnerPhi.sh "--save_path" $fullDir "--env_type" "POMDP" "--job_queue" "POMDPsToEval.db"
 done
@@ -1,2 +1,2 @@
 @echo off
-C:\Users\Zhef\Anaconda3\python.exe C:\Users\Zhef\Repositories\G-DICE\GDICEPython\generalGDICE.py "--save_path" "C:\Users\Zhef\GDICERes\Entropy\" "--env_type" "DPOMDP" "--set_list" "EntDPOMDPsToEval.txt"
\ No newline at end of file
+C:\Users\Zhef\Anaconda3\python.exe C:\Users\Zhef\Repositories\G-DICE\GDICEPython\generalGDICE.py "--save_path" "C:\Users\Zhef\GDICERes\Entropy\" "--env_type" "DPOMDP" "--job_queue" "EntDPOMDPsToEval.db" "--set_list" "EntDPOMDPsToEval.txt"
\ No newline at end of file
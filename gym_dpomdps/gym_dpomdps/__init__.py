@@ -1,5 +1,5 @@
 from pkg_resources import resource_listdir, resource_filename, resource_isdir
-from .envs import DPOMDP
+from .envs import DPOMDP, buildCumulativeCSR, sampleFromCumulativeCSR
 from .wrappers import MultiDPOMDP
 from .envs.registration import register, env_list
 
@@ -1 +1 @@
-from .dpomdp import DPOMDP
\ No newline at end of file
+from .dpomdp import DPOMDP, sampleCSRRow, buildCumulativeCSR, sampleFromCumulativeCSR
\ No newline at end of file
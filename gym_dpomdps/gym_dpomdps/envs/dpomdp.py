@@ -4,10 +4,66 @@ import numpy as np
 import gym
 from gym.utils import seeding
 from gym import spaces
+from scipy.sparse import csr_matrix
+
+
+# Sample a column index from one row of a CSR probability table
+def sampleCSRRow(np_random, table, row):
+    rowSlice = slice(table.indptr[row], table.indptr[row + 1])
+    return table.indices[rowSlice][np_random.multinomial(1, table.data[rowSlice]).argmax()].item()
+
+
+# Build a CSR matrix from the nonzero entries of a dense table, with rows and columns indexing the given axes (raveled
+# in that order). Only the nonzero entries are copied
+def buildCSR(table, rowAxes, colAxes):
+    indices = np.nonzero(table)
+    rows = np.ravel_multi_index(tuple(indices[a] for a in rowAxes), tuple(table.shape[a] for a in rowAxes))
+    cols = np.ravel_multi_index(tuple(indices[a] for a in colAxes), tuple(table.shape[a] for a in colAxes))
+    shape = (int(np.prod([table.shape[a] for a in rowAxes])), int(np.prod([table.shape[a] for a in colAxes])))
+    return csr_matrix((table[indices], (rows, cols)), shape=shape)
+
+
+# Build the cumulative form of a CSR probability table for inverse-CDF lookup
+# Each row's normalized cumulative probabilities are offset by the row index, so that the keys of all rows
+# form one sorted array and a single searchsorted finds the sampled entry of every row at once
+# Inputs:
+#   table: scipy.sparse CSR matrix of probabilities (one distribution per row)
+# Outputs:
+#   cumTable: (indptr, indices, keys) of the table
+def buildCumulativeCSR(table):
+    table = table.tocsr()
+    table.eliminate_zeros()
+    table.sort_indices()
+    rowIndices = np.repeat(np.arange(table.shape[0]), np.diff(table.indptr))
+    cumData = np.cumsum(table.data, dtype=np.float64)
+    rowStarts = np.concatenate(([0.0], cumData))[table.indptr[:-1]]  # Cumulative mass before each row
+    rowTotals = np.concatenate(([0.0], cumData))[table.indptr[1:]] - rowStarts
+    keys = rowIndices + (cumData - rowStarts[rowIndices]) / rowTotals[rowIndices]
+    return table.indptr, table.indices, keys
+
+
+# Draw one column index for each of a list of rows of a cumulative CSR table
+# Inputs:
+#   cumTable: (indptr, indices, keys) from buildCumulativeCSR
+#   rows: (n,) int nparray of the row to draw from for each draw
+#   uniforms: (n,) nparray of uniform [0, 1) draws
+# Outputs:
+#   indices: (n,) int32 nparray of sampled column indices
+def sampleFromCumulativeCSR(cumTable, rows, uniforms):
+    indptr, indices, keys = cumTable
+    positions = np.searchsorted(keys, rows + uniforms, side='right')
+    positions = np.clip(positions, indptr[rows], indptr[rows + 1] - 1)  # Guard against rounding at row ends
+    return indices[positions].astype(np.int32)
 
 class DPOMDP(gym.Env):
-    """Environment specified by DPOMDP file"""
-    def __init__(self, path, episodic=False, seed=None):
+    """Environment specified by DPOMDP file
+
+    With sparse=True, T, O and R are stored as CSR matrices over joint (raveled) actions and observations:
+      T: (nStates*nJointActions, nStates), row s*nJointActions + a
+      O: (nJointActions*nStates, nJointObs), row a*nStates + s' (observations do not depend on the start state)
+      R: (nStates*nJointActions, nStates*nJointObs), row s*nJointActions + a, column s'*nJointObs + o
+    """
+    def __init__(self, path, episodic=False, seed=None, sparse=False):
         debug=False
         #debug = True if 'skewed' in path else False
         self.episodic = episodic
@@ -26,12 +82,23 @@ class DPOMDP(gym.Env):
         else:
             self.start = model.start
 
-        # Start-state, agent actions, end state
-        self.T = model.T.transpose(self.agents, *(np.arange(self.agents)), self.agents+1).copy()
-        # Start, agent actions, end, agent observations
-        self.O = np.stack([model.O] * self.state_space.n)
-        # Start-state, agent actions, end state, agent observations
-        self.R = model.R.transpose(self.agents, *(np.arange(self.agents)), self.agents+1, *(np.arange(self.agents)+self.agents+2)).copy()
+        self.sparse = sparse
+        self.actionShape = tuple(aSpace.n for aSpace in self.action_space)
+        self.obsShape = tuple(oSpace.n for oSpace in self.observation_space)
+        self.nJointActions, self.nJointObs = int(np.prod(self.actionShape)), int(np.prod(self.obsShape))
+        if sparse:
+            # Built from the nonzero entries of the parsed tables, without transposed dense copies
+            actionAxes, obsAxes = tuple(range(self.agents)), tuple(range(self.agents + 2, 2 * self.agents + 2))
+            self.T = buildCSR(model.T, (self.agents,) + actionAxes, (self.agents + 1,))
+            self.O = buildCSR(model.O, actionAxes + (self.agents,), tuple(range(self.agents + 1, 2 * self.agents + 1)))
+            self.R = buildCSR(model.R, (self.agents,) + actionAxes, (self.agents + 1,) + obsAxes)
+        else:
+            # Start-state, agent actions, end state
+            self.T = model.T.transpose(self.agents, *(np.arange(self.agents)), self.agents+1).copy()
+            # Start, agent actions, end, agent observations
+            self.O = np.stack([model.O] * self.state_space.n)
+            # Start-state, agent actions, end state, agent observations
+            self.R = model.R.transpose(self.agents, *(np.arange(self.agents)), self.agents+1, *(np.arange(self.agents)+self.agents+2)).copy()
 
         if episodic:
             self.D = model.reset.T.copy()  # only if episodic
@@ -52,6 +119,8 @@ class DPOMDP(gym.Env):
             assert len(actions) == self.agents, 'Must provide joint action'
         else:
             assert actions.shape[0] == self.agents, 'Must provide joint action'
+        if self.sparse:
+            return self._stepSparse(actions)
 
         state1 = self.np_random.multinomial(
             1, self.T[self.state, (*actions)]).argmax().item()
@@ -73,3 +142,25 @@ class DPOMDP(gym.Env):
             self.state = state1
 
         return obs, reward, done, {}
+
+    # Step using the CSR tables (see class docstring)
+    def _stepSparse(self, actions):
+        nStates = self.state_space.n
+        jointAction = np.ravel_multi_index(tuple(actions), self.actionShape)
+        row = self.state * self.nJointActions + jointAction
+        state1 = sampleCSRRow(self.np_random, self.T, row)
+        jointObs = sampleCSRRow(self.np_random, self.O, jointAction * nStates + state1)
+        obs = np.unravel_index(jointObs, self.obsShape)
+        reward = float(self.R[row, state1 * self.nJointObs + jointObs])
+
+        if self.episodic:
+            done = self.D[(self.state,) + tuple(actions)]
+        else:
+            done = False
+
+        if done:
+            self.state = None
+        else:
+            self.state = state1
+
+        return obs, reward, done, {}
@@ -1,6 +1,6 @@
 import gym
 import numpy as np
-from ..envs import DPOMDP
+from ..envs import DPOMDP, buildCumulativeCSR, sampleFromCumulativeCSR
 
 # For dpomdps
 #   Only difference is that actions and observations now have an additional dimension for each agent at the end
@@ -13,6 +13,9 @@ class MultiDPOMDP(gym.Wrapper):
         self.reset()
 
     def __getattr__(self, attr):
+        # env is not set yet while unpickling (e.g. in pool workers)
+        if attr == 'env':
+            raise AttributeError(attr)
         return getattr(self.env, attr)
 
     def reset(self):
@@ -49,6 +52,8 @@ class MultiDPOMDP(gym.Wrapper):
         validStates = self.state[notDoneIndices]
         validActions = actions[notDoneIndices, :]
         validActionIndices = tuple(aAct.flatten() for aAct in np.split(validActions, self.nAgents, axis=1))
+        if self.env.sparse:
+            return self._stepSparse(validStates, validActionIndices, notDoneIndices, doneIndices)
         validNewStates = np.array([self.np_random.multinomial(1, p).argmax()
                                    for p in self.env.T[validStates, (*validActionIndices)]])
         validObs = np.array([self.np_random.multinomial(1, p.flatten()).argmax()
@@ -66,3 +71,33 @@ class MultiDPOMDP(gym.Wrapper):
         self.state = newStates
 
         return obs, rewards, done, {}
+
+    # Step the trajectories that are not done using the CSR tables of a sparse DPOMDP
+    # Successor states and joint observations of all trajectories are drawn at once, by searchsorted in cumulative CSR
+    # tables (built once and cached on the environment as cumT and cumO)
+    def _stepSparse(self, validStates, validActionIndices, notDoneIndices, doneIndices):
+        nStates = self.state_space.n
+        if getattr(self.env, 'cumT', None) is None:
+            self.env.cumT, self.env.cumO = buildCumulativeCSR(self.env.T), buildCumulativeCSR(self.env.O)
+        newStates = np.zeros(self.nTrajectories, dtype=np.int32)
+        obs = np.zeros((self.nTrajectories, self.nAgents), dtype=np.int32)
+        rewards = np.zeros(self.nTrajectories, dtype=np.float64)
+        done = np.ones(self.nTrajectories, dtype=bool)
+
+        validJointActions = np.ravel_multi_index(validActionIndices, self.env.actionShape)
+        validRows = validStates * self.env.nJointActions + validJointActions
+        u = self.np_random.uniform(size=(2, validRows.shape[0]))
+        validNewStates = sampleFromCumulativeCSR(self.env.cumT, validRows, u[0])
+        validJointObs = sampleFromCumulativeCSR(self.env.cumO, validJointActions * nStates + validNewStates, u[1])
+        validRewards = np.asarray(self.env.R[validRows, validNewStates * self.env.nJointObs + validJointObs]).ravel()
+        if self.env.episodic:
+            done[notDoneIndices] = self.env.D[(validStates,) + validActionIndices]
+        else:
+            done *= False
+
+        newStates[notDoneIndices], newStates[doneIndices] = validNewStates, -1
+        obs[notDoneIndices, :], obs[doneIndices, :] = np.stack(np.unravel_index(validJointObs, self.env.obsShape), axis=1), -1
+        rewards[notDoneIndices], rewards[doneIndices] = validRewards, 0.0
+        self.state = newStates
+
+        return obs, rewards, done, {}
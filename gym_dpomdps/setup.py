@@ -6,6 +6,6 @@ setup(
     version='0.1.0',
     packages=find_packages(),
     package_data={'': ['*.dpomdp']},
-    install_requires=['numpy', 'gym'],
+    install_requires=['numpy', 'scipy', 'gym'],
     test_suite='tests',
 )
\ No newline at end of file
@@ -47,4 +47,40 @@ class GymDPOMDPs_Test(unittest.TestCase):
             agent1Actions = np.random.choice(np.arange(env.action_space[0].n, dtype=int), 50)
             agent2Actions = np.random.choice(np.arange(env.action_space[1].n, dtype=int), 50)
             actions = np.stack((agent1Actions, agent2Actions), axis=1)
-            obs, rewards, done, _ = multiEnv.step(actions)
\ No newline at end of file
+            obs, rewards, done, _ = multiEnv.step(actions)
+
+    def test_sparse_tables(self):
+        env = gym.make('DPOMDP-recycling-v0')
+        sparseEnv = gym.make('DPOMDP-recycling-v0', sparse=True)
+        nStates = env.state_space.n
+
+        np.testing.assert_allclose(sparseEnv.T.toarray(), env.T.reshape(sparseEnv.T.shape))
+        np.testing.assert_allclose(sparseEnv.O.toarray(), env.O[0].reshape(sparseEnv.O.shape))
+        np.testing.assert_allclose(sparseEnv.R.toarray(),
+                                   env.R.reshape(nStates * sparseEnv.nJointActions, nStates * sparseEnv.nJointObs))
+
+    def test_sparse_seed(self):
+        env = gym.make('DPOMDP-dectiger-v0', sparse=True)
+
+        seed = 17
+        actions = [(i,j) for i in range(env.action_space[0].n) for j in range(env.action_space[1].n)]*10
+
+        env.seed(seed)
+        env.reset()
+        outputs = list(map(env.step, actions))
+
+        env.seed(seed)
+        env.reset()
+        outputs2 = list(map(env.step, actions))
+        self.assertEqual(outputs, outputs2)
+
+    def test_sparse_multi(self):
+        env = gym.make('DPOMDP-recycling-v0', sparse=True)
+        multiEnv = gym_dpomdps.MultiDPOMDP(env, 50)
+        for timestep in range(50):
+            agent1Actions = np.random.choice(np.arange(env.action_space[0].n, dtype=int), 50)
+            agent2Actions = np.random.choice(np.arange(env.action_space[1].n, dtype=int), 50)
+            actions = np.stack((agent1Actions, agent2Actions), axis=1)
+            obs, rewards, done, _ = multiEnv.step(actions)
+            self.assertEqual(obs.shape, (50, 2))
+            self.assertTrue(np.all((obs >= 0) & (obs < env.observation_space[0].n)))